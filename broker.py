@@ -1,18 +1,27 @@
 import time
+# startup is timed from here; see the report printed once the drivers are set up
+started = time.perf_counter()
 import sqlite3
 import redis, json
+import redis.asyncio as aioredis
 import asyncio, datetime
 import sys
-import nest_asyncio
-import configparser
+import socket
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import core_error
-
-nest_asyncio.apply()
+import core_metrics
+import core_transport
 
 from broker_root import broker_root
-from broker_ibkr import broker_ibkr
-from broker_alpaca import broker_alpaca
+from broker_snapshot import AccountSnapshot
+from broker_config import ConfigProfiles
+from broker_pipeline import KeyedLocks, SignalGate, SignalCoalescer
+# drivers (and their broker libraries) are imported on demand, see create_driver
+import broker_drivers
+import broker_prices
+
+imports_ms = (time.perf_counter() - started) * 1000
 
 
 # arguments: broker.py [bot]
@@ -24,8 +33,8 @@ bot = sys.argv[1]
 
 last_time_traded = {}
 
-config = configparser.ConfigParser()
-config.read('config.ini')
+# config.ini compiled into per-account profiles; watch_config recompiles it when the file changes
+profiles = ConfigProfiles('config.ini')
 
 
 # SQLite connection (simpler than PostgreSQL)
@@ -53,20 +62,19 @@ def handle_ex(e, context="unknown"):
     core_error.handle_ex(e, context=context, service="broker")
 
 
-# connect to Redis and subscribe to tradingview messages
+# connect to Redis; the subscription itself lives in listen_for_messages()
 r = redis.Redis(host='localhost', port=6379, db=0)
-p = r.pubsub()
-p.subscribe('tradingview')
 
 # figure out what account list to use, if any is specified
-accountlist = config[f"bot-{bot}"]['accounts']
-accounts = accountlist.split(",")
+accounts = profiles.get_accounts(bot)
 
-
-print("Waiting for webhook messages...")
-async def execute_trades(trades):
+async def execute_trades(trades, snapshots=None):
     try:
-        tasks = [driver.set_position_size(symbol, amount) for driver, symbol, amount in trades]
+        # hand the drivers the positions we already know, so they don't look them up again
+        if snapshots:
+            tasks = [driver.set_position_size(symbol, amount, snapshots[driver].get_position_size(symbol)) for driver, symbol, amount in trades]
+        else:
+            tasks = [driver.set_position_size(symbol, amount) for driver, symbol, amount in trades]
         order_ids = await asyncio.gather(*tasks)
         return list(zip([driver for driver, _, _ in trades], order_ids))
     except Exception as e:
@@ -74,49 +82,56 @@ async def execute_trades(trades):
         raise
 
 async def wait_for_trades(drivers_and_orders, signal_id, timeout=30):
+    """Wait for the drivers to report every order done; returns the (driver, order) pairs
+    that were still open when the timeout ran out"""
     try:
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            incomplete_trades = []
-            for driver, order_id in drivers_and_orders:
-                if not await driver.is_trade_completed(order_id):
+        # orders that didn't need placing (no change in position) have nothing to wait for
+        waits = [(driver, order_id, driver.get_trade_event(order_id)) for driver, order_id in drivers_and_orders if order_id is not None]
+        start = time.perf_counter()
+        if waits:
+            waiters = [asyncio.ensure_future(event.wait()) for _, _, event in waits]
+            _, pending = await asyncio.wait(waiters, timeout=timeout)
+            for waiter in pending:
+                waiter.cancel()
+
+        incomplete_trades = []
+        try:
+            for driver, order_id, event in waits:
+                # one last direct check in case the order finished while its stream was down
+                if not event.is_set() and not await driver.check_trade_completed(order_id):
                     incomplete_trades.append((driver, order_id))
-            
-            if not incomplete_trades:
-                if signal_id:
-                    update_signal(signal_id, {'processed': datetime.datetime.now().isoformat()})
-                print(f"All trades for signal {signal_id} completed")
-                return True  # All trades completed
-            
-            drivers_and_orders = incomplete_trades
-            await asyncio.sleep(1)
-        
-        return False  # Timeout reached, some trades incomplete
+        finally:
+            # nothing waits on these orders after this, so the drivers can stop tracking them
+            for driver, order_id, _ in waits:
+                driver.forget_trade(order_id)
+
+        if not incomplete_trades:
+            if signal_id:
+                update_signal(signal_id, {'processed': datetime.datetime.now().isoformat()})
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            core_metrics.timing('broker.fill_wait', elapsed_ms, tags=[f'bot:{bot}'])
+            print(f"All trades for signal {signal_id} completed in {elapsed_ms:.0f}ms")
+        return incomplete_trades
     except Exception as e:
         handle_ex(e, context="trade_monitoring_error")
         raise
 
-def get_account_config(account):
-    config.read('config.ini')
-    account_config = config[account]
-    if 'group' in account_config:
-        group = account_config['group']
-        group_config = config[group]
-        # Merge group config into account config, account config takes precedence
-        merged_config = {**group_config, **account_config}
-        return merged_config
-    return account_config
-
-def setup_trades_for_account(account, signal_order_symbol, signal_position_pct, closing_trades, opening_trades):
+def get_account_profile(account):
+    return profiles.get(account)
+
+def setup_trades_for_account(account, signal_order_symbol, signal_position_pct, closing_trades, opening_trades, snapshot=None):
     print("executing trades for account",account)
 
-    aconfig = get_account_config(account)
+    profile = get_account_profile(account)
     driver = drivers[account]
+    # positions and net liquidity are read once per signal
+    if snapshot is None:
+        snapshot = AccountSnapshot(driver)
     order_symbol_lower = signal_order_symbol.lower()
 
     # Initialize order_stock and price with original symbol first
     order_stock = driver.get_stock(signal_order_symbol)
-    order_price = driver.get_price(signal_order_symbol)
+    order_price = snapshot.get_price(signal_order_symbol)
 
     # position percentage to use for this trade on this account, start with input pct first
     position_pct = signal_position_pct
@@ -125,46 +140,49 @@ def setup_trades_for_account(account, signal_order_symbol, signal_position_pct,
     order_symbol = signal_order_symbol
 
     # Get the max configured percentage for this security and scale the signal
-    if f"{order_symbol_lower}-pct" in aconfig:
-        config_value = aconfig[f"{order_symbol_lower}-pct"]
-        if ',' in config_value and aconfig.get('use-futures', 'no') == 'yes':
-            # Parse format like "1.5, NQ" into percentage and target symbol
-            pct_str, target_symbol = [x.strip() for x in config_value.split(',')]
-            # Scale the signal percentage by the configured percentage
-            position_pct = 0 if signal_position_pct == 0 else float(pct_str) * (signal_position_pct / 100.0)
-            order_symbol = target_symbol
+    rule = profile.get_rule(order_symbol_lower)
+    if rule is not None:
+        if rule.target_symbol is not None and profile.use_futures:
+            # a setting like "1.5, NQ": scale the signal percentage by the configured percentage
+            position_pct = 0 if signal_position_pct == 0 else rule.pct * (signal_position_pct / 100.0)
+            order_symbol = rule.target_symbol
             order_stock = driver.get_stock(order_symbol)
-            order_price = driver.get_price(order_symbol)
+            order_price = snapshot.get_price(order_symbol)
         else:
-            max_pct = float(config_value.split(',')[0])
             # Scale the position percentage by the max allowed percentage
-            position_pct = signal_position_pct * (max_pct / 100.0)
+            position_pct = signal_position_pct * (rule.pct / 100.0)
     else:
-        max_pct = float(aconfig.get("default-pct", "100"))
         # Scale the position percentage by the max allowed percentage
-        position_pct = signal_position_pct * (max_pct / 100.0)
+        position_pct = signal_position_pct * (profile.default_pct / 100.0)
     
     print(f"Using position size of {position_pct}% for {order_symbol}")
 
     # check if the resulting order is for futures and if they're allowed
-    if order_stock.is_futures and aconfig.get('use-futures', 'no') == 'no':
+    if order_stock.is_futures and not profile.use_futures:
         print("this account doesn't allow futures; skipping to inverse ETF logic")
         order_symbol = signal_order_symbol  # Reset to original symbol
         order_stock = driver.get_stock(order_symbol)  # Reset to original stock
-        order_price = driver.get_price(order_symbol)  # Reset to original price
+        order_price = snapshot.get_price(order_symbol)  # Reset to original price
+
+    # futures still held in a month that has since been rolled past are closed; the signal
+    # itself trades the month that's current now
+    if order_stock.is_futures:
+        for rolled_symbol, rolled_size in snapshot.rolled_positions(order_symbol).items():
+            print(f"sending order to close {rolled_symbol} (current: {rolled_size}), rolled into the next month")
+            closing_trades.append((driver, rolled_symbol, 0))
 
     # if this account needs different ETF's for short vs long, close the other side
     # or both if we're going flat
-    if aconfig.get('use-inverse-etf', 'no') == 'yes':
+    if profile.use_inverse_etf:
         if position_pct >= 0:
-            short_symbol = config['inverse-etfs'].get(order_symbol)
+            short_symbol = profile.inverse_etfs.get(order_symbol.lower())
             if short_symbol is not None:
-                current_short = driver.get_position_size(short_symbol)
+                current_short = snapshot.get_position_size(short_symbol)
                 if current_short != 0:
                     print(f"sending order to close short position of {short_symbol} (current: {current_short})")
                     closing_trades.append((driver, short_symbol, 0))
         if position_pct <= 0:
-            current_long = driver.get_position_size(order_symbol)
+            current_long = snapshot.get_position_size(order_symbol)
             if current_long != 0:
                 print(f"sending order to close long position of {order_symbol} (current: {current_long})")
                 closing_trades.append((driver, order_symbol, 0))
@@ -176,30 +194,32 @@ def setup_trades_for_account(account, signal_order_symbol, signal_position_pct,
             return closing_trades, opening_trades
 
     # check for overall multipliers on the account
-    if not order_stock.is_futures and aconfig.get("multiplier", "") != "":
-        print("multiplying position by ",float(aconfig["multiplier"]))
-        position_pct = position_pct * float(aconfig["multiplier"])
+    if not order_stock.is_futures and profile.multiplier is not None:
+        print("multiplying position by ",profile.multiplier)
+        position_pct = position_pct * profile.multiplier
 
     # switch from short a long ETF to long a short ETF, if this account needs it
-    if position_pct < 0 and aconfig.get('use-inverse-etf', 'no') == 'yes':
-        long_price = driver.get_price(order_symbol)
+    if position_pct < 0 and profile.use_inverse_etf:
+        long_price = snapshot.get_price(order_symbol)
         long_symbol = order_symbol
-        short_symbol = config['inverse-etfs'][order_symbol_lower]
+        if order_symbol_lower not in profile.inverse_etfs:
+            raise Exception(f"No inverse ETF configured for {signal_order_symbol}")
+        short_symbol = profile.inverse_etfs[order_symbol_lower]
 
         # now continue with the short ETF
         order_symbol = short_symbol
-        short_price = driver.get_price(order_symbol)
+        short_price = snapshot.get_price(order_symbol)
         order_price = short_price
         position_pct = abs(position_pct)
         print(f"switching to inverse ETF {order_symbol}, to position {position_pct}% at price ", order_price)
 
     # Calculate desired position size based on net liquidity and position percentage
-    net_liquidity = driver.get_net_liquidity()
+    net_liquidity = snapshot.get_net_liquidity()
     
-    # For micro futures, adjust the price to be 1/10th
+    # some futures (the micros) are sized at a fraction of their price, see price_scale in instruments.json
     effective_price = order_price
-    if order_stock.is_futures and order_symbol.startswith('M'):
-        effective_price = order_price / 10
+    if order_stock.is_futures:
+        effective_price = order_price * order_stock.price_scale
     
     raw_position = (net_liquidity * (position_pct/100.0)) / effective_price
     desired_position = round(raw_position)
@@ -212,7 +232,7 @@ def setup_trades_for_account(account, signal_order_symbol, signal_position_pct,
     
     print(f"Position calculation: {net_liquidity} * {position_pct}% / {effective_price} = {raw_position} -> {desired_position}")
     
-    current_position = driver.get_position_size(order_symbol)
+    current_position = snapshot.get_position_size(order_symbol)
 
     # now let's go ahead and place the order to reach the desired position
     if desired_position != current_position:
@@ -223,32 +243,261 @@ def setup_trades_for_account(account, signal_order_symbol, signal_position_pct,
 
     return closing_trades, opening_trades
 
+# thread pools for account planning, one per driver type; drivers whose connection is
+# bound to the event loop (planning_threads = 0) are planned on the loop itself
+planning_pools = {}
+
+async def run_for_driver(driver, fn):
+    """Run blocking driver work on the driver type's planning pool, or inline if it has none"""
+    if driver.planning_threads > 0:
+        driver_type = type(driver).__name__
+        if driver_type not in planning_pools:
+            planning_pools[driver_type] = ThreadPoolExecutor(max_workers=driver.planning_threads, thread_name_prefix=f"plan-{driver_type}")
+        return await asyncio.get_running_loop().run_in_executor(planning_pools[driver_type], fn)
+    return fn()
+
+async def prefetch_prices(order_symbol):
+    """Fetch the price of every symbol this signal may touch, across all accounts, with one
+    get_prices call per driver type; returns driver type -> {symbol: price}"""
+    symbols_by_type = {}
+    driver_by_type = {}
+    for account, symbol in signal_keys(order_symbol):
+        driver = drivers.get(account)
+        if driver is None or not driver.ready:
+            continue
+        driver_type = type(driver).__name__
+        driver_by_type.setdefault(driver_type, driver)
+        symbols_by_type.setdefault(driver_type, set()).add(symbol)
+
+    async def fetch(driver_type):
+        symbols = sorted(symbols_by_type[driver_type])
+        try:
+            driver = driver_by_type[driver_type]
+            with core_metrics.timed('broker.price_prefetch', tags=[f'driver:{driver_type}']):
+                if driver.planning_threads > 0:
+                    return await run_for_driver(driver, lambda: driver.get_prices(symbols))
+                return await driver.get_prices_async(symbols)
+        except Exception as e:
+            # accounts fall back to fetching their own prices
+            print(f"price prefetch for {driver_type} {symbols} failed: {e}")
+            return {}
+
+    driver_types = list(symbols_by_type)
+    results = await asyncio.gather(*[fetch(driver_type) for driver_type in driver_types])
+    return dict(zip(driver_types, results))
+
+async def plan_account(account, order_symbol, signal_position_pct, prices=None):
+    driver = drivers[account]
+    closing_trades = []
+    opening_trades = []
+    start = time.perf_counter()
+
+    def plan():
+        snapshot = AccountSnapshot(driver, prices)
+        setup_trades_for_account(account, order_symbol, signal_position_pct, closing_trades, opening_trades, snapshot)
+        return snapshot
+
+    if driver.planning_threads == 0:
+        # planned on the loop, where nothing may block, so fetch everything it reads first
+        symbols = sorted(symbol for key_account, symbol in signal_keys(order_symbol) if key_account == account)
+        prices = await driver.prepare_async(symbols, prices)
+    snapshot = await run_for_driver(driver, plan)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    core_metrics.timing('broker.plan_account', elapsed_ms, tags=[f'bot:{bot}', f'account:{account}'])
+    return closing_trades, opening_trades, snapshot, elapsed_ms
+
+async def plan_trades(order_symbol, signal_position_pct):
+    """Plan every account in parallel, then merge the trades in account order so the
+    closing/opening lists come out the same no matter which account finished first"""
+    start = time.perf_counter()
+    prices = await prefetch_prices(order_symbol)
+    planned = ready_accounts()
+    for account in accounts:
+        if account not in planned:
+            # still connecting (see start_drivers); it catches up with the next signal
+            print(f"account {account} is not ready, skipping it for this signal")
+            core_metrics.increment('broker.account_not_ready', tags=[f'bot:{bot}', f'account:{account}'])
+    results = await asyncio.gather(*[plan_account(account, order_symbol, signal_position_pct, prices.get(type(drivers[account]).__name__))
+                                     for account in planned],
+                                   return_exceptions=True)
+    closing_trades = []
+    opening_trades = []
+    snapshots = {}
+    timings = []
+    for account, result in zip(planned, results):
+        if isinstance(result, BaseException):
+            raise result
+        account_closing, account_opening, snapshot, elapsed_ms = result
+        closing_trades.extend(account_closing)
+        opening_trades.extend(account_opening)
+        snapshots[drivers[account]] = snapshot
+        timings.append(f"{account} {elapsed_ms:.1f}ms")
+    total_ms = (time.perf_counter() - start) * 1000
+    core_metrics.timing('broker.plan_signal', total_ms, tags=[f'bot:{bot}'])
+    print(f"planning took {total_ms:.1f}ms: {', '.join(timings)}")
+    return closing_trades, opening_trades, snapshots
+
 # After setting up accounts list but before the message loop...
 
-print("Initializing broker connections...")
-drivers = {}
-for account in accounts:
+def create_driver(account):
+    profile = get_account_profile(account)
+    print(f"\nInitializing connection for account {account} using {profile.driver} driver...")
+
+    return broker_drivers.create(profile.driver, bot, account)
+
+# connection settings each driver was built from, so a config reload can tell which ones changed
+driver_settings = {}
+
+def init_driver(account):
     try:
-        aconfig = get_account_config(account)
-        print(f"\nInitializing connection for account {account} using {aconfig['driver']} driver...")
-        
-        if aconfig['driver'] == 'ibkr':
-            driver = broker_ibkr(bot, account)
-        elif aconfig['driver'] == 'alpaca':
-            driver = broker_alpaca(bot, account)
-        else:
-            raise Exception(f"Unknown driver: {aconfig['driver']}")
-            
+        driver_settings[account] = get_account_profile(account).connection
         # Cache the driver instance
-        drivers[account] = driver
-        
+        drivers[account] = create_driver(account)
     except Exception as e:
+        drivers.pop(account, None)
         error_msg = f"Failed to initialize {account}: {str(e)}"
         print(error_msg)
         handle_ex(error_msg)
 
-async def check_messages():
-    message = p.get_message()
+# how long startup waits for an account's driver to connect (the start-timeout setting
+# overrides it per account); accounts that aren't ready by then keep connecting in the
+# background, and are left out of signals until they are
+DRIVER_START_TIMEOUT = 30
+DRIVER_RETRY_DELAY = 1
+DRIVER_RETRY_MAX_DELAY = 60
+
+async def keep_starting(account, driver):
+    delay = DRIVER_RETRY_DELAY
+    start = time.perf_counter()
+    while drivers.get(account) is driver or replacement_drivers.get(account) is driver:
+        try:
+            await driver.start_async()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            core_metrics.timing('broker.driver_ready', elapsed_ms, tags=[f'bot:{bot}', f'account:{account}'])
+            print(f"account {account} ready after {elapsed_ms:.0f}ms")
+            return True
+        except Exception as e:
+            print(f"starting driver for {account} failed: {e}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DRIVER_RETRY_MAX_DELAY)
+    # the account was dropped or rebuilt by a config reload
+    return False
+
+# per account, the task connecting its driver
+driver_starts = {}
+# per account, a driver rebuilt by a config reload that is still connecting; the account's
+# current driver keeps trading until it's ready (see replace_driver)
+replacement_drivers = {}
+
+def start_driver(account):
+    loop = asyncio.get_running_loop()
+    driver = drivers.get(account)
+    if driver is None:
+        return None
+    task = driver_starts[account] = loop.create_task(keep_starting(account, driver))
+    return task
+
+async def start_drivers():
+    """Connect every account's driver concurrently, waiting for each up to its deadline"""
+    async def wait_for(account):
+        task = start_driver(account)
+        if task is None:
+            return
+        timeout = float(get_account_profile(account).get('start-timeout', DRIVER_START_TIMEOUT))
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            core_metrics.increment('broker.driver_start_timeout', tags=[f'bot:{bot}', f'account:{account}'])
+            print(f"account {account} not ready after {timeout:.0f}s, still connecting in the background")
+    await asyncio.gather(*[wait_for(account) for account in accounts])
+
+def replace_driver(account):
+    old = drivers.get(account)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # no event loop (not running under main); the driver connects on first use
+        loop = None
+    if old is None or not old.ready or loop is None:
+        # nothing is trading through the old driver, so there's nothing to keep serving
+        init_driver(account)
+        if loop is not None:
+            start_driver(account)
+        return
+    try:
+        driver = create_driver(account)
+    except Exception as e:
+        error_msg = f"Failed to rebuild driver for {account}, keeping the current one: {str(e)}"
+        print(error_msg)
+        handle_ex(error_msg)
+        return
+    driver_settings[account] = get_account_profile(account).connection
+    replacement_drivers[account] = driver
+    driver_starts[account] = loop.create_task(switch_when_ready(account, driver))
+
+async def switch_when_ready(account, driver):
+    if not await keep_starting(account, driver):
+        return False
+    # not while a signal is using the old driver
+    async with signal_gate.exclusive():
+        if replacement_drivers.get(account) is not driver:
+            return False
+        del replacement_drivers[account]
+        drivers[account] = driver
+    print(f"account {account} switched to its rebuilt driver")
+    return True
+
+def ready_accounts():
+    return [account for account in accounts if account in drivers and drivers[account].ready]
+
+print("Initializing broker drivers...")
+drivers_started = time.perf_counter()
+drivers = {}
+for account in accounts:
+    init_driver(account)
+drivers_ms = (time.perf_counter() - drivers_started) * 1000
+
+def reload_config():
+    """Pick up freshly compiled profiles and rebuild only the drivers whose connection settings
+    changed. Other accounts keep their driver, and with it their connections and caches; sizing
+    settings are read from the profiles on every signal, so they need no new driver."""
+    global accounts
+    new_accounts = profiles.get_accounts(bot)
+
+    for account in new_accounts:
+        try:
+            if account in drivers and driver_settings.get(account) == get_account_profile(account).connection:
+                continue
+        except Exception as e:
+            print(f"config for account {account} is invalid: {e}")
+        print(f"connection settings changed for account {account}, rebuilding its driver")
+        replace_driver(account)
+
+    for account in list(drivers):
+        if account not in new_accounts:
+            print(f"account {account} is no longer used by bot {bot}, dropping its driver")
+            del drivers[account]
+            driver_settings.pop(account, None)
+            driver_starts.pop(account, None)
+            replacement_drivers.pop(account, None)
+
+    accounts = new_accounts
+
+async def watch_config(interval=5):
+    while True:
+        await asyncio.sleep(interval)
+        if not profiles.changed():
+            continue
+        print("config.ini changed, reloading")
+        # don't swap drivers or profiles out from under a signal that's mid-flight
+        async with signal_gate.exclusive():
+            try:
+                profiles.refresh()
+                reload_config()
+            except Exception as e:
+                handle_ex(e, context="config_reload")
+
+async def check_messages(message):
     if message is not None and message['type'] == 'message':
         print("*** ",datetime.datetime.now())
         print(message)
@@ -257,17 +506,18 @@ async def check_messages():
             try:
                 print("health check received")
                 drivers_checked = {}
-                for account in accounts:
+                # accounts still connecting (or whose driver failed to set up) have nothing to check yet
+                for account in ready_accounts():
                     driver = drivers[account]
-                    aconfig = get_account_config(account)
+                    profile = get_account_profile(account)
 
-                    if aconfig['driver'] not in drivers_checked:
-                        drivers_checked[aconfig['driver']] = True
-                        print(f"health check for prices with driver {aconfig['driver']}")
-                        driver.health_check_prices()
+                    if profile.driver not in drivers_checked:
+                        drivers_checked[profile.driver] = True
+                        print(f"health check for prices with driver {profile.driver}")
+                        await driver.health_check_prices_async()
 
                     print("checking positions for account",account)
-                    driver.health_check_positions()
+                    await driver.health_check_positions_async()
 
                 r.publish('health', 'ok')
             except Exception as e:
@@ -281,6 +531,8 @@ async def check_messages():
                 print("Error loading json: ",e)
                 return
 
+            record_transport_latency(message, data_dict)
+
             if 'bot' not in data_dict['strategy']:
                 raise Exception("You need to indicate the bot in the strategy portion of the json payload")
             # special case: a manual trade is treated like a live trade
@@ -293,8 +545,6 @@ async def check_messages():
             if 'ticker' not in data_dict:
                 raise Exception("No ticker found in signal data")
 
-            config.read('config.ini')
-
             ## extract data from TV payload received via webhook
             order_symbol_orig = data_dict['ticker']                             # ticker for which TV order was sent
             order_symbol = order_symbol_orig  # Initialize order_symbol with original ticker
@@ -309,63 +559,272 @@ async def check_messages():
             signal_id = data_dict['strategy'].get('id', None)
             is_retry = data_dict.get('is_retry', False)  # Check if this is a retry signal
 
-            closing_trades = []
-            opening_trades = []
-            for account in accounts:
-                closing_trades, opening_trades = setup_trades_for_account(account, order_symbol, signal_position_pct, closing_trades, opening_trades)
-
-            # For retry signals, filter out trades where position difference is <= 5%
-            if is_retry and len(opening_trades) > 0:
-                filtered_trades = []
-                for driver, symbol, target_pos in opening_trades:
-                    current_pos = driver.get_position_size(symbol)
-                    if target_pos == 0:
-                        pct_diff = 100 if current_pos != 0 else 0
-                    else:
-                        pct_diff = abs((current_pos - target_pos) / target_pos * 100)
-                    if pct_diff > 5:
-                        filtered_trades.append((driver, symbol, target_pos))
-                else:
-                        print(f"Skipping retry trade - position difference {pct_diff:.1f}% <= 5%")
-                opening_trades = filtered_trades
-
-            if len(closing_trades) > 0:
-                print("executing closing trades")
-                drivers_and_orders = await execute_trades(closing_trades)
-                print("waiting for closing trades to complete")
-                all_completed = await wait_for_trades(drivers_and_orders, signal_id)
-                if not all_completed:
-                    incomplete_accounts = [account for (driver, _), account in zip(drivers_and_orders, accounts) if not await driver.is_trade_completed(_)]
-                    error_msg = f"ORDER FAILED: Timeout reached for accounts: {', '.join(incomplete_accounts)}"
-                    print(error_msg)
-                    handle_ex(error_msg, context="trade_closing_timeout")
-                else:
-                    print("All closing trades filled successfully")
-
-
-            if len(opening_trades) > 0:
-                print("executing opening trades")
-                drivers_and_orders = await execute_trades(opening_trades)
-                print("waiting for opening trades to complete")
-                all_completed = await wait_for_trades(drivers_and_orders, signal_id)
-                if not all_completed:
-                    incomplete_accounts = [account for (driver, _), account in zip(drivers_and_orders, accounts) if not await driver.is_trade_completed(_)]
-                    error_msg = f"ORDER FAILED: Timeout reached for accounts: {', '.join(incomplete_accounts)}"
-                    print(error_msg)
-                    handle_ex(error_msg, context="trade_opening_timeout")
-                else:
-                    print("All opening trades filled successfully")
+            # signals for different symbols run concurrently; the same account+symbol runs in order
+            coalesce_key = (bot, order_symbol.upper())
+            seq = signal_coalescer.arrive(coalesce_key)
+            try:
+                async with signal_gate.signal(), signal_locks.acquire(signal_keys(order_symbol)):
+                    # a newer target for this ticker arrived while we waited, so only that one matters
+                    if signal_coalescer.is_superseded(coalesce_key, seq):
+                        print(f"signal {signal_id} for {order_symbol} superseded by a newer signal, skipping")
+                        return
+                    await execute_signal(order_symbol, signal_position_pct, signal_id, is_retry)
+            finally:
+                signal_coalescer.done(coalesce_key)
 
         except Exception as e:
             handle_ex(e, context="trade_execution_error")
             raise
 
-runcount = 1
-async def run_periodically(interval, periodic_function):
-    global runcount
-    while runcount < 3600:
-        await asyncio.gather(asyncio.sleep(interval), periodic_function())
-        runcount = runcount + 1
-    sys.exit()
-asyncio.run(run_periodically(1, check_messages))
+def record_transport_latency(message, data_dict):
+    """Time from the webapp publishing a signal to us picking it up"""
+    transport = message.get('transport', 'pubsub')
+    published = message.get('published')
+    if published is None:
+        # pubsub messages only carry the webapp's own timestamp, and not always
+        try:
+            published = datetime.datetime.fromisoformat(data_dict['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return
+    latency_ms = (time.time() - published) * 1000
+    core_metrics.timing('broker.transport.latency', latency_ms, tags=[f'transport:{transport}'])
+    print(f"signal delivered over {transport} {latency_ms:.1f}ms after it was published")
+
+def signal_keys(order_symbol):
+    """(account, symbol) pairs a signal for order_symbol may trade: the symbol itself, its
+    futures target and the inverse ETF of whichever it trades, following the same
+    use-futures and use-inverse-etf settings as setup_trades_for_account"""
+    keys = set()
+    for account in accounts:
+        profile = get_account_profile(account)
+        symbols = {order_symbol}
+        trade_symbol = order_symbol
+        rule = profile.rules.get(order_symbol.lower())
+        if rule is not None and rule.target_symbol is not None and profile.use_futures:
+            trade_symbol = rule.target_symbol
+            symbols.add(trade_symbol)
+        if profile.use_inverse_etf:
+            inverse_symbol = profile.inverse_etfs.get(trade_symbol.lower())
+            if inverse_symbol is not None:
+                symbols.add(inverse_symbol)
+        keys.update((account, symbol.replace('1!', '').upper()) for symbol in symbols)
+    return keys
+
+def portfolio_fetches():
+    return sum(driver.portfolio_fetches for driver in drivers.values())
+
+async def execute_signal(order_symbol, signal_position_pct, signal_id, is_retry):
+    fetches_before = portfolio_fetches()
+    try:
+        await execute_signal_trades(order_symbol, signal_position_pct, signal_id, is_retry)
+    finally:
+        # approximate when signals overlap, since the drivers' counters are shared
+        fetches = portfolio_fetches() - fetches_before
+        core_metrics.gauge('broker.signal_portfolio_fetches', fetches, tags=[f'bot:{bot}'])
+        print(f"signal cost {fetches} portfolio fetches")
+
+async def execute_signal_trades(order_symbol, signal_position_pct, signal_id, is_retry):
+    closing_trades, opening_trades, snapshots = await plan_trades(order_symbol, signal_position_pct)
+
+    # For retry signals, filter out trades where position difference is <= 5%
+    if is_retry and len(opening_trades) > 0:
+        filtered_trades = []
+        for driver, symbol, target_pos in opening_trades:
+            current_pos = snapshots[driver].get_position_size(symbol)
+            if target_pos == 0:
+                pct_diff = 100 if current_pos != 0 else 0
+            else:
+                pct_diff = abs((current_pos - target_pos) / target_pos * 100)
+            if pct_diff > 5:
+                filtered_trades.append((driver, symbol, target_pos))
+            else:
+                print(f"Skipping retry trade - position difference {pct_diff:.1f}% <= 5%")
+        opening_trades = filtered_trades
+
+    if len(closing_trades) > 0:
+        print("executing closing trades")
+        drivers_and_orders = await execute_trades(closing_trades, snapshots)
+        print("waiting for closing trades to complete")
+        incomplete_trades = await wait_for_trades(drivers_and_orders, signal_id)
+        if incomplete_trades:
+            incomplete_accounts = [driver.account for driver, _ in incomplete_trades]
+            error_msg = f"ORDER FAILED: Timeout reached for accounts: {', '.join(incomplete_accounts)}"
+            print(error_msg)
+            handle_ex(error_msg, context="trade_closing_timeout")
+        else:
+            print("All closing trades filled successfully")
+
+        # the closing fills moved positions, so re-read them before sizing the opening orders
+        await asyncio.gather(*[snapshots[driver].refresh_positions_async()
+                               for driver in {driver for driver, _, _ in closing_trades}])
+
+
+    if len(opening_trades) > 0:
+        print("executing opening trades")
+        drivers_and_orders = await execute_trades(opening_trades, snapshots)
+        print("waiting for opening trades to complete")
+        incomplete_trades = await wait_for_trades(drivers_and_orders, signal_id)
+        if incomplete_trades:
+            incomplete_accounts = [driver.account for driver, _ in incomplete_trades]
+            error_msg = f"ORDER FAILED: Timeout reached for accounts: {', '.join(incomplete_accounts)}"
+            print(error_msg)
+            handle_ex(error_msg, context="trade_opening_timeout")
+        else:
+            print("All opening trades filled successfully")
+
+# per (account, symbol) ordering for signals, collapsing of queued signals per ticker,
+# and a gate that config reloads use to pause them
+signal_locks = KeyedLocks('broker.signal')
+signal_coalescer = SignalCoalescer('broker.signal')
+signal_gate = SignalGate()
+pending_tasks = set()
+
+async def dispatch_message(message, received):
+    dispatch_ms = (time.perf_counter() - received) * 1000
+    core_metrics.timing('broker.dispatch_latency', dispatch_ms, tags=[f'bot:{bot}'])
+    print(f"message dispatched in {dispatch_ms:.2f}ms")
+    try:
+        await check_messages(message)
+    except Exception as e:
+        # already reported by check_messages; keep listening for the next signal
+        print(f"signal processing failed: {e}")
+
+async def listen_for_messages():
+    # only this bot's channel, plus the channels every broker shares (human signals, health checks)
+    channels = core_transport.broker_channels(bot)
+    while True:
+        aredis = aioredis.Redis(host='localhost', port=6379, db=0)
+        pubsub = aredis.pubsub()
+        try:
+            await pubsub.subscribe(*channels)
+            print(f"Waiting for webhook messages on {', '.join(channels)}...")
+            # listen() blocks until redis pushes a message, so there is no polling delay
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                core_metrics.increment('broker.transport.messages', tags=['transport:pubsub'])
+                start_task(dispatch_message(message, time.perf_counter()))
+        except redis.exceptions.ConnectionError as e:
+            handle_ex(e, context="redis_subscribe")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+            await aredis.aclose()
+
+def start_task(coro):
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+# unacknowledged stream entries older than this are dropped on recovery rather than traded late
+STREAM_RECOVERY_MAX_AGE = 600
+
+async def handle_stream_entry(aredis, group, stream, entry_id, fields):
+    message = {
+        'type': 'message',
+        'data': fields.get(b'data'),
+        'transport': 'streams',
+        'published': core_transport.stream_entry_time(entry_id),
+    }
+    try:
+        await dispatch_message(message, time.perf_counter())
+    finally:
+        # acknowledge once handled (failures are already reported) so it isn't redelivered
+        await aredis.xack(stream, group, entry_id)
+
+async def recover_pending_entries(aredis, group, consumer, streams):
+    """Re-handle signals that were read by a previous run but never acknowledged"""
+    # our own unacknowledged entries, then any left behind by other consumers in the group
+    entries = []
+    seen = set()
+    response = await aredis.xreadgroup(group, consumer, {stream: '0' for stream in streams}, count=1000)
+    for stream, stream_entries in response or []:
+        for entry_id, fields in stream_entries:
+            entries.append((stream, entry_id, fields))
+            seen.add(entry_id)
+    for stream in streams:
+        claimed = await aredis.xautoclaim(stream, group, consumer, min_idle_time=60000, start_id='0-0', count=1000)
+        entries += [(stream, entry_id, fields) for entry_id, fields in claimed[1] if entry_id not in seen]
+
+    for stream, entry_id, fields in sorted(entries, key=lambda entry: core_transport.stream_entry_time(entry[1])):
+        age = time.time() - core_transport.stream_entry_time(entry_id)
+        if not fields or age > STREAM_RECOVERY_MAX_AGE:
+            print(f"dropping unacknowledged stream entry {entry_id} ({age:.0f}s old)")
+            await aredis.xack(stream, group, entry_id)
+            continue
+        print(f"recovering unacknowledged stream entry {entry_id} ({age:.0f}s old)")
+        core_metrics.increment('broker.transport.recovered', tags=['transport:streams'])
+        start_task(handle_stream_entry(aredis, group, stream, entry_id, fields))
+
+async def listen_for_stream_messages(batch_size=100):
+    # every bot has its own consumer group, so each bot sees every signal on the shared streams
+    group = f"broker-{bot}"
+    consumer = f"{bot}-{socket.gethostname()}"
+    streams = core_transport.broker_streams(bot)
+    aredis = aioredis.Redis(host='localhost', port=6379, db=0)
+    recovered = False
+    while True:
+        try:
+            for stream in streams:
+                try:
+                    await aredis.xgroup_create(stream, group, id='$', mkstream=True)
+                except redis.exceptions.ResponseError as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+            if not recovered:
+                await recover_pending_entries(aredis, group, consumer, streams)
+                recovered = True
+            print(f"Waiting for webhook messages on {', '.join(streams)}...")
+            while True:
+                # blocks until entries arrive; several queued entries come back as one batch
+                response = await aredis.xreadgroup(group, consumer, {stream: '>' for stream in streams}, count=batch_size, block=5000)
+                for stream, entries in response or []:
+                    for entry_id, fields in entries:
+                        core_metrics.increment('broker.transport.messages', tags=['transport:streams'])
+                        start_task(handle_stream_entry(aredis, group, stream, entry_id, fields))
+        except redis.exceptions.ConnectionError as e:
+            handle_ex(e, context="redis_subscribe")
+            await asyncio.sleep(1)
+
+async def report_stats(interval=300):
+    last_count = {}
+    while True:
+        await asyncio.sleep(interval)
+        for transport in ['pubsub', 'streams']:
+            stats = core_metrics.get_stats('broker.transport.messages', [f'transport:{transport}'])
+            if stats is None:
+                continue
+            count = stats['count'] - last_count.get(transport, 0)
+            last_count[transport] = stats['count']
+            print(f"{transport}: {count} messages in the last {interval}s ({count / interval:.2f}/s)")
+        for line in core_metrics.report('broker.'):
+            print("  " + line)
+        for line in broker_prices.summary():
+            print(line)
+
+async def main():
+    # the broker runs until it's stopped; config changes are picked up by watch_config
+    # instead of restarting the process, so connections and caches stay warm
+    connect_started = time.perf_counter()
+    await start_drivers()
+    startup_ms = (time.perf_counter() - started) * 1000
+    phases = {'broker.py imports': imports_ms, 'driver setup (including imports)': drivers_ms,
+              'connecting accounts': (time.perf_counter() - connect_started) * 1000}
+    if core_error.init_ms is not None:
+        phases['datadog/textmagic clients'] = core_error.init_ms
+    print(broker_drivers.startup_report(startup_ms, phases))
+    print(f"ready accounts: {', '.join(ready_accounts()) or 'none'}")
+    core_metrics.timing('broker.startup', startup_ms, tags=[f'bot:{bot}'])
+
+    background = [asyncio.create_task(watch_config()), asyncio.create_task(report_stats())]
+    try:
+        if core_transport.get_transport(profiles.config) == 'streams':
+            await listen_for_stream_messages()
+        else:
+            await listen_for_messages()
+    finally:
+        for task in background:
+            task.cancel()
 
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,135 +1,228 @@
 import asyncio
 import datetime
 import time
+import threading
 import configparser
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 from alpaca.trading.client import TradingClient
-from alpaca.trading.requests import LimitOrderRequest
-from alpaca.trading.enums import OrderSide, TimeInForce
+from alpaca.trading.stream import TradingStream
+from alpaca.trading.requests import LimitOrderRequest, GetOrdersRequest
+from alpaca.trading.enums import OrderSide, TimeInForce, QueryOrderStatus
 from alpaca.data.historical import StockHistoricalDataClient
 from alpaca.data.requests import StockLatestQuoteRequest, StockBarsRequest
 from alpaca.data.timeframe import TimeFrame
 from broker_root import broker_root
-import yfinance as yf
+from broker_fills import FillTracker
+import core_metrics
+import broker_instruments
+import broker_bars
 
-alpacaconn_cache = {}
+# one TradingClient/StockHistoricalDataClient pair per API key, kept for the life of the
+# process: each holds a requests Session, so its keep-alive connections get reused
+alpaca_clients = {}
 ticker_cache = {}
+fill_trackers = {}
+# positions per API key (i.e. per account), indexed by symbol; filled with one
+# get_all_positions call, kept current by fill events, and refetched after POSITION_TTL
+position_caches = {}
+POSITION_TTL = 30
+# the alpaca clients are blocking, so async callers run them here instead of on the event loop
+ALPACA_THREADS = 8
+alpaca_executor = ThreadPoolExecutor(max_workers=ALPACA_THREADS, thread_name_prefix="alpaca")
+
+def get_clients(key, secret, paper):
+    if key not in alpaca_clients:
+        print(f"Alpaca: Trying to connect...")
+        alpaca_clients[key] = {
+            'conn': TradingClient(api_key=key, secret_key=secret, paper=paper),
+            'dataconn': StockHistoricalDataClient(api_key=key, secret_key=secret),
+        }
+        print("Alpaca: Connected")
+    return alpaca_clients[key]['conn'], alpaca_clients[key]['dataconn']
+
+def get_position_cache(key):
+    if key not in position_caches:
+        position_caches[key] = {'positions': {}, 'time': 0}
+    return position_caches[key]
+
+def update_cached_position(key, symbol, qty):
+    cache = position_caches.get(key)
+    # nothing to update until the positions have been fetched once
+    if cache is None or cache['time'] == 0:
+        return
+    qty = int(float(qty))
+    if qty == 0:
+        cache['positions'].pop(symbol, None)
+    else:
+        cache['positions'][symbol] = qty
+
+def get_fill_tracker(key, secret, paper, url_override=None):
+    # one trade-updates stream per API key, shared by every driver using that key;
+    # url_override points it at another server (e.g. a local fake in tests)
+    if key not in fill_trackers:
+        tracker = FillTracker(['filled', 'canceled', 'expired', 'rejected'])
+        # raw messages: we only need the order id and status, not the full order model
+        stream = TradingStream(api_key=key, secret_key=secret, paper=paper, raw_data=True, url_override=url_override)
+
+        async def on_trade_update(msg):
+            data = msg['data']
+            order = data['order']
+            # fill events carry the resulting position, which keeps the position cache current;
+            # updated first, so whoever the fill wakes up sees the new position
+            if data.get('position_qty') is not None:
+                update_cached_position(key, order['symbol'], data['position_qty'])
+            tracker.update_threadsafe(order['id'], order['status'])
+
+        stream.subscribe_trade_updates(on_trade_update)
+        # the stream runs its own event loop, so give it a thread
+        threading.Thread(target=stream.run, name="alpaca-trade-updates", daemon=True).start()
+        fill_trackers[key] = {'tracker': tracker, 'stream': stream}
+    return fill_trackers[key]['tracker']
 
 class StockStub:
-    def __init__(self, symbol):
+    def __init__(self, symbol, instrument):
         self.symbol = symbol
-        self.is_futures = 0
+        self.is_futures = 1 if instrument.is_futures else 0
+        self.price_scale = instrument.price_scale
 
 # declare a class to represent the IB driver
 class broker_alpaca(broker_root):
+    price_source = 'alpaca'
+    price_fresh = 5
+
     def __init__(self, bot, account):
         self.config = configparser.ConfigParser()
         self.config.read('config.ini')
         self.bot = bot
         self.account = account
         self.aconfig = self.get_account_config(account)
-        self.conn = None
-        self.dataconn = None
-
-        # pick up a cached IB connection if it exists; cache lifetime is 5 mins
-        alcachekey = f"{self.aconfig['key']}"
-        if alcachekey in alpacaconn_cache and alpacaconn_cache[alcachekey]['time'] > time.time() - 300:
-            self.conn = alpacaconn_cache[alcachekey]['conn']
-            self.dataconn = alpacaconn_cache[alcachekey]['dataconn']
-
-        if self.conn is None:
-            try:
-                print(f"Alpaca: Trying to connect...")
-                paper = True if self.aconfig['paper'] == 'yes' else False
-                self.conn = TradingClient(api_key=self.aconfig['key'], secret_key=self.aconfig['secret'], paper=paper)
-                self.dataconn = StockHistoricalDataClient(api_key=self.aconfig['key'], secret_key=self.aconfig['secret'])
-
-            except Exception as e:
-                self.handle_ex(e)
-                raise
-
-            # cache the connection
-            alpacaconn_cache[alcachekey] = {'conn': self.conn, 'dataconn': self.dataconn, 'time': time.time()}
-            print("Alpaca: Connected")
+        paper = True if self.aconfig['paper'] == 'yes' else False
+        try:
+            self.conn, self.dataconn = get_clients(self.aconfig['key'], self.aconfig['secret'], paper)
+        except Exception as e:
+            self.handle_ex(e)
+            raise
 
-    def get_stock(self, symbol):
-        # normalization of the symbol, from TV to Alpaca form
-        stock = StockStub(symbol)
-        symbol = symbol.replace('1!', '')
-        if symbol in ['NQ', 'ES', 'RTY', 'MES', 'MNQ', 'M2K']:
-            stock.is_futures = 1
-        elif symbol in ['YM']:
-            stock.is_futures = 1
-        elif symbol in ['ZN']:
-            stock.is_futures = 1
-        elif symbol in ['VX']:
-            stock.is_futures = 1
-        # forex futures listed at https://www.interactivebrokers.com/en/trading/cme-wti-futures.php
-        elif symbol in ['M6E', 'M6A', 'M6B', 'MJY', 'MSF', 'MIR', 'MNH']:
-            stock.is_futures = 1
-        elif symbol in ['MCD']:
-            stock.is_futures = 1
-        elif symbol in ['HE']:
-            stock.is_futures = 1
-        elif symbol == 'DX':
-            stock.is_futures = 1
-        elif symbol in ['CL', 'NG']:
-            stock.is_futures = 1
-        elif symbol in ['GC', 'SI', 'HG', 'MGC', 'MSI', 'MHG']:
-            stock.is_futures = 1
-        else:
-            stock.is_futures = 0
+        self.positions = get_position_cache(self.aconfig['key'])
 
-        return stock
+        # fills are pushed to us over the trade-updates stream
+        self.fills = get_fill_tracker(self.aconfig['key'], self.aconfig['secret'], paper, self.aconfig.get('stream-url'))
 
-    def get_price(self, symbol):
-        stock = self.get_stock(symbol)
+    def request(self, endpoint, fn, *args, **kwargs):
+        """Make one Alpaca API call, recording its latency per endpoint"""
+        with core_metrics.timed('broker.alpaca.request', tags=[f'endpoint:{endpoint}']):
+            return fn(*args, **kwargs)
 
-        # keep a cache of tickers to avoid repeated calls to IB, but only for 5s
-        if symbol in ticker_cache and time.time() - ticker_cache[symbol]['time'] < 5:
-            ticker = ticker_cache[symbol]['ticker']
-        else:
-            multisymbol_request_params = StockLatestQuoteRequest(symbol_or_symbols=[symbol])
-            latest_multisymbol_quotes = self.dataconn.get_stock_latest_quote(multisymbol_request_params)
-            if symbol not in latest_multisymbol_quotes:
-                # can't find this symbol
-                print(f"Alpaca: get_price({symbol}) failed")
-                return 0
-            ticker = latest_multisymbol_quotes[symbol]
-            ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
-
-        price = ticker.ask_price
+    async def run_async(self, fn, *args, **kwargs):
+        """Run a blocking driver method on the alpaca executor, so the event loop keeps going"""
+        return await asyncio.get_running_loop().run_in_executor(alpaca_executor, functools.partial(fn, *args, **kwargs))
+
+    def get_stock(self, symbol):
+        # alpaca only trades stocks, but the registry tells us which symbols are futures
+        return StockStub(symbol, broker_instruments.get_instrument(symbol))
+
+    def get_price(self, symbol):
+        price = self.get_prices([symbol]).get(symbol)
+        if price is None:
+            # can't find this symbol
+            print(f"Alpaca: get_price({symbol}) failed")
+            return 0
         print(f"  get_price({symbol}) -> {price}")
         return price
 
+    def get_prices(self, symbols):
+        prices = {}
+        missing = []
+        # keep a cache of tickers to avoid repeated calls to Alpaca, but only for 5s
+        for symbol in symbols:
+            if symbol in ticker_cache and time.time() - ticker_cache[symbol]['time'] < 5:
+                prices[symbol] = ticker_cache[symbol]['ticker'].ask_price
+            else:
+                missing.append(symbol)
+
+        if missing:
+            # then the price cache shared with the other broker processes
+            shared, stale, missing = self.price_cache().lookup(missing)
+            prices.update(shared)
+            if stale:
+                alpaca_executor.submit(self.refresh_prices, stale)
+
+        if missing:
+            prices.update(self.fetch_prices(missing))
+
+        print(f"  get_prices({list(symbols)}) -> {prices}")
+        return prices
+
+    def fetch_prices(self, symbols):
+        # the latest quote endpoint takes a list, so this is one request for all of them
+        quotes = self.request('latest_quote', self.dataconn.get_stock_latest_quote, StockLatestQuoteRequest(symbol_or_symbols=symbols))
+        prices = {}
+        for symbol in symbols:
+            if symbol in quotes:
+                ticker_cache[symbol] = {'ticker': quotes[symbol], 'time': time.time()}
+                prices[symbol] = quotes[symbol].ask_price
+        self.price_cache().put(prices)
+        return prices
+
+    def refresh_prices(self, symbols):
+        """Fetch stale shared prices again, in the background, for every process using them"""
+        try:
+            self.fetch_prices(symbols)
+        except Exception as e:
+            print(f"  refreshing prices for {symbols} failed: {e}")
+
+    async def get_prices_async(self, symbols):
+        return await self.run_async(self.get_prices, symbols)
+
     def get_net_liquidity(self):
         # get the current Alpaca net liquidity in USD
-        net_liquidity = self.conn.get_account().last_equity
+        net_liquidity = self.request('account', self.conn.get_account).last_equity
         print(f"  get_net_liquidity() -> {net_liquidity}")
         return float(net_liquidity)
 
+    def load_positions(self):
+        cache = self.positions
+        if time.time() - cache['time'] > POSITION_TTL:
+            # the whole portfolio in one call
+            cache['positions'] = {position.symbol: int(position.qty) for position in self.request('positions', self.conn.get_all_positions)}
+            cache['time'] = time.time()
+            self.portfolio_fetches += 1
+            core_metrics.increment('broker.alpaca.portfolio_fetches', tags=[f'account:{self.account}'])
+        return cache['positions']
+
     def get_position_size(self, symbol):
         # get the current Alpaca position size for this stock and this account
-        position_size = 0
-        for position in self.conn.get_all_positions():
-            if position.symbol == symbol:
-                position_size = int(position.qty)
-                break
+        position_size = self.load_positions().get(symbol, 0)
         print(f"  get_position_size({symbol}) -> {position_size}")
         return position_size
 
+    def get_positions(self):
+        # every position, keyed by symbol
+        positions = dict(self.load_positions())
+        print(f"  get_positions() -> {positions}")
+        return positions
+
+    async def get_positions_async(self):
+        return await self.run_async(self.get_positions)
+
+    def get_open_orders(self):
+        return self.request('orders', self.conn.get_orders, GetOrdersRequest(status=QueryOrderStatus.OPEN))
 
-    async def set_position_size(self, symbol, amount):
+    async def set_position_size(self, symbol, amount, position_size=None):
         print(f"set_position_size({symbol},{amount}) acct {self.account}")
 
-        # get the current position size
-        position_size = self.get_position_size(symbol)
+        # get the current position size, unless the caller already knows it
+        if position_size is None:
+            position_size = await self.run_async(self.get_position_size, symbol)
 
         # figure out how much to buy or sell
         position_variation = round(amount - position_size, 0)
 
         # if we need to buy or sell, do it with a limit order
         if position_variation != 0:
-            price = self.get_price(symbol)
+            price = await self.run_async(self.get_price, symbol)
             high_limit_price = round(price * 1.005, 2)
             low_limit_price  = round(price * 0.995, 2)
 
@@ -156,15 +249,34 @@ class broker_alpaca(broker_root):
                    )
 
             print("  placing order: ", limit_order_data)
-            trade = self.conn.submit_order(order_data=limit_order_data)
+            trade = await self.run_async(self.request, 'submit_order', self.conn.submit_order, order_data=limit_order_data)
             print("    trade: ", trade)
             return trade.id  # Return the order ID
 
     async def is_trade_completed(self, order_id):
-        trade = self.conn.get_order_by_id(order_id)
-        return trade.status in ['filled', 'canceled', 'expired']
+        # order states come from the trade-updates stream
+        if self.fills.get_status(order_id) is not None:
+            return self.fills.is_done(order_id)
+        # the stream hasn't mentioned this order (yet), so ask once rather than assume
+        return await self.check_trade_completed(order_id)
 
-    def download_data(self, symbol, end, duration, timeframe, cachedata=False):
+    async def check_trade_completed(self, order_id):
+        # the stream doesn't replay updates missed while it was disconnected, so anything it
+        # hasn't reported as done is asked of Alpaca
+        if self.fills.is_done(order_id):
+            return True
+        core_metrics.increment('broker.alpaca.order_status_fallback', tags=[f'account:{self.account}'])
+        trade = await self.run_async(self.request, 'order', self.conn.get_order_by_id, order_id)
+        self.fills.update(order_id, getattr(trade.status, 'value', trade.status))
+        return self.fills.is_done(order_id)
+
+    def get_trade_event(self, order_id):
+        return self.fills.watch(order_id)
+
+    def forget_trade(self, order_id):
+        self.fills.forget(order_id)
+
+    def download_data(self, symbol, end, duration, timeframe, cachedata=False, copy=True):
         if end != "":
             raise Exception("Can only use blank end date")
         if timeframe != "1 day":
@@ -175,12 +287,41 @@ class broker_alpaca(broker_root):
         duration_years = int(duration.split(' ')[0])
         start = datetime.datetime.now() - datetime.timedelta(days=duration_years*365)
 
+        # bars are kept in the shared bar store; after the first request only the bars since
+        # the last one stored are fetched (that one again, as today's bar may have been partial)
+        store = broker_bars.bar_store
+        if store.covers('alpaca', symbol, timeframe, start):
+            last = store.last_time('alpaca', symbol, timeframe)
+            if not (cachedata and store.age('alpaca', symbol, timeframe) < 3600):
+                df = self.fetch_bars(symbol, last)
+                if len(df):
+                    store.write('alpaca', symbol, timeframe, df)
+        else:
+            df = self.fetch_bars(symbol, start)
+            if not len(df):
+                return df
+            store.write('alpaca', symbol, timeframe, df, covered_from=start, replace=True)
+        df = store.read('alpaca', symbol, timeframe, start)
+        if copy:
+            # the store's frames are read-only views of its mapped file
+            df = df.copy()
+        # same shape as the SDK's bars.df
+        return pd.concat({symbol: df}, names=['symbol', df.index.name])
+
+    async def download_data_async(self, symbol, end, duration, timeframe, cachedata=False, copy=True):
+        return await self.run_async(self.download_data, symbol, end, duration, timeframe, cachedata, copy)
+
+    def fetch_bars(self, symbol, start):
         request_params = StockBarsRequest(symbol_or_symbols=symbol, 
             start=start.strftime("%Y-%m-%d"), 
             timeframe = TimeFrame.Day)
 
-        bars = self.dataconn.get_stock_bars(request_params)
-        return bars.df
+        bars = self.request('bars', self.dataconn.get_stock_bars, request_params)
+        df = bars.df
+        if len(df):
+            df = df.xs(symbol, level='symbol')
+        core_metrics.increment('broker.bars.fetched', len(df), tags=['source:alpaca'])
+        return df
 
     def health_check_prices(self):
         self.get_price('SOXL')
@@ -189,3 +330,9 @@ class broker_alpaca(broker_root):
         self.get_net_liquidity()
         self.get_position_size('SOXL')
         self.get_position_size('SOXS')
+
+    async def health_check_prices_async(self):
+        await self.run_async(self.health_check_prices)
+
+    async def health_check_positions_async(self):
+        await self.run_async(self.health_check_positions)
@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+DURATION_UNITS = {'S': 1, 'D': 86400, 'W': 7 * 86400, 'M': 31 * 86400, 'Y': 366 * 86400}
+
+def duration_to_timedelta(duration):
+    """IB-style duration ('5 Y', '30 D', '3600 S') -> timedelta, erring on the long side"""
+    count, unit = duration.split(' ')
+    return datetime.timedelta(seconds=int(count) * DURATION_UNITS[unit.upper()])
+
+def timedelta_to_duration(delta):
+    """The shortest IB duration string covering delta"""
+    seconds = max(int(delta.total_seconds()), 60)
+    if seconds < 86400:
+        return f"{seconds} S"
+    days = -(-seconds // 86400) + 1
+    if days <= 365:
+        return f"{days} D"
+    return f"{-(-days // 365)} Y"
+
+def parse_end(end):
+    """IB-style end ('' for now, 'YYYYMMDD HH:MM:SS', optionally followed by a time zone)"""
+    if not end:
+        return pd.Timestamp.now()
+    parts = end.split(' ')
+    when = pd.Timestamp(' '.join(parts[:2]))
+    return when.tz_localize(parts[2]) if len(parts) > 2 else when
+
+def to_ns(when):
+    # stored times are UTC nanoseconds; naive timestamps are taken as they are
+    when = pd.Timestamp(when)
+    if when.tz is not None:
+        when = when.tz_convert('UTC').tz_localize(None)
+    return when.value
+
+class BarStore:
+    """
+    Historical bars on disk, one memory-mapped NumPy file per source, symbol and bar size,
+    plus a small JSON file saying what it covers. Windows are served by slicing the
+    mapped array, so reads don't copy the file; updates only add the bars fetched since
+    the last one stored (which is fetched again, since it may have been partial).
+    """
+    def __init__(self, root='cache/bars'):
+        self.root = root
+        self.arrays = {}
+
+    def path(self, source, symbol, barlength):
+        name = re.sub(r'[^A-Za-z0-9_.!-]', '_', f"{source}-{symbol}-{barlength}")
+        return os.path.join(self.root, name)
+
+    def meta(self, source, symbol, barlength):
+        try:
+            with open(self.path(source, symbol, barlength) + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def array(self, source, symbol, barlength):
+        path = self.path(source, symbol, barlength) + '.npy'
+        array = self.arrays.get(path)
+        if array is None:
+            try:
+                array = self.arrays[path] = np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                return None
+        return array
+
+    def last_time(self, source, symbol, barlength):
+        meta = self.meta(source, symbol, barlength)
+        array = self.array(source, symbol, barlength)
+        if meta is None or array is None or len(array) == 0:
+            return None
+        last = pd.Timestamp(int(array['time'][-1]))
+        return last.tz_localize('UTC').tz_convert(meta['tz']) if meta.get('tz') else last
+
+    def covers(self, source, symbol, barlength, start, end=None):
+        """Whether the store has every bar from start (to end, or the last update)"""
+        meta = self.meta(source, symbol, barlength)
+        last = self.last_time(source, symbol, barlength)
+        if meta is None or last is None or to_ns(start) < meta['covered_from']:
+            return False
+        return end is None or to_ns(end) <= to_ns(last)
+
+    def age(self, source, symbol, barlength):
+        meta = self.meta(source, symbol, barlength)
+        return time.time() - meta['updated'] if meta else None
+
+    def read(self, source, symbol, barlength, start=None, end=None):
+        """Bars with start <= time <= end as a DataFrame backed by the mapped file, so it's
+        read-only: callers that change it take a copy first"""
+        meta = self.meta(source, symbol, barlength)
+        array = self.array(source, symbol, barlength)
+        if meta is None or array is None:
+            return None
+        times = array['time']
+        lo = 0 if start is None else np.searchsorted(times, to_ns(start), side='left')
+        hi = len(array) if end is None else np.searchsorted(times, to_ns(end), side='right')
+        window = array[lo:hi]
+        index = pd.DatetimeIndex(window['time'].astype('datetime64[ns]'), name=meta['index'])
+        if meta.get('tz'):
+            index = index.tz_localize('UTC').tz_convert(meta['tz'])
+        return pd.DataFrame({column: window[column] for column in meta['columns']}, index=index, copy=False)
+
+    def write(self, source, symbol, barlength, df, covered_from=None, replace=False):
+        """
+        Store df (indexed by time, numeric columns). Unless replace is set, stored bars
+        from df's first timestamp on are replaced and earlier ones kept.
+        """
+        index = pd.DatetimeIndex(df.index)
+        tz = str(index.tz) if index.tz is not None else None
+        if tz:
+            index = index.tz_convert('UTC').tz_localize(None)
+        times = index.as_unit('ns').asi8
+        columns = [str(column) for column in df.columns]
+        dtype = [('time', 'i8')] + [(column, 'f8') for column in columns]
+        new = np.empty(len(df), dtype=dtype)
+        new['time'] = times
+        for column in columns:
+            new[column] = df[column].to_numpy(dtype='f8', na_value=np.nan)
+        new = new[np.argsort(new['time'], kind='stable')]
+
+        meta = None if replace else self.meta(source, symbol, barlength)
+        old = None if meta is None else self.array(source, symbol, barlength)
+        if old is not None and len(new) and list(old.dtype.names) == ['time'] + columns:
+            new = np.concatenate([old[old['time'] < new['time'][0]], new])
+        else:
+            # nothing stored, or stored with other columns: start over
+            meta = None
+
+        path = self.path(source, symbol, barlength)
+        os.makedirs(self.root, exist_ok=True)
+        # write to a temp file and rename, so readers never see a half-written file
+        with open(path + '.tmp.npy', 'wb') as f:
+            np.save(f, new)
+        os.replace(path + '.tmp.npy', path + '.npy')
+        self.arrays.pop(path + '.npy', None)
+        if covered_from is None:
+            covered_from = int(new['time'][0]) if len(new) else 0
+        else:
+            covered_from = to_ns(covered_from)
+        if meta is not None:
+            covered_from = min(covered_from, meta['covered_from'])
+        meta = {'columns': columns, 'index': df.index.name, 'tz': tz, 'covered_from': covered_from, 'updated': time.time()}
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.json.tmp', path + '.json')
+
+bar_store = BarStore()
@@ -0,0 +1,132 @@
+import os
+import configparser
+
+# the settings a driver connects with; a change to any other setting doesn't need a new driver
+CONNECTION_SETTINGS = ['driver', 'host', 'port', 'key', 'secret', 'paper', 'stream-url']
+
+class SymbolRule:
+    """Sizing for one symbol, compiled from a `{symbol}-pct` setting like "70" or "1.5, NQ" """
+    def __init__(self, pct, target_symbol=None):
+        self.pct = pct
+        # futures (or other) symbol to trade instead, for use-futures accounts
+        self.target_symbol = target_symbol
+
+    def __repr__(self):
+        return f"SymbolRule({self.pct}, {self.target_symbol})"
+
+class AccountProfile:
+    """
+    An account's settings (merged with its group) parsed once into typed values,
+    so signal handling doesn't re-parse config strings for every account on every signal.
+    """
+    def __init__(self, name, settings, inverse_etfs=None):
+        self.name = name
+        self.settings = dict(settings)
+        self.inverse_etfs = inverse_etfs if inverse_etfs is not None else {}
+        self.driver = self.settings.get('driver')
+        self.use_futures = self.settings.get('use-futures', 'no') == 'yes'
+        self.use_inverse_etf = self.settings.get('use-inverse-etf', 'no') == 'yes'
+        multiplier = self.settings.get('multiplier', '')
+        self.multiplier = float(multiplier) if multiplier != '' else None
+        self.default_pct = float(self.settings.get('default-pct', '100'))
+
+        # per-symbol rules keyed by lowercase symbol; a bad value only breaks signals for that symbol
+        self.rules = {}
+        self.rule_errors = {}
+        for key, value in self.settings.items():
+            if not key.endswith('-pct') or key == 'default-pct':
+                continue
+            symbol = key[:-len('-pct')]
+            try:
+                parts = [x.strip() for x in value.split(',')]
+                target_symbol = parts[1] if len(parts) > 1 and parts[1] != '' else None
+                self.rules[symbol] = SymbolRule(float(parts[0]), target_symbol)
+            except ValueError as e:
+                self.rule_errors[symbol] = f"invalid {key} setting '{value}' for account {name}: {e}"
+
+    def get_rule(self, symbol):
+        symbol = symbol.lower()
+        if symbol in self.rule_errors:
+            raise Exception(self.rule_errors[symbol])
+        return self.rules.get(symbol)
+
+    @property
+    def connection(self):
+        return {key: self.settings.get(key) for key in CONNECTION_SETTINGS}
+
+    def get(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __contains__(self, key):
+        return key in self.settings
+
+class ConfigProfiles:
+    """
+    Compiled AccountProfiles for config.ini. Profiles are built on first use and kept
+    until refresh() sees a new file mtime, so lookups are plain dict hits.
+    """
+    def __init__(self, path='config.ini'):
+        self.path = path
+        self.mtime = None
+        self.config = None
+        self.inverse_etfs = {}
+        self.profiles = {}
+        self.errors = {}
+        self.refresh()
+
+    def file_mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def changed(self):
+        return self.file_mtime() != self.mtime
+
+    def refresh(self):
+        """Re-read the file if its mtime changed; returns True if it was reloaded"""
+        mtime = self.file_mtime()
+        if self.config is not None and mtime == self.mtime:
+            return False
+        config = configparser.ConfigParser()
+        config.read(self.path)
+        self.load(config)
+        self.mtime = mtime
+        return True
+
+    def load(self, config):
+        self.config = config
+        self.profiles = {}
+        self.errors = {}
+        self.inverse_etfs = {}
+        if config.has_section('inverse-etfs'):
+            defaults = config.defaults()
+            for key, value in config['inverse-etfs'].items():
+                if key not in defaults:
+                    self.inverse_etfs[key] = value
+
+    def compile(self, account):
+        account_config = self.config[account]
+        settings = dict(account_config)
+        if 'group' in account_config:
+            # Merge group config into account config, account config takes precedence
+            settings = {**dict(self.config[account_config['group']]), **settings}
+        return AccountProfile(account, settings, self.inverse_etfs)
+
+    def get(self, account):
+        profile = self.profiles.get(account)
+        if profile is None:
+            if account in self.errors:
+                raise Exception(self.errors[account])
+            try:
+                profile = self.profiles[account] = self.compile(account)
+            except (KeyError, ValueError) as e:
+                self.errors[account] = f"invalid config for account {account}: {e}"
+                raise Exception(self.errors[account])
+        return profile
+
+    def get_accounts(self, bot):
+        return self.config[f"bot-{bot}"]['accounts'].split(",")
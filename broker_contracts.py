@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import bisect
+import datetime
+
+# contract details are re-fetched after this long, to pick up newly listed futures months
+MAX_AGE = 7 * 24 * 3600
+
+def parse_expiry(value):
+    # IB gives YYYYMMDD (sometimes followed by a time) or YYYYMM for some contracts
+    value = value.split(' ')[0]
+    if len(value) == 6:
+        value += '01'
+    return datetime.datetime.strptime(value, '%Y%m%d').date()
+
+class ContractCache:
+    """
+    reqContractDetails results kept on disk, so a restart doesn't have to look every
+    contract up again. For futures each entry also has a roll calendar: the date from
+    which each listed month is the front month (roll_days before the previous one expires).
+    """
+    def __init__(self, path='cache/contract-details.json'):
+        self.path = path
+        self.entries = {}
+        self.calendars = {}
+        self.load()
+
+    def key(self, instrument):
+        return f"{instrument.sec_type}:{instrument.contract_symbol}:{instrument.exchange}:{instrument.currency}"
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.calendars = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def put(self, instrument, contracts):
+        """contracts: dicts of Contract fields, as returned by contract_fields()"""
+        key = self.key(instrument)
+        self.entries[key] = {'fetched': time.time(), 'contracts': contracts}
+        self.calendars.pop(key, None)
+
+    def get(self, instrument):
+        return self.entries.get(self.key(instrument))
+
+    def calendar(self, instrument):
+        """[(first day as front month, contract)] sorted by date"""
+        key = self.key(instrument)
+        calendar = self.calendars.get(key)
+        if calendar is None:
+            entry = self.entries.get(key)
+            contracts = sorted(entry['contracts'] if entry else [], key=lambda c: parse_expiry(c['lastTradeDateOrContractMonth']))
+            calendar = []
+            starts = datetime.date.min
+            for contract in contracts:
+                calendar.append((starts, contract))
+                # the next month takes over roll_days before this one expires
+                starts = parse_expiry(contract['lastTradeDateOrContractMonth']) - datetime.timedelta(days=instrument.roll_days)
+            calendar = self.calendars[key] = calendar
+        return calendar
+
+    def front_month(self, instrument, today=None):
+        """The contract to trade today and the date it rolls, or (None, None) if none is usable"""
+        today = today or datetime.date.today()
+        calendar = self.calendar(instrument)
+        index = bisect.bisect_right([starts for starts, _ in calendar], today) - 1
+        if index < 0:
+            return None, None
+        contract = calendar[index][1]
+        # never hand out an expired contract, even if it's all we have
+        if parse_expiry(contract['lastTradeDateOrContractMonth']) < today:
+            return None, None
+        rolls = calendar[index + 1][0] if index + 1 < len(calendar) else None
+        return contract, rolls
+
+    def is_fresh(self, instrument, today=None):
+        entry = self.get(instrument)
+        if entry is None or time.time() - entry['fetched'] > MAX_AGE:
+            return False
+        if instrument.is_futures:
+            contract, rolls = self.front_month(instrument, today)
+            # also refresh once we're trading the last month we know about
+            return contract is not None and rolls is not None
+        return True
+
+def contract_fields(contract):
+    fields = ['conId', 'symbol', 'secType', 'lastTradeDateOrContractMonth', 'exchange', 'currency',
+              'multiplier', 'localSymbol', 'tradingClass']
+    return {field: getattr(contract, field) for field in fields}
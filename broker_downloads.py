@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import asyncio
+import contextlib
+import collections
+import core_metrics
+
+class SlidingWindow:
+    """At most limit acquisitions in any window seconds: the time of each recent one is kept,
+    so a burst can't borrow against the next window the way a token bucket's refill does"""
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.recent = collections.deque()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= self.window:
+                self.recent.popleft()
+            if len(self.recent) < self.limit:
+                self.recent.append(now)
+                return
+            await asyncio.sleep(self.window - (now - self.recent[0]))
+
+class HistoryPacing:
+    """
+    IB's historical data pacing limits, per gateway: at most 60 requests in any 10 minutes,
+    5 for the same contract in 2 seconds, and 50 open at once. Going over them gets
+    requests rejected (and the connection eventually dropped), so requests wait here instead.
+    """
+    def __init__(self, per_window=60, window=600, per_contract=5, contract_window=2, open_requests=50):
+        self.requests = SlidingWindow(per_window, window)
+        self.contracts = collections.defaultdict(lambda: SlidingWindow(per_contract, contract_window))
+        self.open = asyncio.Semaphore(open_requests)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, contract):
+        async with self.open:
+            await self.contracts[contract].acquire()
+            await self.requests.acquire()
+            yield
+
+class BulkDownloader:
+    """
+    Downloads bars for a list of symbols concurrently through a driver's download_data_async
+    (which does the pacing and fills the bar store). Finished symbols are checkpointed, so a
+    run that's interrupted picks up where it stopped when started again with the same request.
+    """
+    def __init__(self, driver, checkpoint='cache/bulk-download.json', concurrency=8):
+        self.driver = driver
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+
+    def load_checkpoint(self, request):
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        return set(state['done']) if state.get('request') == request else set()
+
+    def save_checkpoint(self, request, done):
+        os.makedirs(os.path.dirname(self.checkpoint) or '.', exist_ok=True)
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump({'request': request, 'done': sorted(done)}, f)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def download(self, symbols, end, duration, barlength):
+        return asyncio.run(self.download_async(symbols, end, duration, barlength))
+
+    async def download_async(self, symbols, end, duration, barlength):
+        """Returns {symbol: bars} for the symbols downloaded by this run, and the ones that failed"""
+        request = [end, duration, barlength]
+        done = self.load_checkpoint(request)
+        # the same symbol listed twice is downloaded once
+        todo = [symbol for symbol in dict.fromkeys(symbols) if symbol not in done]
+        if done:
+            print(f"bulk download: resuming, {len(done)} symbols already done, {len(todo)} to go")
+        limit = asyncio.Semaphore(self.concurrency)
+        results, failed = {}, []
+        start = time.perf_counter()
+
+        async def download_one(symbol):
+            async with limit:
+                try:
+                    results[symbol] = await self.driver.download_data_async(symbol, end, duration, barlength, copy=False)
+                except Exception as e:
+                    print(f"bulk download: {symbol} failed: {e}")
+                    failed.append(symbol)
+                    return
+            done.add(symbol)
+            self.save_checkpoint(request, done)
+
+        await asyncio.gather(*[download_one(symbol) for symbol in todo])
+        elapsed = time.perf_counter() - start
+        bars = sum(len(df) for df in results.values())
+        rate = bars / elapsed if elapsed > 0 else 0
+        core_metrics.gauge('broker.bars.download_rate', rate)
+        print(f"bulk download: {len(results)} symbols, {bars} bars in {elapsed:.1f}s ({rate:.0f} bars/s), {len(failed)} failed")
+        if not failed:
+            # finished: the next run starts afresh
+            with contextlib.suppress(OSError):
+                os.remove(self.checkpoint)
+        return results, failed
@@ -0,0 +1,44 @@
+import sys
+import time
+import importlib
+import core_metrics
+
+# driver name (the driver setting in config.ini) -> (module, class). A driver's module, and
+# the broker library behind it, is only imported when an account that uses it is set up
+drivers = {
+    'ibkr': ('broker_ibkr', 'broker_ibkr'),
+    'alpaca': ('broker_alpaca', 'broker_alpaca'),
+}
+# ms each lazily imported module took, for the startup report
+import_times = {}
+
+def register(name, module, cls=None):
+    drivers[name] = (module, cls or module)
+
+def timed_import(module):
+    if module in sys.modules:
+        return sys.modules[module]
+    start = time.perf_counter()
+    loaded = importlib.import_module(module)
+    import_times[module] = (time.perf_counter() - start) * 1000
+    core_metrics.timing('broker.startup.import', import_times[module], tags=[f'module:{module}'])
+    return loaded
+
+def get_driver_class(name):
+    if name not in drivers:
+        raise Exception(f"Unknown driver: {name}")
+    module, cls = drivers[name]
+    return getattr(timed_import(module), cls)
+
+def create(name, bot, account):
+    return get_driver_class(name)(bot, account)
+
+def startup_report(total_ms, phases):
+    """
+    Where startup time went: phases is {name: ms} measured by the caller, followed by the
+    driver imports. For a per-module breakdown, run with python -X importtime.
+    """
+    lines = [f"startup took {total_ms:.0f}ms"]
+    for name, ms in list(phases.items()) + [(f"import {module}", ms) for module, ms in import_times.items()]:
+        lines.append(f"  {name}: {ms:.0f}ms")
+    return '\n'.join(lines)
@@ -0,0 +1,78 @@
+import time
+import asyncio
+import threading
+
+# states of orders nobody is waiting on are dropped after this long; orders are watched
+# right after they're placed, so this only has to cover a fill that beats the watch
+STATE_TTL = 300
+
+class FillTracker:
+    """
+    Order states pushed by a broker's event stream, with an asyncio.Event per order that
+    is set as soon as the order reaches a final state. Drivers feed it from their streams;
+    tests can feed it directly with update(). Waiters forget() an order once they're done
+    with it, and states for orders nobody watches are pruned after STATE_TTL.
+    """
+    def __init__(self, done_states):
+        self.done_states = set(done_states)
+        self.states = {}
+        self.events = {}
+        # when each order's state last changed, oldest first
+        self.updated = {}
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def update(self, order_id, status):
+        order_id = str(order_id)
+        with self.lock:
+            self.states[order_id] = status
+            self.updated.pop(order_id, None)
+            self.updated[order_id] = time.monotonic()
+            event = self.events.get(order_id)
+            self.prune()
+        if event is not None and status in self.done_states:
+            event.set()
+
+    def update_threadsafe(self, order_id, status):
+        """update() for stream callbacks running on another thread's event loop"""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.update, order_id, status)
+        else:
+            # nobody is waiting yet, so there's no event to wake
+            self.update(order_id, status)
+
+    def get_status(self, order_id):
+        return self.states.get(str(order_id))
+
+    def is_done(self, order_id):
+        return self.get_status(order_id) in self.done_states
+
+    def watch(self, order_id):
+        """Return an asyncio.Event that is set once the order is done; call from the event loop"""
+        order_id = str(order_id)
+        self.loop = asyncio.get_running_loop()
+        with self.lock:
+            event = self.events.get(order_id)
+            if event is None:
+                event = self.events[order_id] = asyncio.Event()
+        if self.is_done(order_id):
+            event.set()
+        return event
+
+    def forget(self, order_id):
+        order_id = str(order_id)
+        with self.lock:
+            self.events.pop(order_id, None)
+            self.states.pop(order_id, None)
+            self.updated.pop(order_id, None)
+
+    def prune(self):
+        # called with the lock held
+        cutoff = time.monotonic() - STATE_TTL
+        for order_id, updated in list(self.updated.items()):
+            if updated > cutoff:
+                break
+            if order_id not in self.events:
+                del self.updated[order_id]
+                self.states.pop(order_id, None)
@@ -3,21 +3,47 @@ import datetime
 import os
 from ib_insync import *
 import time
-import nest_asyncio
 import configparser
 import math
+import socket
 
 import pandas as pd
 from broker_root import broker_root
+import broker_ibkr_conn
+import broker_instruments
+import broker_contracts
+import broker_bars
+import broker_downloads
+import core_metrics
 
-nest_asyncio.apply()
-
-ibconn_cache = {}
 stock_cache = {}
+contract_cache = broker_contracts.ContractCache()
+# instruments whose contract details are being fetched in the background
+contract_refreshes = set()
 ticker_cache = {}
+# standing reqMktData subscriptions, keyed by gateway and contract symbol; IB keeps each
+# Ticker up to date in place, so reading a price is a dict lookup
+market_data = {}
+# per gateway: net liquidity and a symbol -> position index for each account, see account_cache()
+account_state = {}
+# historical data requests: pacing per gateway, and downloads in flight (see download_data_async)
+history_pacing = {}
+history_downloads = {}
+
+def position_key(contract):
+    # each futures month is a position of its own, so those are keyed by symbol and month
+    # ('NQ 202509'); that works whether or not the contract has been qualified yet
+    if contract.secType == 'FUT':
+        return f"{contract.symbol} {contract.lastTradeDateOrContractMonth[:6]}"
+    return contract.symbol
 
 # declare a class to represent the IB driver
 class broker_ibkr(broker_root):
+    # ib_insync's IB object belongs to the event loop thread, so plan these accounts there
+    planning_threads = 0
+    price_source = 'ibkr'
+    price_fresh = 15
+
     def __init__(self, bot, account):
         self.config = configparser.ConfigParser()
         self.config.read('config.ini')
@@ -25,67 +51,34 @@ class broker_ibkr(broker_root):
         self.account = account
         self.aconfig = self.get_account_config(account)
         self.conn = None
-        
-        # Initialize connection at startup
-        try:
-            print(f"IB: Initializing connection for account {account}...")
-            self.load_conn()
-            if self.check_connection():
-                print(f"IB: Successfully initialized connection for account {account}")
-            else:
-                print(f"IB: Failed to establish initial connection for account {account}")
-        except Exception as e:
-            print(f"IB: Error during initial connection for account {account}: {str(e)}")
+        self.session = None
+        # the connection is made by start_async (or by the first call that needs it)
+
+    async def start_async(self):
+        print(f"IB: Initializing connection for account {self.account}...")
+        await self.load_conn_async()
+        symbols = self.config_symbols()
+        # look up every contract we may trade now, so signals never wait on it
+        await self.qualify_contracts_async(symbols)
+        self.subscribe_market_data(symbols)
+        self.ready = True
+        print(f"IB: Successfully initialized connection for account {self.account}")
+        return True
+
+    def get_session(self):
+        # one IB session per gateway, shared with every other account on it; the session
+        # leases its clientId and reconnects in the background (see broker_ibkr_conn)
+        if self.session is None:
+            owner = f"{self.bot}@{socket.gethostname()}:{os.getpid()}"
+            self.session = broker_ibkr_conn.get_session(self.aconfig['host'], self.aconfig['port'], owner)
+        return self.session
 
     def load_conn(self):
-        # pick up a cached IB connection if it exists
-        ibcachekey = f"{self.aconfig['host']}:{self.aconfig['port']}"
-        if ibcachekey in ibconn_cache:
-            self.conn = ibconn_cache[ibcachekey]['conn']
-            # Test if connection is still alive
-            try:
-                self.conn.isConnected()
-            except:
-                self.conn = None
-                del ibconn_cache[ibcachekey]
-
-        if self.conn is None:
-            max_retries = 3
-            retry_delay = 2  # seconds
-            
-            for attempt in range(max_retries):
-                try:
-                    # Create new IB instance for each attempt
-                    self.conn = IB()
-                    client_id = 1 + attempt
-                    print(f"IB: Attempting to connect (attempt {attempt + 1}/{max_retries}, client ID: {client_id})...")
-                    self.conn.connect(
-                        self.aconfig['host'], 
-                        int(self.aconfig['port']), 
-                        clientId=client_id,
-                        timeout=20
-                    )
-                    print("IB: Connected successfully")
-                    # Cache the successful connection
-                    ibconn_cache[ibcachekey] = {'conn': self.conn, 'time': time.time()}
-                    return
-                except Exception as e:
-                    print(f"Connection attempt {attempt + 1} failed: {str(e)}")
-                    # Disconnect and cleanup failed connection
-                    try:
-                        if self.conn:
-                            self.conn.disconnect()
-                            self.conn = None
-                    except:
-                        pass
-                    
-                    if attempt < max_retries - 1:
-                        print(f"Waiting {retry_delay} seconds before retry...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Exponential backoff
-                    else:
-                        self.handle_ex(f"Failed to connect after {max_retries} attempts: {str(e)}")
-                        raise
+        self.conn = self.get_session().ensure_connected()
+
+    def conn_token(self):
+        """Identifies the current connection; changes whenever it was (re)established"""
+        return (self.conn, self.session.generation if self.session is not None else 0)
 
     def check_connection(self):
         """Check if the connection is alive and reconnect if needed"""
@@ -98,244 +91,348 @@ class broker_ibkr(broker_root):
         if not self.check_connection():
             raise Exception("Unable to establish connection to Interactive Brokers")
         self.load_conn()
+        # a futures month we hold a position in, by its position key (see rolled_positions)
+        held = self.held_contracts().get(symbol)
+        if held is not None and not forhistory:
+            return self.held_contract(held)
         # keep a cache of stocks to avoid repeated calls to IB
-        if symbol in stock_cache:
-            stock = stock_cache[symbol]
-        else:
-            # remove the TV-style 1! suffix from the symbol (e.g. NQ1! -> NQ)
-            symbol = symbol.replace('1!', '')
-            if False:
-                pass
+        key = (symbol, forhistory)
+        stock = stock_cache.get(key)
+        # futures are rebuilt on their roll date, to move on to the next month, and once
+        # contract details have arrived for one that was built without them
+        if stock is None or (stock.roll_at is not None and datetime.date.today() >= stock.roll_at) \
+                or (stock.provisional and contract_cache.get(broker_instruments.get_instrument(symbol))):
+            stock = stock_cache[key] = self.make_contract(broker_instruments.get_instrument(symbol), forhistory)
+        return stock
 
-            elif symbol in ['SOXL','SOXS']:
-                # Use SMART routing for better reliability
-                stock = Stock(symbol, 'SMART', 'USD')
-                #stock = Stock(symbol, 'ARCA', 'USD')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol in ['NQ', 'ES', 'MNQ', 'MES']:
-                if not forhistory:
-                    stock = Future(symbol, '20250919', 'CME')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CME', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 4
-                stock.market_order = False
-
-            elif symbol in ['RTY','M2K']:
-                if not forhistory:
-                    stock = Future(symbol, '20250620', 'CME')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CME', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10
-                stock.market_order = False
-
-            elif symbol in ['YM','MYM']:
-                if not forhistory:
-                    stock = Future(symbol, '20250919', 'CBOT')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CBOT', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 100
-                stock.market_order = True
-
-            elif symbol in ['ZN']:
-                if not forhistory:
-                    stock = Future(symbol, '20230621', 'CBOT')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CBOT', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol in ['VX']:
-                if not forhistory:
-                    stock = Future('VIX', '20230517', 'CFE')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CFE', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 100
-                stock.market_order = True
-
-            # forex futures listed at https://www.interactivebrokers.com/en/trading/cme-wti-futures.php
-            elif symbol in ['M6E', 'M6A', 'M6B', 'MJY', 'MSF', 'MIR', 'MNH']:
-                if not forhistory:
-                    stock = Future(symbol, '20230616', 'CME')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CME', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10000
-                stock.market_order = False
-
-            elif symbol in ['MCD']:
-                if not forhistory:
-                    stock = Future(symbol, '20230620', 'CME')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CME', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10000
-                stock.market_order = False
-
-            elif symbol in ['HE']:
-                if not forhistory:
-                    stock = Future(symbol, '20230417', 'CME')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='CME', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 4
-                stock.market_order = False
-
-            elif symbol == 'DX':
-                if not forhistory:
-                    stock = Future(symbol, '20230616', 'NYBOT')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='NYBOT', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol in ['CL', 'NG']:
-                if not forhistory:
-                    stock = Future(symbol, '20230522', 'NYMEX')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='NYMEX', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10
-                stock.market_order = False
-
-            elif symbol in ['GC', 'HG', 'MGC', 'MHG']:
-                if not forhistory:
-                    stock = Future(symbol, '20230628', 'COMEX')
-                else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='COMEX', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10
-                stock.market_order = True
-
-            elif symbol in ['SI','MSI']:
-                if not forhistory:
-                    stock = Future(symbol, '20230727', 'COMEX', currency='USD', multiplier='1000')
+    def make_contract(self, instrument, forhistory=False):
+        roll_at = None
+        provisional = False
+        if instrument.is_futures:
+            if forhistory:
+                stock = Contract(symbol=instrument.history_symbol, secType='CONTFUT', exchange=instrument.exchange,
+                                 currency=instrument.currency, multiplier=instrument.multiplier, includeExpired=True)
+            else:
+                front, roll_at = contract_cache.front_month(instrument)
+                if front is not None:
+                    stock = Contract(**front)
                 else:
-                    stock = Contract(symbol=symbol, secType='CONTFUT', exchange='COMEX', currency='USD', multiplier='1000', includeExpired=True)
-                stock.is_futures = 1
-                stock.round_precision = 10
-                stock.market_order = True
-
-            elif symbol in ['HXU', 'HXD', 'HQU', 'HQD', 'HEU', 'HED', 'HSU', 'HSD', 'HGU', 'HGD', 'HBU', 'HBD', 'HNU', 'HND', 'HOU', 'HOD', 'HCU', 'HCD']:
-                #stock = Stock(symbol, 'SMART', 'CAD')
-                stock = Stock(symbol, 'TSE')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = True
-
-            elif symbol == 'NDX':
-                stock = Index(symbol, 'NASDAQ')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol == 'VIX':
-                stock = Index(symbol, 'CBOE')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol == 'BRK-B' or symbol == 'BRK/B' or symbol == 'BRK.B':
-                stock = Index('BRK B', 'NYSE', 'USD')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol == 'JETS':
-                stock = Index('JETS', 'NYSE')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
-            elif symbol == 'WEAT':
-                stock = Index('WEAT', 'NYSE')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
-
+                    # nothing cached yet: use the registry's expiry until the listed
+                    # months have been fetched in the background
+                    stock = Future(instrument.contract_symbol, instrument.expiry, instrument.exchange,
+                                   currency=instrument.currency, multiplier=instrument.multiplier)
+                    provisional = True
+                if not contract_cache.is_fresh(instrument):
+                    self.refresh_contracts_later(instrument)
+        else:
+            if instrument.sec_type == 'IND':
+                stock = Index(instrument.contract_symbol, instrument.exchange, instrument.currency)
             else:
-                stock = Stock(symbol, 'SMART', 'USD')
-                stock.is_futures = 0
-                stock.round_precision = 100
-                stock.market_order = False
+                stock = Stock(instrument.contract_symbol, instrument.exchange, instrument.currency)
+            entry = contract_cache.get(instrument)
+            if entry and len(entry['contracts']) == 1:
+                stock.conId = entry['contracts'][0]['conId']
+        return self.describe_contract(stock, instrument, roll_at, provisional)
+
+    def describe_contract(self, stock, instrument, roll_at=None, provisional=False):
+        stock.is_futures = 1 if instrument.is_futures else 0
+        stock.round_precision = instrument.round_precision
+        stock.market_order = instrument.market_order
+        stock.price_scale = instrument.price_scale
+        stock.roll_at = roll_at
+        stock.provisional = provisional
+        return stock
+
+    def held_contracts(self):
+        state = account_state.get(f"{self.aconfig['host']}:{self.aconfig['port']}")
+        return state['contracts'].get(self.account, {}) if state is not None else {}
+
+    def held_contract(self, contract):
+        instrument = broker_instruments.find_contract(contract.symbol, contract.secType)
+        # position contracts come without an exchange to route orders to
+        fields = broker_contracts.contract_fields(contract)
+        fields['exchange'] = fields['exchange'] or instrument.exchange
+        return self.describe_contract(Contract(**fields), instrument)
+
+    def position_key(self, symbol):
+        return position_key(self.get_stock(symbol))
 
-            stock_cache[symbol] = stock
+    def rolled_positions(self, symbol, positions):
+        stock = self.get_stock(symbol)
+        if not stock.is_futures:
+            return {}
+        current = position_key(stock)
+        prefix = f"{stock.symbol} "
+        # earlier months only; a later one would be a position we didn't open
+        return {key: size for key, size in positions.items() if key.startswith(prefix) and key < current}
+
+    def contract_template(self, instrument):
+        if instrument.is_futures:
+            # no expiry, so IB returns every listed month
+            return Future(instrument.contract_symbol, exchange=instrument.exchange, currency=instrument.currency, multiplier=instrument.multiplier)
+        if instrument.sec_type == 'IND':
+            return Index(instrument.contract_symbol, instrument.exchange, instrument.currency)
+        return Stock(instrument.contract_symbol, instrument.exchange, instrument.currency)
+
+    def qualify_contracts(self, symbols):
+        broker_ibkr_conn.run(self.qualify_contracts_async(symbols))
+
+    async def qualify_contracts_async(self, symbols):
+        """Fetch contract details for every symbol that isn't freshly cached, in one batch"""
+        instruments = {}
+        for symbol in symbols:
+            instrument = broker_instruments.get_instrument(symbol)
+            if not contract_cache.is_fresh(instrument):
+                instruments[contract_cache.key(instrument)] = instrument
+        if not instruments:
+            return
+        start = time.perf_counter()
+        results = await asyncio.gather(*[self.conn.reqContractDetailsAsync(self.contract_template(instrument))
+                                         for instrument in instruments.values()], return_exceptions=True)
+        for instrument, result in zip(instruments.values(), results):
+            if isinstance(result, BaseException) or not result:
+                print(f"IB: no contract details for {instrument.symbol}: {result}")
+                continue
+            contract_cache.put(instrument, [broker_contracts.contract_fields(details.contract) for details in result])
+        contract_cache.save()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        core_metrics.timing('broker.ibkr.contract_details', elapsed_ms)
+        print(f"IB: fetched contract details for {len(instruments)} instruments in {elapsed_ms:.0f}ms")
+
+    def refresh_contracts_later(self, instrument):
+        if instrument.symbol in contract_refreshes:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop (e.g. startup); the next lookup on the loop schedules it
+            return
+        contract_refreshes.add(instrument.symbol)
+        task = loop.create_task(self.qualify_contracts_async([instrument.symbol]))
+        task.add_done_callback(lambda _: contract_refreshes.discard(instrument.symbol))
+
+    def config_symbols(self):
+        """Symbols this account can trade according to config.ini: its *-pct settings and the inverse ETFs"""
+        defaults = self.config.defaults()
+        symbols = set()
+        for key, value in self.aconfig.items():
+            if not key.endswith('-pct') or key == 'default-pct' or key in defaults:
+                continue
+            symbols.add(key[:-len('-pct')].upper())
+            # "1.5, NQ" trades NQ instead of the signal's symbol
+            parts = [x.strip() for x in value.split('#')[0].split(',')]
+            if len(parts) > 1 and parts[1] != '':
+                symbols.add(parts[1].upper())
+        if self.config.has_section('inverse-etfs'):
+            for key, value in self.config['inverse-etfs'].items():
+                if key not in defaults:
+                    symbols.add(key.upper())
+                    symbols.add(value.strip().upper())
+        return sorted(symbols)
+
+    def market_data_key(self, stock):
+        # by conId where we have one, so a futures roll subscribes to the new month
+        return (f"{self.aconfig['host']}:{self.aconfig['port']}", stock.conId or stock.symbol)
+
+    def subscribe_market_data(self, symbols):
+        for symbol in symbols:
+            try:
+                stock = self.get_stock(symbol)
+                key = self.market_data_key(stock)
+                entry = market_data.get(key)
+                # subscriptions don't survive a reconnect
+                if entry is not None and entry['token'] == self.conn_token():
+                    continue
+                ticker = self.conn.reqMktData(stock, '', False, False)
+                market_data[key] = {'token': self.conn_token(), 'ticker': ticker}
+                print(f"IB: streaming market data for {symbol}")
+            except Exception as e:
+                print(f"IB: unable to subscribe to market data for {symbol}: {e}")
+
+    def get_streaming_price(self, stock):
+        entry = market_data.get(self.market_data_key(stock))
+        if entry is None or entry['token'] != self.conn_token():
+            return None
+        price = self.ticker_price(entry['ticker'])
+        return None if math.isnan(price) else price
+
+    def ticker_price(self, ticker):
+        if not math.isnan(ticker.last):
+            return ticker.last
+        return ticker.close
+
+    async def load_conn_async(self):
+        self.conn = await self.get_session().ensure_connected_async()
+
+    async def get_stock_async(self, symbol):
+        stock = self.get_stock(symbol)
+        # qualify once so orders carry a conId (cached contract details already have one);
+        # contracts IB can't resolve are used as they are
+        if not stock.conId and not getattr(stock, 'qualify_attempted', False):
+            stock.qualify_attempted = True
+            try:
+                await self.conn.qualifyContractsAsync(stock)
+            except Exception as e:
+                print(f"  unable to qualify contract for {symbol}: {e}")
         return stock
 
+    # the sync versions run the async ones to completion, for callers off the event loop
+    # (scripts); on the loop they only work for what's already cached, see broker_ibkr_conn.run
     def get_price(self, symbol):
-        if not self.check_connection():
-            raise Exception("Unable to establish connection to Interactive Brokers")
-        self.load_conn()
-        stock = self.get_stock(symbol)
+        return broker_ibkr_conn.run(self.get_price_async(symbol))
+
+    async def get_price_async(self, symbol):
+        await self.load_conn_async()
+        stock = await self.get_stock_async(symbol)
+
+        # subscribed symbols are a memory read once IB has sent the first tick
+        price = self.get_streaming_price(stock)
+        if price is not None:
+            print(f"  get_price({symbol}) -> {price} (streaming)")
+            return price
 
         # keep a cache of tickers to avoid repeated calls to IB, but only for 15s
         # (IBKR is giving us 11s delays for some reason)
+        price = None
         if symbol in ticker_cache and time.time() - ticker_cache[symbol]['time'] < 15:
             ticker = ticker_cache[symbol]['ticker']
         else:
-            # Retry with exponential backoff: 1s, 2s, 4s, 8s, 16s (up to 31s total)
-            max_retries = 5
-            retry_delays = [1, 2, 4, 8, 16]
-            
-            for attempt in range(max_retries + 1):
-                try:
-                    starttimer = time.time()
-                    [ticker] = self.conn.reqTickers(stock)
-                    elapsed = time.time() - starttimer
-                    if attempt > 0:
-                        print(f"  get_price({symbol}) succeeded on attempt {attempt + 1}, took {elapsed:.2f}s")
-                    else:
-                        print(f"  get_price({symbol}) cache miss, took {elapsed:.2f}s")
-                    ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
-                    break
-                except Exception as e:
-                    if attempt < max_retries:
-                        delay = retry_delays[attempt]
-                        print(f"  get_price({symbol}) failed on attempt {attempt + 1}: {str(e)}, retrying in {delay}s...")
-                        time.sleep(delay)
-                        # Force reconnection on repeated failures
-                        if attempt >= 2:
-                            print(f"  Forcing reconnection after {attempt + 1} failures")
-                            try:
-                                self.conn.disconnect()
-                            except:
-                                pass
-                            self.conn = None
-                            # Clear the cache to force fresh connection
-                            ibcachekey = f"{self.aconfig['host']}:{self.aconfig['port']}"
-                            if ibcachekey in ibconn_cache:
-                                del ibconn_cache[ibcachekey]
-                        # Refresh connection for next attempt
-                        self.load_conn()
-                        stock = self.get_stock(symbol)
-                    else:
-                        print(f"  get_price({symbol}) failed after {max_retries + 1} attempts: {str(e)}")
-                        # Send critical error notification
-                        from core_error import handle_ex
-                        handle_ex(f"Failed to get price for {symbol}: {str(e)}", 
-                                context=f"trade_price_fetch_{symbol}", 
-                                service="broker",
-                                extra_tags=[f'symbol:{symbol}', f'account:{self.account}'])
-                        raise Exception(f"Failed to get price for {symbol} after {max_retries + 1} attempts: {str(e)}")
-
-        if math.isnan(ticker.last):
-            if math.isnan(ticker.close):
+            # then the price cache shared with the other broker processes
+            shared, stale, _ = self.price_cache().lookup([symbol])
+            price = shared.get(symbol)
+            if stale:
+                asyncio.get_running_loop().create_task(self.refresh_prices_async(stale))
+            if price is None:
+                ticker = await self.request_ticker_async(symbol, stock)
+
+        # stream this symbol from now on, so the snapshot above is only needed once
+        self.subscribe_market_data([symbol])
+
+        if price is None:
+            price = self.ticker_price(ticker)
+            if math.isnan(price):
                 raise Exception(f"error trying to retrieve stock price for {symbol}, last={ticker.last}, close={ticker.close}")
-            else:
-                price = ticker.close
-        else:
-            price = ticker.last
         print(f"  get_price({symbol}) -> {price}")
         return price
 
+    async def request_ticker_async(self, symbol, stock):
+        # Retry with exponential backoff: 1s, 2s, 4s, 8s, 16s (up to 31s total)
+        max_retries = 5
+        retry_delays = [1, 2, 4, 8, 16]
+
+        for attempt in range(max_retries + 1):
+            try:
+                starttimer = time.time()
+                [ticker] = await self.conn.reqTickersAsync(stock)
+                elapsed = time.time() - starttimer
+                if attempt > 0:
+                    print(f"  get_price({symbol}) succeeded on attempt {attempt + 1}, took {elapsed:.2f}s")
+                else:
+                    print(f"  get_price({symbol}) cache miss, took {elapsed:.2f}s")
+                self.cache_ticker(symbol, ticker)
+                return ticker
+            except Exception as e:
+                if attempt < max_retries:
+                    delay = retry_delays[attempt]
+                    print(f"  get_price({symbol}) failed on attempt {attempt + 1}: {str(e)}, retrying in {delay}s...")
+                    # other accounts' orders keep going while this one backs off
+                    await asyncio.sleep(delay)
+                    # Force reconnection on repeated failures
+                    if attempt >= 2:
+                        print(f"  Forcing reconnection after {attempt + 1} failures")
+                        try:
+                            await self.session.reset_async()
+                        except Exception as reset_error:
+                            print(f"  reconnection failed: {reset_error}")
+                    # Refresh connection for next attempt
+                    await self.load_conn_async()
+                    stock = await self.get_stock_async(symbol)
+                else:
+                    print(f"  get_price({symbol}) failed after {max_retries + 1} attempts: {str(e)}")
+                    # Send critical error notification
+                    from core_error import handle_ex
+                    handle_ex(f"Failed to get price for {symbol}: {str(e)}", 
+                            context=f"trade_price_fetch_{symbol}", 
+                            service="broker",
+                            extra_tags=[f'symbol:{symbol}', f'account:{self.account}'])
+                    raise Exception(f"Failed to get price for {symbol} after {max_retries + 1} attempts: {str(e)}")
+
+    def cache_ticker(self, symbol, ticker):
+        ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
+        price = self.ticker_price(ticker)
+        if not math.isnan(price):
+            self.price_cache().put({symbol: price})
+
+    async def refresh_prices_async(self, symbols):
+        """Fetch stale shared prices again, in the background, for every process using them"""
+        try:
+            stocks = {symbol: await self.get_stock_async(symbol) for symbol in symbols}
+            tickers = await self.conn.reqTickersAsync(*stocks.values())
+            by_contract = {ticker.contract.symbol: ticker for ticker in tickers}
+            for symbol, stock in stocks.items():
+                if stock.symbol in by_contract:
+                    self.cache_ticker(symbol, by_contract[stock.symbol])
+        except Exception as e:
+            print(f"  refreshing prices for {symbols} failed: {e}")
+
+    def get_prices(self, symbols):
+        return broker_ibkr_conn.run(self.get_prices_async(symbols))
+
+    async def get_prices_async(self, symbols):
+        await self.load_conn_async()
+        prices = {}
+        missing = {}
+        for symbol in symbols:
+            stock = await self.get_stock_async(symbol)
+            price = self.get_streaming_price(stock)
+            if price is not None:
+                prices[symbol] = price
+            else:
+                missing[symbol] = stock
+
+        if missing:
+            # then the price cache shared with the other broker processes
+            shared, stale, still_missing = self.price_cache().lookup(missing)
+            prices.update(shared)
+            if stale:
+                asyncio.get_running_loop().create_task(self.refresh_prices_async(stale))
+            self.subscribe_market_data([symbol for symbol in missing if symbol not in still_missing])
+            missing = {symbol: missing[symbol] for symbol in still_missing}
+
+        if missing:
+            # one reqTickers round trip for everything that isn't streaming yet
+            starttimer = time.time()
+            tickers = await self.conn.reqTickersAsync(*missing.values())
+            print(f"  get_prices({list(missing)}) took {time.time() - starttimer:.2f}s")
+            by_contract = {ticker.contract.symbol: ticker for ticker in tickers}
+            for symbol, stock in missing.items():
+                ticker = by_contract.get(stock.symbol)
+                if ticker is None:
+                    continue
+                price = self.ticker_price(ticker)
+                if not math.isnan(price):
+                    prices[symbol] = price
+                    self.cache_ticker(symbol, ticker)
+            self.subscribe_market_data(list(missing))
+
+        print(f"  get_prices({list(symbols)}) -> {prices}")
+        return prices
+
+    async def prepare_async(self, symbols=(), prices=None):
+        # connect and pull net liquidity and prices before planning, so planning (on the
+        # event loop) only reads caches. Prices are best effort: not every symbol a signal
+        # may touch gets read, so one that can't be priced only fails the plan if it's needed
+        await self.load_conn_async()
+        await self.get_net_liquidity_async()
+        prices = dict(prices) if prices else {}
+        missing = [symbol for symbol in symbols if symbol not in prices]
+        if missing:
+            try:
+                prices.update(await self.get_prices_async(missing))
+            except Exception as e:
+                print(f"  prepare_async: pricing {missing} failed: {e}")
+        return prices
+
     # example: get_price_opt('SPY', datetime.date.today, 280, 'P', '20191016')
     def get_price_opt(self, symbol, expiry, strike, put_call):
         self.load_conn()
@@ -359,15 +456,76 @@ class broker_ibkr(broker_root):
         print(f"  get_price({symbol}) -> {price}")
         return price
 
+    def account_cache(self):
+        """Net liquidity and positions for every account on this gateway, kept current by
+        ib_insync's account and position events so reading them needs no round trip"""
+        key = f"{self.aconfig['host']}:{self.aconfig['port']}"
+        state = account_state.get(key)
+        token = self.conn_token()
+        if state is not None and state['token'] == token:
+            return state
+        if state is not None and state['conn'] is self.conn:
+            # same IB object, reconnected: our handlers are still attached, but the account
+            # summary subscription is gone and positions are re-sent, so start over
+            state['token'] = token
+            state['net_liquidity'].clear()
+            state['positions'].clear()
+            state['contracts'].clear()
+            for position in self.conn.positions():
+                state['on_position'](position)
+            return state
+        state = account_state[key] = {'conn': self.conn, 'token': token, 'net_liquidity': {}, 'positions': {}, 'contracts': {}}
+
+        def on_account_value(value):
+            if value.tag == 'NetLiquidation':
+                try:
+                    state['net_liquidity'][value.account] = float(value.value)
+                except ValueError:
+                    pass
+
+        def on_position(position):
+            positions = state['positions'].setdefault(position.account, {})
+            contracts = state['contracts'].setdefault(position.account, {})
+            key = position_key(position.contract)
+            if position.position == 0:
+                positions.pop(key, None)
+                contracts.pop(key, None)
+            else:
+                positions[key] = int(position.position)
+                contracts[key] = position.contract
+
+        self.conn.accountValueEvent += on_account_value
+        self.conn.accountSummaryEvent += on_account_value
+        self.conn.positionEvent += on_position
+        state['on_position'] = on_position
+        # seed from what ib_insync already holds locally
+        for value in self.conn.accountValues():
+            on_account_value(value)
+        for position in self.conn.positions():
+            on_position(position)
+        return state
+
     def get_net_liquidity(self):
         self.load_conn()
-        # get the current net liquidity
-        net_liquidity = 0
-        accountSummary = self.conn.accountSummary(self.account)
-        for value in accountSummary:
-            if value.tag == 'NetLiquidation':
-                net_liquidity = float(value.value)
-                break
+        net_liquidity = self.account_cache()['net_liquidity'].get(self.account)
+        if net_liquidity is None:
+            net_liquidity = broker_ibkr_conn.run(self.get_net_liquidity_async())
+        else:
+            print(f"  get_net_liquidity() -> {net_liquidity}")
+        return net_liquidity
+
+    async def get_net_liquidity_async(self):
+        await self.load_conn_async()
+        state = self.account_cache()
+        net_liquidity = state['net_liquidity'].get(self.account)
+        if net_liquidity is None:
+            # not streamed yet; this also starts the account summary subscription,
+            # so later changes arrive through accountSummaryEvent
+            net_liquidity = 0
+            for value in await self.conn.accountSummaryAsync(self.account):
+                if value.tag == 'NetLiquidation':
+                    net_liquidity = state['net_liquidity'][self.account] = float(value.value)
+                    break
 
         print(f"  get_net_liquidity() -> {net_liquidity}")
 
@@ -377,25 +535,40 @@ class broker_ibkr(broker_root):
         self.load_conn()
         # get the current position size
         stock = self.get_stock(symbol)
-        psize = 0
-        for p in self.conn.positions(self.account):
-            if p.contract.symbol == stock.symbol:
-                psize = int(p.position)
+        psize = self.account_cache()['positions'].get(self.account, {}).get(position_key(stock), 0)
 
         print(f"  get_position_size({symbol}) -> {psize}")
         return psize
 
-    async def set_position_size(self, symbol, amount):
+    def get_positions(self):
+        self.load_conn()
+        # every position, keyed by contract symbol (and month, for futures)
+        positions = dict(self.account_cache()['positions'].get(self.account, {}))
+
+        print(f"  get_positions() -> {positions}")
+        return positions
+
+    async def get_positions_async(self):
+        # reconnects without blocking if the session dropped; positions are then re-sent
+        await self.load_conn_async()
+        return self.get_positions()
+
+    def get_open_orders(self):
+        self.load_conn()
+        return [trade for trade in self.conn.openTrades() if trade.order.account == self.account]
+
+    async def set_position_size(self, symbol, amount, position_size=None):
         print(f"set_position_size({self.account},{symbol},{amount})")
         if False:
             print(f"  SKIPPING")
             return
 
-        self.load_conn()
-        stock = self.get_stock(symbol)
+        await self.load_conn_async()
+        stock = await self.get_stock_async(symbol)
 
-        # get the current position size
-        position_size = self.get_position_size(symbol)
+        # get the current position size, unless the caller already knows it
+        if position_size is None:
+            position_size = self.get_position_size(symbol)
 
         # figure out how much to buy or sell
         position_variation = round(amount - position_size, 0)
@@ -410,7 +583,7 @@ class broker_ibkr(broker_root):
                     order = MarketOrder('SELL', abs(position_variation))
 
             else:
-                price = self.get_price(symbol)
+                price = await self.get_price_async(symbol)
                 high_limit_price = self.x_round(price * 1.008, stock.round_precision)
                 low_limit_price  = self.x_round(price * 0.992, stock.round_precision)
 
@@ -431,18 +604,74 @@ class broker_ibkr(broker_root):
     async def is_trade_completed(self, trade):
         return trade.orderStatus.status in ['Filled', 'Cancelled', 'ApiCancelled']
 
-    def download_data(self, symbol, end, duration, barlength, cachedata=False):
+    def get_trade_event(self, trade):
+        # ib_insync pushes order status changes (fills, cancels) on the trade itself
+        event = asyncio.Event()
+        def on_status(trade):
+            if trade.isDone():
+                trade.statusEvent -= on_status
+                event.set()
+        if trade.isDone():
+            event.set()
+        else:
+            trade.statusEvent += on_status
+        return event
+
+    def download_data(self, symbol, end, duration, barlength, cachedata=False, copy=True):
+        return broker_ibkr_conn.run(self.download_data_async(symbol, end, duration, barlength, cachedata, copy))
+
+    async def download_data_async(self, symbol, end, duration, barlength, cachedata=False, copy=True):
+        # identical downloads already under way (e.g. QQQ for NDX's volume) are shared, not repeated
+        key = (f"{self.aconfig['host']}:{self.aconfig['port']}", symbol, end, duration, barlength, cachedata)
+        task = history_downloads.get(key)
+        if task is None:
+            task = history_downloads[key] = asyncio.ensure_future(self.load_bars(symbol, end, duration, barlength, cachedata))
+            task.add_done_callback(lambda _: history_downloads.pop(key, None))
+        df = await asyncio.shield(task)
+        # bars from the store are a read-only view of its mapped file, and a shared download is
+        # one frame for every caller, so each caller gets its own copy unless it only reads (copy=False)
+        return df.copy() if copy else df
+
+    async def load_bars(self, symbol, end, duration, barlength, cachedata):
         print(f"download_data({symbol},{end},{duration},{barlength})")
 
-        cachefile = f"cache/stockdata-{symbol}-{end.replace(' ','_')}-{duration.replace(' ','_')}-{barlength}.pkl"
-
-        # check if we have a cached version of the data and it's not more than 1h old
-        if cachedata and os.path.exists(cachefile) and time.time() - os.path.getmtime(cachefile) < 3600:
+        # bars are kept in the shared bar store; a request only fetches what the store lacks,
+        # normally just the bars since the last one stored (cachedata skips even that for an hour)
+        store = broker_bars.bar_store
+        end_time = broker_bars.parse_end(end)
+        start = end_time - broker_bars.duration_to_timedelta(duration)
+        if end:
+            if store.covers('ibkr', symbol, barlength, start, end_time):
+                return store.read('ibkr', symbol, barlength, start, end_time)
+            # a window in the past the store doesn't have: fetch it without touching the store
+            return await self.fetch_bars_async(symbol, end, duration, barlength)
+
+        if not store.covers('ibkr', symbol, barlength, start):
+            df = await self.fetch_bars_async(symbol, '', duration, barlength)
+            if len(df):
+                store.write('ibkr', symbol, barlength, df, covered_from=start, replace=True)
+        elif not (cachedata and store.age('ibkr', symbol, barlength) < 3600):
+            last = store.last_time('ibkr', symbol, barlength)
+            df = await self.fetch_bars_async(symbol, '', broker_bars.timedelta_to_duration(pd.Timestamp.now(tz=last.tz) - last), barlength)
+            if len(df):
+                store.write('ibkr', symbol, barlength, df)
+        else:
             print("  loading cached data")
-            df = pd.read_pickle(cachefile)
-            return df
+        df = store.read('ibkr', symbol, barlength, start)
+        if df is None:
+            # nothing stored (IB had no bars)
+            return await self.fetch_bars_async(symbol, '', duration, barlength)
+        return df
 
-        self.load_conn()
+    def pacing(self):
+        gateway = f"{self.aconfig['host']}:{self.aconfig['port']}"
+        pacing = history_pacing.get(gateway)
+        if pacing is None:
+            pacing = history_pacing[gateway] = broker_downloads.HistoryPacing()
+        return pacing
+
+    async def fetch_bars_async(self, symbol, end, duration, barlength):
+        await self.load_conn_async()
         stock = self.get_stock(symbol, forhistory=True)
 
         # request historical bars
@@ -450,16 +679,19 @@ class broker_ibkr(broker_root):
         if 'day' in barlength or 'week' in barlength or 'month' in barlength:
             useRTH = True
 
-        bars = self.conn.reqHistoricalData(
-            stock,
-            endDateTime=end,
-            durationStr=duration,
-            barSizeSetting=barlength,
-            whatToShow='TRADES',
-            useRTH=useRTH,
-            formatDate=1,
-            timeout = 300
-        )
+        async with self.pacing().slot(stock.symbol):
+            bars = await self.conn.reqHistoricalDataAsync(
+                stock,
+                endDateTime=end,
+                durationStr=duration,
+                barSizeSetting=barlength,
+                whatToShow='TRADES',
+                useRTH=useRTH,
+                formatDate=1,
+                timeout = 300
+            )
+        if not bars:
+            return pd.DataFrame(columns=['Open', 'High', 'Low', 'Close', 'Volume'], index=pd.DatetimeIndex([], name='Date'))
         # convert to df, and rename columns from 'open' to 'Open' etc to make it look like Yahoo data
         df = util.df(bars,labels=['date','open','high','low','close','volume'])
         df.columns = [c.capitalize() for c in df.columns]
@@ -494,14 +726,10 @@ class broker_ibkr(broker_root):
 
         # special case: NDX doesn't give us volume, so we have to pick it up from QQQ
         if (symbol == 'NDX'):
-            df['Volume'] = self.download_data('QQQ', end, duration, barlength)['Volume']
-
-        print(f"  download_data({symbol},{end},{duration},{barlength}) -> {len(bars)} bars")
-
-        if cachedata:
-            # cache the data
-            df.to_pickle(cachefile)
+            df['Volume'] = (await self.download_data_async('QQQ', end, duration, barlength, copy=False))['Volume']
 
+        print(f"  fetch_bars({symbol},{end},{duration},{barlength}) -> {len(bars)} bars")
+        core_metrics.increment('broker.bars.fetched', len(df), tags=['source:ibkr'])
         return df
 
 
@@ -518,13 +746,22 @@ class broker_ibkr(broker_root):
         self.get_position_size('SOXL')
         self.get_position_size('SOXS')
 
+    async def health_check_prices_async(self):
+        await self.get_price_async('NQ1!')
+        await self.get_price_async('MNQ1!')
+
+    async def health_check_positions_async(self):
+        await self.get_net_liquidity_async()
+        self.get_position_size('SOXL')
+        self.get_position_size('SOXS')
+
     async def set_bracket(self, symbol):
         print(f"set_bracket({self.account},{symbol})")
-        self.load_conn()
-        stock = self.get_stock(symbol)
+        await self.load_conn_async()
+        stock = await self.get_stock_async(symbol)
 
         # Get the current price
-        price = self.get_price(symbol)
+        price = await self.get_price_async(symbol)
 
         # Calculate stop loss and take profit prices
         stop_loss_price = self.x_round(price * 0.99, stock.round_precision)
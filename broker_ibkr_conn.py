@@ -0,0 +1,272 @@
+import asyncio
+import atexit
+import os
+import socket
+import time
+import redis
+from ib_insync import IB, util
+import core_metrics
+from core_error import handle_ex
+
+# clientIds are leased in redis per gateway, so several broker processes (or bots) on one
+# gateway never try the same id; each session renews its lease every LEASE_RENEW seconds
+CLIENT_ID_KEY = 'ibkr:clientid'
+CLIENT_ID_MIN = 1
+CLIENT_ID_MAX = 64
+LEASE_TTL = 300
+LEASE_RENEW = 60
+CONNECT_TIMEOUT = 20
+CONNECT_ATTEMPTS = 3
+RECONNECT_MAX_DELAY = 60
+# IB's error for a clientId that another client is already connected with
+CLIENT_ID_IN_USE = 326
+
+def run(coro):
+    """
+    Run a coroutine to completion for a sync wrapper. ib_insync lives on the event loop, which
+    must never block, so on the loop this fails at once: code there uses the *_async versions,
+    or reads what they've already cached.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("IB: blocking call made on the event loop, use the async version")
+    try:
+        asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        # none set for this thread (e.g. after asyncio.run() finished in it)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    return util.run(coro)
+
+class ClientIdRegistry:
+    def __init__(self, owner, r=None):
+        self.owner = owner
+        self.r = r if r is not None else redis.Redis(host='localhost', port=6379, db=0)
+        self.leases = {}
+
+    def key(self, gateway, client_id):
+        return f"{CLIENT_ID_KEY}:{gateway}:{client_id}"
+
+    def allocate(self, gateway, skip=()):
+        try:
+            for client_id in range(CLIENT_ID_MIN, CLIENT_ID_MAX + 1):
+                if client_id in skip:
+                    continue
+                if self.r.set(self.key(gateway, client_id), self.owner, nx=True, ex=LEASE_TTL):
+                    self.leases[(gateway, client_id)] = time.time()
+                    return client_id
+        except redis.exceptions.ConnectionError as e:
+            # no registry: fall back to an id that differs per process
+            client_id = CLIENT_ID_MAX + 1 + os.getpid() % 900
+            print(f"IB: clientId registry unavailable ({e}), using clientId {client_id}")
+            return client_id
+        raise Exception(f"IB: no free clientId for {gateway} (all {CLIENT_ID_MAX} are leased)")
+
+    def block(self, gateway, client_id):
+        """Mark an id taken by something outside the registry (e.g. TWS itself) so nobody tries it for a while"""
+        self.leases.pop((gateway, client_id), None)
+        try:
+            self.r.set(self.key(gateway, client_id), 'in-use', ex=LEASE_TTL)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def renew(self, gateway, client_id):
+        if (gateway, client_id) not in self.leases:
+            return
+        try:
+            key = self.key(gateway, client_id)
+            owner = self.r.get(key)
+            if owner is None or owner.decode() == self.owner:
+                self.r.set(key, self.owner, ex=LEASE_TTL)
+            self.leases[(gateway, client_id)] = time.time()
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def release(self, gateway, client_id):
+        if self.leases.pop((gateway, client_id), None) is None:
+            return
+        try:
+            key = self.key(gateway, client_id)
+            owner = self.r.get(key)
+            if owner is not None and owner.decode() == self.owner:
+                self.r.delete(key)
+        except redis.exceptions.ConnectionError:
+            pass
+
+    def release_all(self):
+        for gateway, client_id in list(self.leases):
+            self.release(gateway, client_id)
+
+class IBSession:
+    """
+    One IB connection per gateway, shared by every account in the process that trades
+    through it. If the gateway drops the connection, it is re-established in the
+    background; generation counts successful connects, so callers can tell when
+    per-connection state (like market data subscriptions) has to be set up again.
+    """
+    def __init__(self, host, port, registry):
+        self.host = host
+        self.port = port
+        self.gateway = f"{host}:{port}"
+        self.registry = registry
+        self.ib = IB()
+        self.client_id = None
+        self.generation = 0
+        self.closing = False
+        self.disconnected_at = None
+        self.reconnect_task = None
+        self.connect_task = None
+        self.renew_task = None
+        self.client_id_rejected = False
+        self.ib.disconnectedEvent += self.on_disconnected
+        self.ib.errorEvent += self.on_error
+
+    def tags(self):
+        return [f'gateway:{self.gateway}']
+
+    def connect(self):
+        return run(self.connect_async())
+
+    def on_error(self, req_id, error_code, error_string, contract):
+        if error_code == CLIENT_ID_IN_USE:
+            self.client_id_rejected = True
+
+    async def connect_async(self):
+        failed = set()
+        for attempt in range(CONNECT_ATTEMPTS):
+            if self.client_id is None:
+                self.client_id = self.registry.allocate(self.gateway, skip=failed)
+            self.client_id_rejected = False
+            start = time.perf_counter()
+            try:
+                print(f"IB: connecting to {self.gateway} (attempt {attempt + 1}/{CONNECT_ATTEMPTS}, client ID: {self.client_id})...")
+                await self.ib.connectAsync(self.host, self.port, clientId=self.client_id, timeout=CONNECT_TIMEOUT)
+                self.connected(start, 'broker.ibkr.connect')
+                return self.ib
+            except Exception as e:
+                print(f"IB: connection attempt {attempt + 1} failed: {e}")
+                self.closing = True
+                try:
+                    self.ib.disconnect()
+                except Exception:
+                    pass
+                self.closing = False
+                if self.client_id_rejected:
+                    # taken by a client that isn't in the registry (e.g. TWS itself): move on.
+                    # Anything else (gateway down, timeout) is retried with the id we hold
+                    failed.add(self.client_id)
+                    self.registry.block(self.gateway, self.client_id)
+                    self.client_id = None
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    handle_ex(f"Failed to connect to {self.gateway} after {CONNECT_ATTEMPTS} attempts: {e}", context="ibkr_connect", service="broker")
+                    raise
+
+    def connected(self, start, metric):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.generation += 1
+        self.disconnected_at = None
+        core_metrics.timing(metric, elapsed_ms, tags=self.tags())
+        print(f"IB: connected to {self.gateway} as client {self.client_id} in {elapsed_ms:.0f}ms")
+        if self.renew_task is None or self.renew_task.done():
+            self.renew_task = asyncio.get_running_loop().create_task(self.keep_lease())
+
+    async def keep_lease(self):
+        # renewed on a timer rather than on use, so a quiet night doesn't let the lease
+        # lapse while we're still connected with the id
+        while True:
+            await asyncio.sleep(LEASE_RENEW)
+            if self.client_id is not None:
+                self.registry.renew(self.gateway, self.client_id)
+
+    def ensure_connected(self):
+        if self.ib.isConnected():
+            return self.ib
+        return run(self.ensure_connected_async())
+
+    async def ensure_connected_async(self):
+        if self.ib.isConnected():
+            return self.ib
+        if self.reconnect_task is not None and not self.reconnect_task.done():
+            # a background reconnect is already under way; give it a moment rather than racing it
+            try:
+                await asyncio.wait_for(asyncio.shield(self.reconnect_task), CONNECT_TIMEOUT + 5)
+            except Exception as e:
+                print(f"IB: still reconnecting to {self.gateway}: {e}")
+            if self.ib.isConnected():
+                return self.ib
+            raise Exception(f"IB: reconnecting to {self.gateway}, try again shortly")
+        # accounts on this gateway starting up together share one connect
+        if self.connect_task is None or self.connect_task.done():
+            self.connect_task = asyncio.ensure_future(self.connect_async())
+        return await asyncio.shield(self.connect_task)
+
+    async def reset_async(self):
+        """Drop and re-establish the connection, e.g. after repeated request failures"""
+        self.closing = True
+        try:
+            self.ib.disconnect()
+        finally:
+            self.closing = False
+        return await self.connect_async()
+
+    def on_disconnected(self):
+        if self.closing:
+            return
+        self.disconnected_at = time.perf_counter()
+        core_metrics.increment('broker.ibkr.disconnects', tags=self.tags())
+        print(f"IB: lost connection to {self.gateway}, reconnecting in the background")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop to run it on; the next request reconnects instead
+            return
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = loop.create_task(self.reconnect())
+
+    async def reconnect(self):
+        delay = 1
+        start = self.disconnected_at or time.perf_counter()
+        while not self.ib.isConnected():
+            try:
+                await self.ib.connectAsync(self.host, self.port, clientId=self.client_id, timeout=CONNECT_TIMEOUT)
+                # time is measured from the disconnect, i.e. how long the gateway was unusable
+                self.connected(start, 'broker.ibkr.reconnect')
+                return
+            except Exception as e:
+                print(f"IB: reconnect to {self.gateway} failed: {e}, retrying in {delay}s")
+                self.closing = True
+                try:
+                    self.ib.disconnect()
+                except Exception:
+                    pass
+                self.closing = False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def close(self):
+        self.closing = True
+        for task in [self.reconnect_task, self.renew_task]:
+            if task is not None:
+                task.cancel()
+        try:
+            self.ib.disconnect()
+        finally:
+            self.registry.release(self.gateway, self.client_id)
+            self.client_id = None
+
+sessions = {}
+registry = None
+
+def get_session(host, port, owner=None):
+    global registry
+    if registry is None:
+        registry = ClientIdRegistry(owner or f"{socket.gethostname()}:{os.getpid()}")
+        atexit.register(registry.release_all)
+    gateway = f"{host}:{port}"
+    session = sessions.get(gateway)
+    if session is None:
+        session = sessions[gateway] = IBSession(host, int(port), registry)
+    return session
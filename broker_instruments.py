@@ -0,0 +1,77 @@
+import os
+import json
+
+class Instrument:
+    """How to trade one symbol, from instruments.json"""
+    def __init__(self, symbol, spec):
+        self.symbol = symbol
+        self.sec_type = spec.get('sec_type', 'STK')
+        self.contract_symbol = spec.get('contract_symbol', symbol)
+        self.history_symbol = spec.get('history_symbol', self.contract_symbol)
+        self.exchange = spec.get('exchange', 'SMART')
+        self.currency = spec.get('currency', '')
+        self.expiry = spec.get('expiry', '')
+        self.multiplier = spec.get('multiplier', '')
+        self.round_precision = spec.get('round_precision', 100)
+        self.tick_size = spec.get('tick_size', 1.0 / self.round_precision)
+        self.market_order = spec.get('market_order', False)
+        self.price_scale = spec.get('price_scale', 1.0)
+        # futures roll to the next month this many days before the front month expires
+        self.roll_days = spec.get('roll_days', 5)
+
+    @property
+    def is_futures(self):
+        return self.sec_type == 'FUT'
+
+    def __repr__(self):
+        return f"Instrument({self.symbol}, {self.sec_type}, {self.exchange})"
+
+class InstrumentRegistry:
+    """
+    Symbol -> Instrument, loaded once from the data file. Symbols that aren't listed
+    get the file's default entry, so a lookup never fails.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self.default = data.get('default', {})
+        self.aliases = data.get('aliases', {})
+        self.instruments = {}
+        # (contract symbol, security type) -> Instrument, for contracts IB hands back
+        self.contracts = {}
+        for spec in data.get('instruments', []):
+            spec = dict(spec)
+            for symbol in spec.pop('symbols'):
+                instrument = self.instruments[symbol] = Instrument(symbol, spec)
+                self.contracts.setdefault((instrument.contract_symbol, instrument.sec_type), instrument)
+
+    def normalize(self, symbol):
+        # remove the TV-style 1! suffix from the symbol (e.g. NQ1! -> NQ)
+        symbol = symbol.replace('1!', '').upper()
+        return self.aliases.get(symbol, symbol)
+
+    def get(self, symbol):
+        symbol = self.normalize(symbol)
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            # unlisted symbols are cached too, so repeat lookups stay a dict hit
+            instrument = self.instruments[symbol] = Instrument(symbol, self.default)
+        return instrument
+
+    def find_contract(self, contract_symbol, sec_type):
+        """The instrument for a contract as IB reports it, which can differ from the symbol
+        we trade it as: VX futures come back as VIX, and plain VIX is the index"""
+        instrument = self.contracts.get((contract_symbol, sec_type))
+        return instrument if instrument is not None else self.get(contract_symbol)
+
+registry = InstrumentRegistry(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instruments.json'))
+
+def get_instrument(symbol):
+    return registry.get(symbol)
+
+def find_contract(contract_symbol, sec_type):
+    return registry.find_contract(contract_symbol, sec_type)
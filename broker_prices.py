@@ -0,0 +1,128 @@
+import json
+import time
+import redis
+import core_metrics
+import broker_instruments
+
+# quotes are shared by every broker process (live and test bots alike) through redis
+PRICE_KEY = 'price'
+# only one process refreshes a stale quote; the others keep serving it for this long at most
+REFRESH_LOCK_TTL = 10
+# after redis fails, skip it for this long rather than waiting on a timeout every lookup
+REDIS_RETRY = 30
+
+redis_client = None
+
+def get_redis():
+    global redis_client
+    if redis_client is None:
+        redis_client = redis.Redis(host='localhost', port=6379, db=0, socket_timeout=0.25, socket_connect_timeout=0.25)
+    return redis_client
+
+class PriceCache:
+    """
+    Prices from one source (ibkr, alpaca) in redis, keyed by symbol. A price younger than
+    fresh seconds is used as is. One up to stale seconds older than that is still used, and
+    the first process to see it refreshes it in the background (see lookup).
+    """
+    def __init__(self, source, fresh, stale, r=None):
+        self.source = source
+        self.fresh = fresh
+        self.stale = stale
+        self.r = r
+        self.down_until = 0
+
+    def key(self, symbol):
+        return f"{PRICE_KEY}:{self.source}:{broker_instruments.registry.normalize(symbol)}"
+
+    def count(self, result, n=1):
+        if n:
+            core_metrics.increment('broker.price_cache', n, tags=[f'source:{self.source}', f'result:{result}'])
+
+    def client(self):
+        if time.time() < self.down_until:
+            return None
+        return self.r if self.r is not None else get_redis()
+
+    def failed(self, e):
+        print(f"price cache: redis unavailable ({e}), fetching prices directly for {REDIS_RETRY}s")
+        self.down_until = time.time() + REDIS_RETRY
+        self.count('error')
+
+    def lookup(self, symbols):
+        """
+        Returns (prices, stale, missing): a price for every symbol with a usable quote, the
+        stale ones this process should refresh, and the symbols that have to be fetched.
+        """
+        symbols = list(symbols)
+        r = self.client()
+        if r is None or not symbols:
+            return {}, [], symbols
+        try:
+            values = r.mget([self.key(symbol) for symbol in symbols])
+        except redis.exceptions.RedisError as e:
+            self.failed(e)
+            return {}, [], symbols
+
+        prices, stale, missing = {}, [], []
+        now = time.time()
+        for symbol, value in zip(symbols, values):
+            quote = json.loads(value) if value is not None else None
+            age = now - quote['time'] if quote is not None else None
+            if age is None or age > self.fresh + self.stale:
+                missing.append(symbol)
+                continue
+            prices[symbol] = quote['price']
+            if age > self.fresh:
+                stale.append(symbol)
+        self.count('hit', len(prices) - len(stale))
+        self.count('stale', len(stale))
+        self.count('miss', len(missing))
+        # refreshed by whichever process gets there first
+        stale = [symbol for symbol in stale if self.claim_refresh(r, symbol)]
+        return prices, stale, missing
+
+    def claim_refresh(self, r, symbol):
+        try:
+            return bool(r.set(f"{self.key(symbol)}:refresh", 1, nx=True, ex=REFRESH_LOCK_TTL))
+        except redis.exceptions.RedisError as e:
+            self.failed(e)
+            return False
+
+    def put(self, prices):
+        """Share freshly fetched prices ({symbol: price}) with the other processes"""
+        r = self.client()
+        if r is None or not prices:
+            return
+        ttl = max(1, int(self.fresh + self.stale + 1))
+        try:
+            pipe = r.pipeline(transaction=False)
+            for symbol, price in prices.items():
+                pipe.set(self.key(symbol), json.dumps({'price': price, 'time': time.time()}), ex=ttl)
+                pipe.delete(f"{self.key(symbol)}:refresh")
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            self.failed(e)
+
+caches = {}
+
+def get_cache(source, fresh, stale):
+    cache = caches.get(source)
+    if cache is None:
+        cache = caches[source] = PriceCache(source, fresh, stale)
+    return cache
+
+def summary():
+    """One line per source: how many lookups the shared cache answered without a broker call"""
+    lines = []
+    for source in caches:
+        counts = {}
+        for result in ['hit', 'stale', 'miss']:
+            stats = core_metrics.get_stats('broker.price_cache', [f'source:{source}', f'result:{result}'])
+            counts[result] = int(stats['total']) if stats else 0
+        total = sum(counts.values())
+        if total:
+            saved = counts['hit'] + counts['stale']
+            lines.append(f"price cache {source}: {counts['hit']} fresh, {counts['stale']} stale, {counts['miss']} misses "
+                         f"({saved} broker calls saved, {100 * saved / total:.0f}%)")
+    return lines
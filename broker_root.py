@@ -1,7 +1,20 @@
+import asyncio
 import configparser
 import core_error
+import broker_prices
 
 class broker_root:
+    # how many accounts using this driver can be planned at once on worker threads
+    planning_threads = 4
+    # times this driver has fetched the whole portfolio from the broker
+    portfolio_fetches = 0
+    # set by start_async once the driver can trade; signals are only planned for ready drivers
+    ready = False
+    # this driver's prices in the shared price cache: source name, and how many seconds a
+    # price counts as fresh (price-cache-stale in config.ini says how long after that it's usable)
+    price_source = None
+    price_fresh = 5
+
     def __init__(self, bot, account):
         self.config = configparser.ConfigParser()
         self.config.read('config.ini')
@@ -20,6 +33,12 @@ class broker_root:
             return merged_config
         return account_config
 
+    # connect and warm up; broker.py starts every account's driver concurrently, and keeps
+    # retrying in the background for those that fail. Drivers with nothing to do are ready at once
+    async def start_async(self):
+        self.ready = True
+        return True
+
     def handle_ex(self, e, context="unknown"):
         core_error.handle_ex(e, context, "broker")
 
@@ -33,20 +52,87 @@ class broker_root:
     def get_price(self, symbol):
         pass
 
+    def price_cache(self):
+        cache = broker_prices.caches.get(self.price_source)
+        if cache is None:
+            stale = self.config.getfloat('DEFAULT', 'price-cache-stale', fallback=10)
+            cache = broker_prices.get_cache(self.price_source, self.price_fresh, stale)
+        return cache
+
+    # prices for several symbols as a dict of symbol -> price; drivers whose API takes
+    # a list of symbols override this to fetch them in one request
+    def get_prices(self, symbols):
+        return {symbol: self.get_price(symbol) for symbol in symbols}
+
+    async def get_prices_async(self, symbols):
+        return self.get_prices(symbols)
+
+    # called before an account whose driver is planned on the event loop (planning_threads = 0)
+    # is planned, to fetch without blocking whatever planning reads: returns prices, completed
+    # with whichever of the missing symbols could be priced
+    async def prepare_async(self, symbols=(), prices=None):
+        return dict(prices) if prices else {}
+
+    # drivers whose API is async override this; the others download on a worker thread.
+    # copy=False lets callers that only read the bars skip copying them out of the bar store
+    async def download_data_async(self, symbol, end, duration, barlength, cachedata=False, copy=True):
+        return await asyncio.to_thread(self.download_data, symbol, end, duration, barlength, cachedata, copy)
+
     def get_net_liquidity(self):
         pass
 
     def get_position_size(self, symbol):
         pass
 
-    async def set_position_size(self, symbol, amount):
+    # all positions for the account in one call, as a dict of symbol -> size
+    def get_positions(self):
+        pass
+
+    # get_positions() for the event loop; drivers whose lookup blocks override this
+    async def get_positions_async(self):
+        return self.get_positions()
+
+    # the key get_positions() uses for the position symbol trades into
+    def position_key(self, symbol):
+        return self.get_stock(symbol).symbol
+
+    # positions (key -> size, from positions) held in futures months that symbol no longer
+    # trades because they've been rolled past; signals for symbol close them
+    def rolled_positions(self, symbol, positions):
+        return {}
+
+    def get_open_orders(self):
+        pass
+
+    # position_size is the current position if the caller already knows it
+    async def set_position_size(self, symbol, amount, position_size=None):
         pass
 
     async def is_trade_completed(self, trade):
         pass
 
+    # is_trade_completed() straight from the broker, for when the driver's pushed order
+    # updates may have missed the end of the trade
+    async def check_trade_completed(self, trade):
+        return await self.is_trade_completed(trade)
+
+    # asyncio.Event that gets set once a trade returned by set_position_size is done
+    def get_trade_event(self, trade):
+        pass
+
+    # called once nothing waits on the trade any more, so drivers can drop what they track for it
+    def forget_trade(self, trade):
+        pass
+
     def download_data(self, symbol, end, duration, timeframe):
         pass
 
     def health_check(self):
-        pass
\ No newline at end of file
+        pass
+
+    # the broker's health check runs on the event loop; drivers that mustn't block it override these
+    async def health_check_prices_async(self):
+        self.health_check_prices()
+
+    async def health_check_positions_async(self):
+        self.health_check_positions()
\ No newline at end of file
@@ -0,0 +1,60 @@
+import core_metrics
+
+class AccountSnapshot:
+    """
+    Positions, net liquidity and open orders for one account, fetched once per signal
+    so that sizing, retry filtering and order placement don't each go back to the broker.
+    Call refresh_positions() (refresh_positions_async() on the event loop) after fills to
+    pick up the new positions. Prices prefetched for the signal can be passed in; anything
+    else is fetched from the driver.
+    """
+    def __init__(self, driver, prices=None):
+        self.driver = driver
+        self.positions = {}
+        self.net_liquidity = 0
+        self.prices = dict(prices) if prices else {}
+        self._open_orders = None
+        self.refresh()
+
+    def refresh(self):
+        self.positions = self.driver.get_positions()
+        self.net_liquidity = self.driver.get_net_liquidity()
+        self._open_orders = None
+        core_metrics.increment('broker.snapshot_fetches', tags=[f'account:{self.driver.account}'])
+
+    def refresh_positions(self):
+        self.positions = self.driver.get_positions()
+        core_metrics.increment('broker.snapshot_fetches', tags=[f'account:{self.driver.account}'])
+
+    async def refresh_positions_async(self):
+        # for the event loop, between the closing and opening trades
+        self.positions = await self.driver.get_positions_async()
+        core_metrics.increment('broker.snapshot_fetches', tags=[f'account:{self.driver.account}'])
+
+    @property
+    def open_orders(self):
+        # nothing in planning needs these yet, so only pay for the lookup when asked
+        if self._open_orders is None:
+            self._open_orders = self.driver.get_open_orders()
+        return self._open_orders
+
+    def get_position_size(self, symbol):
+        # positions are keyed the way the broker reports them, e.g. NQ for NQ1!
+        psize = self.positions.get(self.driver.position_key(symbol), 0)
+        print(f"  snapshot get_position_size({symbol}) -> {psize}")
+        return psize
+
+    def rolled_positions(self, symbol):
+        return self.driver.rolled_positions(symbol, self.positions)
+
+    def get_net_liquidity(self):
+        return self.net_liquidity
+
+    def get_price(self, symbol):
+        key = symbol.replace('1!', '').upper()
+        price = self.prices.get(key)
+        if price is None:
+            price = self.prices[key] = self.driver.get_price(symbol)
+        else:
+            print(f"  snapshot get_price({symbol}) -> {price}")
+        return price
@@ -9,8 +9,7 @@ from textmagic.rest import TextmagicRestClient
 nest_asyncio.apply()
 
 from broker_root import broker_root
-from broker_ibkr import broker_ibkr
-from broker_alpaca import broker_alpaca
+import broker_drivers
 
 for account in ["U8438939", "PA3I5VZDCGPF"]:
     print(f"Account: {account}")
@@ -20,12 +19,7 @@ for account in ["U8438939", "PA3I5VZDCGPF"]:
     print("HEALTH CHECK")
     config.read('config.ini')
     aconfig = config[account]
-    if aconfig['driver'] == 'ibkr':
-        driver = broker_ibkr(bot, account)
-    elif aconfig['driver'] == 'alpaca':
-        driver = broker_alpaca(bot, account)
-    else:
-        raise Exception("Unknown driver: " + aconfig['driver'])
+    driver = broker_drivers.create(aconfig['driver'], bot, account)
     driver.health_check()
 
     print("GET POSITION SIZE")
@@ -1,67 +1,92 @@
 import configparser
 import traceback
 import logging
+import time
 import urllib3
 
-# For SMS notifications
-try:
-    from textmagic.rest import TextmagicRestClient
-    TEXTMAGIC_AVAILABLE = True
-except ImportError:
-    TEXTMAGIC_AVAILABLE = False
-    print("TextMagic library not found. SMS notifications will be disabled.")
-
-# For Datadog monitoring
-try:
-    from datadog import initialize, statsd
-    from datadog.api import Event
-    DATADOG_AVAILABLE = True
-except ImportError:
-    DATADOG_AVAILABLE = False
-    print("Datadog library not found. Monitoring will be disabled.")
-
 # Suppress SSL connection noise
 logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# Initialize Datadog on module import
-config = configparser.ConfigParser()
-config.read('config.ini')
+# The Datadog and TextMagic clients (and their libraries) are set up by init() on first use
+# instead of on import, so processes that import this module don't pay for them up front
+initialized = False
+datadog_enabled = False
+textmagic_enabled = False
+statsd = None
+Event = None
+textmagic_client = None
+textmagic_phone = ''
+# how long init() took, in ms (for the broker's startup report)
+init_ms = None
 
-# Debug config reading - safely get values with defaults
-dd_api_key = config.get('DEFAULT', 'datadog-api-key', fallback='')
-dd_app_key = config.get('DEFAULT', 'datadog-app-key', fallback='')
-print(f"Initializing Datadog with API key: {dd_api_key[:8] if dd_api_key else 'None'}... App key: {dd_app_key[:8] if dd_app_key else 'None'}...")
+def init():
+    global initialized, datadog_enabled, textmagic_enabled, statsd, Event, textmagic_client, textmagic_phone, init_ms
+    if initialized:
+        return
+    initialized = True
+    start = time.perf_counter()
 
-# Check if Datadog is properly configured
-datadog_enabled = (DATADOG_AVAILABLE and dd_api_key and dd_app_key)
+    # For SMS notifications
+    try:
+        from textmagic.rest import TextmagicRestClient
+        TEXTMAGIC_AVAILABLE = True
+    except ImportError:
+        TEXTMAGIC_AVAILABLE = False
+        print("TextMagic library not found. SMS notifications will be disabled.")
 
-if datadog_enabled:
+    # For Datadog monitoring
     try:
-        options = {
-            'api_key': dd_api_key,
-            'app_key': dd_app_key,
-            'api_host': 'https://api.us5.datadoghq.com'
-        }
-        initialize(**options)
-        print("Datadog monitoring enabled")
-    except Exception as e:
-        print(f"Failed to initialize Datadog: {e}")
-        datadog_enabled = False
-else:
-    print("Datadog monitoring disabled (missing API keys or library)")
+        from datadog import initialize, statsd
+        from datadog.api import Event
+        DATADOG_AVAILABLE = True
+    except ImportError:
+        DATADOG_AVAILABLE = False
+        print("Datadog library not found. Monitoring will be disabled.")
 
-# TextMagic configuration
-textmagic_username = config.get('DEFAULT', 'textmagic-username', fallback='')
-textmagic_token = config.get('DEFAULT', 'textmagic-token', fallback='')
-textmagic_phone = config.get('DEFAULT', 'textmagic-phone', fallback='')
-textmagic_enabled = (TEXTMAGIC_AVAILABLE and textmagic_username and textmagic_token and textmagic_phone)
+    config = configparser.ConfigParser()
+    config.read('config.ini')
 
-if textmagic_enabled:
-    print(f"TextMagic SMS notifications enabled for {textmagic_phone}")
-    textmagic_client = TextmagicRestClient(textmagic_username, textmagic_token)
-else:
-    print("TextMagic SMS notifications disabled (missing credentials or library)")
+    # Debug config reading - safely get values with defaults
+    dd_api_key = config.get('DEFAULT', 'datadog-api-key', fallback='')
+    dd_app_key = config.get('DEFAULT', 'datadog-app-key', fallback='')
+    print(f"Initializing Datadog with API key: {dd_api_key[:8] if dd_api_key else 'None'}... App key: {dd_app_key[:8] if dd_app_key else 'None'}...")
+
+    # Check if Datadog is properly configured
+    datadog_enabled = bool(DATADOG_AVAILABLE and dd_api_key and dd_app_key)
+
+    if datadog_enabled:
+        try:
+            options = {
+                'api_key': dd_api_key,
+                'app_key': dd_app_key,
+                'api_host': 'https://api.us5.datadoghq.com'
+            }
+            initialize(**options)
+            print("Datadog monitoring enabled")
+        except Exception as e:
+            print(f"Failed to initialize Datadog: {e}")
+            datadog_enabled = False
+    else:
+        print("Datadog monitoring disabled (missing API keys or library)")
+
+    # TextMagic configuration
+    textmagic_username = config.get('DEFAULT', 'textmagic-username', fallback='')
+    textmagic_token = config.get('DEFAULT', 'textmagic-token', fallback='')
+    textmagic_phone = config.get('DEFAULT', 'textmagic-phone', fallback='')
+    textmagic_enabled = bool(TEXTMAGIC_AVAILABLE and textmagic_username and textmagic_token and textmagic_phone)
+
+    if textmagic_enabled:
+        print(f"TextMagic SMS notifications enabled for {textmagic_phone}")
+        textmagic_client = TextmagicRestClient(textmagic_username, textmagic_token)
+    else:
+        print("TextMagic SMS notifications disabled (missing credentials or library)")
+    init_ms = (time.perf_counter() - start) * 1000
+
+def get_statsd():
+    """The Datadog statsd client, or None if Datadog isn't configured"""
+    init()
+    return statsd if datadog_enabled else None
 
 def handle_ex(e, context="unknown", service="unknown", extra_tags=None):
     """
@@ -73,6 +98,8 @@ def handle_ex(e, context="unknown", service="unknown", extra_tags=None):
         service: The service name (e.g., 'webapp', 'broker')
         extra_tags: Additional tags to include with the event
     """
+    init()
+
     # Build tags list
     tags = [
         f'service:{service}',
@@ -116,7 +143,7 @@ def handle_ex(e, context="unknown", service="unknown", extra_tags=None):
             print(f"Failed to send event: {event_e}")
     
     # Send SMS notification if TextMagic is enabled
-    if textmagic_enabled and 'textmagic_client' in globals():
+    if textmagic_enabled and textmagic_client is not None:
         # Only send SMS for critical trade execution failures or connection failures
         error_str = str(e).lower()
         
@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+import core_error
+
+# in-process aggregates, keyed by (metric name, tags), so services can print
+# their own latency reports even when Datadog isn't configured
+stats = {}
+
+def _key(name, tags):
+    return (name, tuple(sorted(tags))) if tags else (name, ())
+
+def _record(name, value, tags):
+    key = _key(name, tags)
+    s = stats.get(key)
+    if s is None:
+        s = stats[key] = {'count': 0, 'total': 0.0, 'max': None, 'last': None}
+    s['count'] += 1
+    s['total'] += value
+    s['last'] = value
+    if s['max'] is None or value > s['max']:
+        s['max'] = value
+    return s
+
+def increment(name, value=1, tags=None):
+    _record(name, value, tags)
+    statsd = core_error.get_statsd()
+    if statsd is not None:
+        try:
+            statsd.increment(name, value, tags=tags)
+        except Exception as e:
+            print(f"Failed to send metric {name}: {e}")
+
+def gauge(name, value, tags=None):
+    _record(name, value, tags)
+    statsd = core_error.get_statsd()
+    if statsd is not None:
+        try:
+            statsd.gauge(name, value, tags=tags)
+        except Exception as e:
+            print(f"Failed to send metric {name}: {e}")
+
+def timing(name, ms, tags=None):
+    """Record a duration in milliseconds"""
+    _record(name, ms, tags)
+    statsd = core_error.get_statsd()
+    if statsd is not None:
+        try:
+            statsd.timing(name, ms, tags=tags)
+        except Exception as e:
+            print(f"Failed to send metric {name}: {e}")
+
+@contextmanager
+def timed(name, tags=None):
+    """Context manager that records the elapsed time of its block via timing()"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, (time.perf_counter() - start) * 1000, tags)
+
+def get_stats(name, tags=None):
+    return stats.get(_key(name, tags))
+
+def report(prefix=""):
+    """Return one line per recorded metric whose name starts with prefix"""
+    lines = []
+    for (name, tags), s in sorted(stats.items()):
+        if not name.startswith(prefix):
+            continue
+        avg = s['total'] / s['count'] if s['count'] else 0
+        tagstr = f" [{','.join(tags)}]" if tags else ""
+        lines.append(f"{name}{tagstr}: count={s['count']} avg={avg:.2f} max={s['max']:.2f} last={s['last']:.2f}")
+    return lines
@@ -0,0 +1,43 @@
+# How signals get from the webapp to the broker processes. 'pubsub' is fire-and-forget;
+# 'streams' keeps each signal in a Redis stream until a broker acknowledges it.
+#
+# Signals are routed per bot (tradingview:<bot>), so a broker only receives and decodes
+# its own traffic. 'human' signals go to tradingview:human, which every broker listens on,
+# and the bare channel/stream carries health checks and signals without a bot.
+SIGNAL_CHANNEL = 'tradingview'
+SIGNAL_STREAM = 'tradingview-stream'
+HUMAN_BOT = 'human'
+STREAM_MAXLEN = 10000
+
+def get_transport(config):
+    return config.get('DEFAULT', 'signal-transport', fallback='pubsub')
+
+def _route(base, bot):
+    bot = (bot or '').strip()
+    return f"{base}:{bot}" if bot else base
+
+def signal_channel(bot=None):
+    return _route(SIGNAL_CHANNEL, bot)
+
+def signal_stream(bot=None):
+    return _route(SIGNAL_STREAM, bot)
+
+def broker_channels(bot):
+    """Everything a broker for this bot subscribes to: its own channel, human signals, and the shared channel"""
+    return [signal_channel(bot), signal_channel(HUMAN_BOT), SIGNAL_CHANNEL]
+
+def broker_streams(bot):
+    return [signal_stream(bot), signal_stream(HUMAN_BOT), SIGNAL_STREAM]
+
+def publish_signal(r, message, transport='pubsub', bot=None):
+    if transport == 'streams':
+        # trimmed approximately so old, acknowledged signals don't pile up
+        r.xadd(signal_stream(bot), {'data': message}, maxlen=STREAM_MAXLEN, approximate=True)
+    else:
+        r.publish(signal_channel(bot), message)
+
+def stream_entry_time(entry_id):
+    """Epoch seconds at which redis added a stream entry, from its id (e.g. b'1700000000000-0')"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split('-')[0]) / 1000.0
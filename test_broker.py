@@ -5,7 +5,10 @@ import os
 import asyncio
 import time
 import sys
-from unittest.mock import patch, MagicMock, call
+import configparser
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock, AsyncMock, call
 
 # Patch sys.argv - we need to do this before importing broker
 original_argv = sys.argv
@@ -49,6 +52,13 @@ config_patch.start()
 # Now it's safe to import broker
 import broker
 
+from broker_config import AccountProfile, ConfigProfiles
+import broker_fills
+from broker_fills import FillTracker
+from broker_pipeline import KeyedLocks, SignalGate
+import core_metrics
+import core_transport
+
 # Restore original
 sys.argv = original_argv
 config_patch.stop()
@@ -57,6 +67,29 @@ psycopg2_patch.stop()
 
 import logging
 
+class FakeRedis:
+    """The few redis calls the shared price cache makes, on a dict"""
+    def __init__(self):
+        self.store = {}
+
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
 # Set up test logger to prevent logs from appearing in test output
 test_logger = logging.getLogger('test_broker')
 test_logger.setLevel(logging.DEBUG)
@@ -96,7 +129,13 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         self.mock_stock.is_futures = False
         self.mock_stock.round_precision = 100
         self.mock_stock.market_order = False
+        self.mock_stock.symbol = 'SOXL'
         self.mock_driver.get_stock.return_value = self.mock_stock
+
+        # Positions are read through a per-signal snapshot; the tests below set the
+        # current position via get_position_size, so report that from get_positions
+        self.mock_driver.get_positions.side_effect = lambda: {'SOXL': self.mock_driver.get_position_size.return_value}
+        self.mock_driver.position_key.side_effect = lambda symbol: symbol
         
         # Create a context that returns our mock driver when setup_trades_for_account is called
         self.setup_trades_patcher = patch.dict('broker.drivers', {'test_account': self.mock_driver})
@@ -115,14 +154,10 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         self.mock_driver.set_position_size.return_value = "order_id"
         self.mock_driver.is_trade_completed.return_value = True
         
-        # Patch the db_pool to avoid database connection
-        self.db_pool_patcher = patch('broker.db_pool')
-        self.mock_db_pool = self.db_pool_patcher.start()
-        
-        # Mock get_account_config
-        self.get_account_config_patcher = patch('broker.get_account_config')
-        self.mock_get_account_config = self.get_account_config_patcher.start()
-        self.mock_get_account_config.return_value = {'driver': 'ibkr', 'default-pct': '100'}
+        # Mock get_account_profile
+        self.get_account_profile_patcher = patch('broker.get_account_profile')
+        self.mock_get_account_profile = self.get_account_profile_patcher.start()
+        self.mock_get_account_profile.return_value = AccountProfile('test_account', {'driver': 'ibkr', 'default-pct': '100'})
         
         # Helper function to create signal data
         def create_signal_data(market_position, prev_market_position, position_pct=None):
@@ -170,8 +205,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         self.setup_trades_patcher.stop()
         self.asyncio_gather_patcher.stop()
         self.asyncio_sleep_patcher.stop()
-        self.get_account_config_patcher.stop()
-        self.db_pool_patcher.stop()
+        self.get_account_profile_patcher.stop()
 
     def test_setup_trades_for_account_short_position(self):
         """Test setting up a short position trade"""
@@ -184,7 +218,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         self.mock_driver.get_stock.assert_called_with('SOXL')
         self.mock_driver.get_price.assert_called_with('SOXL')
         self.mock_driver.get_net_liquidity.assert_called()
-        self.mock_driver.get_position_size.assert_called_with('SOXL')
+        self.mock_driver.get_positions.assert_called()
         
         # Verify an opening trade was added
         self.assertEqual(len(opening_trades), 1)
@@ -209,6 +243,16 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         self.assertEqual(opening_trades[0][1], 'SOXL')
         self.assertEqual(opening_trades[0][2], 0)  # Flat position
     
+    def test_setup_trades_reads_broker_once(self):
+        """Planning an account fetches positions and net liquidity once, through the snapshot"""
+        self.mock_driver.get_position_size.return_value = 100
+
+        broker.setup_trades_for_account('test_account', 'SOXL', -100, [], [])
+
+        self.assertEqual(self.mock_driver.get_positions.call_count, 1)
+        self.assertEqual(self.mock_driver.get_net_liquidity.call_count, 1)
+        self.mock_driver.get_position_size.assert_not_called()
+
     # Test different position transitions
     
     def test_long_to_flat(self):
@@ -314,7 +358,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
     def test_long_above_webhook_qty(self):
         """Test when current long position is above webhook requested quantity"""
         # Set current position to long but larger than webhook
-        self.mock_driver.get_position_size.return_value = 150
+        self.mock_driver.get_position_size.return_value = 1500
         
         # Call the function with smaller position
         closing_trades, opening_trades = broker.setup_trades_for_account(
@@ -323,7 +367,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         
         # Should have a trade to decrease position
         self.assertEqual(len(opening_trades), 1)
-        self.assertEqual(opening_trades[0][2], 100)  # Reduce to 100
+        self.assertEqual(opening_trades[0][2], 950)  # Reduce to 100% of $100k at $100, capped at 95%
     
     def test_short_below_webhook_qty(self):
         """Test when current short position is below webhook requested quantity (less negative)"""
@@ -342,7 +386,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
     def test_short_above_webhook_qty(self):
         """Test when current short position is above webhook requested quantity (more negative)"""
         # Set current position to short but larger than webhook
-        self.mock_driver.get_position_size.return_value = -150
+        self.mock_driver.get_position_size.return_value = -1500
         
         # Call the function with smaller short position
         closing_trades, opening_trades = broker.setup_trades_for_account(
@@ -351,12 +395,12 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         
         # Should have a trade to decrease short position (less negative)
         self.assertEqual(len(opening_trades), 1)
-        self.assertEqual(opening_trades[0][2], -100)  # Reduce to -100
+        self.assertEqual(opening_trades[0][2], -950)  # Reduce to -100%, capped at 95%
     
     def test_same_qty_as_webhook(self):
         """Test when current position matches webhook requested quantity"""
-        # Set current position to match webhook
-        self.mock_driver.get_position_size.return_value = 100
+        # Set current position to match webhook (100% of $100k at $100, capped at 95%)
+        self.mock_driver.get_position_size.return_value = 950
         
         # Call the function with same position
         closing_trades, opening_trades = broker.setup_trades_for_account(
@@ -371,7 +415,7 @@ class TestBrokerSignalProcessing(unittest.TestCase):
     def test_long_take_profit(self):
         """Test a take profit order in a long position"""
         # Set current position to long
-        self.mock_driver.get_position_size.return_value = 100
+        self.mock_driver.get_position_size.return_value = 950
         
         # Call the function with TP (lower quantity)
         closing_trades, opening_trades = broker.setup_trades_for_account(
@@ -380,12 +424,12 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         
         # Should have a trade to reduce position
         self.assertEqual(len(opening_trades), 1)
-        self.assertEqual(opening_trades[0][2], 20)  # Reduce to 20
+        self.assertEqual(opening_trades[0][2], 200)  # Reduce to 20% of $100k at $100
     
     def test_short_take_profit(self):
         """Test a take profit order in a short position"""
         # Set current position to short
-        self.mock_driver.get_position_size.return_value = -100
+        self.mock_driver.get_position_size.return_value = -950
         
         # Call the function with TP (lower quantity)
         closing_trades, opening_trades = broker.setup_trades_for_account(
@@ -394,7 +438,1575 @@ class TestBrokerSignalProcessing(unittest.TestCase):
         
         # Should have a trade to reduce position
         self.assertEqual(len(opening_trades), 1)
-        self.assertEqual(opening_trades[0][2], -20)  # Reduce to -20
+        self.assertEqual(opening_trades[0][2], -200)  # Reduce to -20% of $100k at $100
+
+
+class TestBrokerSignalExecution(unittest.TestCase):
+    """Test a signal end to end, from the pubsub message to the orders placed"""
+
+    def setUp(self):
+        self.driver = MagicMock()
+        self.driver.account = 'test_account'
+        self.driver.planning_threads = 0
+        self.driver.portfolio_fetches = 0
+        self.driver.prepare_async = AsyncMock(side_effect=lambda symbols, prices: dict(prices or {}))
+        self.driver.get_prices_async = AsyncMock(return_value={})
+        self.driver.get_price.return_value = 100.0
+        self.driver.get_net_liquidity.return_value = 100000.0
+        self.driver.get_positions.return_value = {'SOXL': 0}
+        self.stock = MagicMock()
+        self.stock.is_futures = False
+        self.stock.symbol = 'SOXL'
+        self.driver.get_stock.return_value = self.stock
+        self.driver.position_key.side_effect = lambda symbol: symbol
+        self.driver.set_position_size = AsyncMock(return_value='order1')
+        self.driver.is_trade_completed = AsyncMock(return_value=True)
+
+        def filled_event(order_id):
+            event = asyncio.Event()
+            event.set()
+            return event
+        self.driver.get_trade_event.side_effect = filled_event
+
+        profile = AccountProfile('test_account', {'driver': 'ibkr', 'default-pct': '50'})
+        self.patchers = [
+            patch.dict('broker.drivers', {'test_account': self.driver}, clear=True),
+            patch('broker.accounts', ['test_account']),
+            patch('broker.get_account_profile', return_value=profile),
+            patch('broker.update_signal'),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def message(self, ticker, position_pct, bot='test', signal_id=1):
+        return {'type': 'message', 'data': json.dumps({
+            'ticker': ticker,
+            'strategy': {'bot': bot, 'position_pct': position_pct, 'id': signal_id},
+        }).encode()}
+
+    def test_signal_places_order(self):
+        """A long signal sizes against the snapshot and places one order"""
+        asyncio.run(broker.check_messages(self.message('SOXL', 100)))
+        self.driver.set_position_size.assert_awaited_once_with('SOXL', 500, 0)
+
+    def test_prices_prefetched_in_one_call(self):
+        """Every symbol the signal may touch is priced with one get_prices call per driver type"""
+        profile = AccountProfile('test_account', {'driver': 'ibkr', 'default-pct': '50', 'use-inverse-etf': 'yes'}, {'soxl': 'SOXS'})
+        self.driver.get_prices_async.side_effect = lambda symbols: {symbol: 50.0 for symbol in symbols}
+        with patch('broker.get_account_profile', return_value=profile):
+            asyncio.run(broker.check_messages(self.message('SOXL', -100)))
+        self.driver.get_prices_async.assert_awaited_once_with(['SOXL', 'SOXS'])
+        self.driver.prepare_async.assert_awaited_once_with(['SOXL', 'SOXS'], {'SOXL': 50.0, 'SOXS': 50.0})
+        self.driver.get_price.assert_not_called()
+        self.driver.set_position_size.assert_awaited_once_with('SOXS', 1000, 0)
+        broker.update_signal.assert_called_once()
+
+    def test_positions_are_reread_without_blocking_after_closing(self):
+        """Positions after the closing fills come from the async lookup, not a blocking one"""
+        profile = AccountProfile('test_account', {'driver': 'ibkr', 'default-pct': '50', 'use-inverse-etf': 'yes'}, {'soxl': 'SOXS'})
+        self.driver.get_positions.return_value = {'SOXS': 10}
+        self.driver.get_positions_async = AsyncMock(return_value={})
+        with patch('broker.get_account_profile', return_value=profile):
+            asyncio.run(broker.check_messages(self.message('SOXL', 100)))
+        self.driver.get_positions.assert_called_once()
+        self.driver.get_positions_async.assert_awaited_once()
+        self.assertEqual(self.driver.set_position_size.await_args_list,
+                         [call('SOXS', 0, 10), call('SOXL', 500, 0)])
+
+    def test_unneeded_inverse_etf_price_doesnt_fail_the_signal(self):
+        """A long signal goes through when only its inverse ETF couldn't be priced"""
+        profile = AccountProfile('test_account', {'driver': 'ibkr', 'default-pct': '50', 'use-inverse-etf': 'yes'}, {'soxl': 'SOXS'})
+        self.driver.get_prices_async.return_value = {'SOXL': 50.0}
+        self.driver.get_price.side_effect = RuntimeError("IB: blocking call made on the event loop")
+        with patch('broker.get_account_profile', return_value=profile):
+            asyncio.run(broker.check_messages(self.message('SOXL', 100)))
+        self.driver.get_price.assert_not_called()
+        self.driver.set_position_size.assert_awaited_once_with('SOXL', 1000, 0)
+
+    def test_burst_collapses_to_latest_signal(self):
+        """Signals queued behind a running one are dropped in favour of the newest"""
+        async def slow_order(symbol, amount, position_size=None):
+            await asyncio.sleep(0.02)
+            return 'order1'
+        self.driver.set_position_size.side_effect = slow_order
+
+        async def run():
+            await asyncio.gather(
+                broker.check_messages(self.message('SOXL', 100, signal_id=1)),
+                broker.check_messages(self.message('SOXL', -100, signal_id=2)),
+                broker.check_messages(self.message('SOXL', 20, signal_id=3)),
+            )
+
+        before = core_metrics.get_stats('broker.signal.superseded', ['key:test:SOXL'])
+        asyncio.run(run())
+        self.assertEqual([c.args[:2] for c in self.driver.set_position_size.await_args_list], [('SOXL', 500), ('SOXL', 100)])
+        after = core_metrics.get_stats('broker.signal.superseded', ['key:test:SOXL'])
+        self.assertEqual(after['count'] - (before['count'] if before else 0), 1)
+        self.assertEqual(broker.signal_coalescer.latest, {})
+
+    def test_signal_for_other_bot_is_ignored(self):
+        """Signals meant for another bot don't trade"""
+        asyncio.run(broker.check_messages(self.message('SOXL', 100, bot='other')))
+        self.driver.set_position_size.assert_not_called()
+
+class TestBrokerMessageDispatch(unittest.TestCase):
+    """Test handing pubsub messages off to the signal processor"""
+
+    def test_dispatch_runs_handler_and_records_latency(self):
+        """A dispatched message is processed and its dispatch latency recorded"""
+        message = {'type': 'message', 'data': b'{}'}
+        with patch('broker.check_messages', new_callable=AsyncMock) as mock_check:
+            asyncio.run(broker.dispatch_message(message, time.perf_counter()))
+        mock_check.assert_awaited_once_with(message)
+        stats = broker.core_metrics.get_stats('broker.dispatch_latency', ['bot:test'])
+        self.assertIsNotNone(stats)
+        self.assertGreaterEqual(stats['count'], 1)
+
+    def test_dispatch_survives_handler_errors(self):
+        """A failing signal doesn't take down the listener"""
+        message = {'type': 'message', 'data': b'{}'}
+        with patch('broker.check_messages', new_callable=AsyncMock, side_effect=Exception("boom")):
+            asyncio.run(broker.dispatch_message(message, time.perf_counter()))
+
+class TestBrokerStreamTransport(unittest.TestCase):
+    """Test consuming signals from the redis stream transport"""
+
+    def test_stream_entry_is_acked_after_processing(self):
+        """An entry is dispatched with its publish time and acknowledged once handled"""
+        aredis = AsyncMock()
+        entry_id = b'1700000000000-0'
+        with patch('broker.check_messages', new_callable=AsyncMock) as mock_check:
+            asyncio.run(broker.handle_stream_entry(aredis, 'broker-test', b'tradingview-stream:test', entry_id, {b'data': b'{}'}))
+        message = mock_check.await_args[0][0]
+        self.assertEqual(message['data'], b'{}')
+        self.assertEqual(message['transport'], 'streams')
+        self.assertEqual(message['published'], 1700000000.0)
+        aredis.xack.assert_awaited_once_with(b'tradingview-stream:test', 'broker-test', entry_id)
+
+    def test_failed_entry_is_still_acked(self):
+        """A signal that fails is reported, not redelivered forever"""
+        aredis = AsyncMock()
+        with patch('broker.check_messages', new_callable=AsyncMock, side_effect=Exception("boom")):
+            asyncio.run(broker.handle_stream_entry(aredis, 'broker-test', b'tradingview-stream:test', b'1700000000000-0', {b'data': b'{}'}))
+        aredis.xack.assert_awaited_once()
+
+    def test_recovery_replays_recent_entries_and_drops_stale_ones(self):
+        """Unacknowledged entries from a previous run are re-handled unless they're too old"""
+        now_ms = int(time.time() * 1000)
+        recent = f'{now_ms - 5000}-0'.encode()
+        stale = f'{now_ms - (broker.STREAM_RECOVERY_MAX_AGE + 60) * 1000}-0'.encode()
+        claimed = f'{now_ms - 2000}-0'.encode()
+        aredis = AsyncMock()
+        aredis.xreadgroup.return_value = [[b'tradingview-stream:test', [(stale, {b'data': b'old'}), (recent, {b'data': b'new'})]]]
+        aredis.xautoclaim.return_value = [b'0-0', [(recent, {b'data': b'new'}), (claimed, {b'data': b'other'})], []]
+
+        async def run():
+            with patch('broker.check_messages', new_callable=AsyncMock) as mock_check:
+                await broker.recover_pending_entries(aredis, 'broker-test', 'test-host', ['tradingview-stream:test'])
+                await asyncio.gather(*broker.pending_tasks)
+            return mock_check
+        mock_check = asyncio.run(run())
+
+        self.assertEqual([c[0][0]['data'] for c in mock_check.await_args_list], [b'new', b'other'])
+        acked = [c[0][2] for c in aredis.xack.await_args_list]
+        self.assertCountEqual(acked, [stale, recent, claimed])
+
+    def test_transport_latency_from_pubsub_timestamp(self):
+        """Pubsub signals measure delivery latency from the webapp's timestamp"""
+        published = datetime.datetime.now() - datetime.timedelta(seconds=2)
+        broker.record_transport_latency({'type': 'message'}, {'timestamp': published.isoformat()})
+        stats = broker.core_metrics.get_stats('broker.transport.latency', ['transport:pubsub'])
+        self.assertGreaterEqual(stats['last'], 2000)
+
+    def test_publish_signal_uses_configured_transport(self):
+        """The webapp publishes to the channel or the stream depending on signal-transport"""
+        r = MagicMock()
+        core_transport.publish_signal(r, 'msg')
+        r.publish.assert_called_once_with(core_transport.SIGNAL_CHANNEL, 'msg')
+        core_transport.publish_signal(r, 'msg', 'streams')
+        r.xadd.assert_called_once_with(core_transport.SIGNAL_STREAM, {'data': 'msg'}, maxlen=core_transport.STREAM_MAXLEN, approximate=True)
+
+    def test_signals_are_routed_per_bot(self):
+        """Bot signals go to that bot's channel; every broker also hears human signals and the shared channel"""
+        r = MagicMock()
+        core_transport.publish_signal(r, 'msg', bot='live')
+        r.publish.assert_called_once_with('tradingview:live', 'msg')
+        core_transport.publish_signal(r, 'msg', 'streams', bot=' live ')
+        self.assertEqual(r.xadd.call_args[0][0], 'tradingview-stream:live')
+        self.assertEqual(core_transport.broker_channels('test'), ['tradingview:test', 'tradingview:human', 'tradingview'])
+        self.assertEqual(core_transport.broker_streams('test'), ['tradingview-stream:test', 'tradingview-stream:human', 'tradingview-stream'])
+
+class TestBrokerConfigReload(unittest.TestCase):
+    """Test hot reloading of config.ini without restarting the broker"""
+
+    def setUp(self):
+        self.old_driver1 = MagicMock()
+        self.old_driver2 = MagicMock()
+        self.drivers_patcher = patch.dict('broker.drivers', {'acct1': self.old_driver1, 'acct2': self.old_driver2}, clear=True)
+        self.drivers_patcher.start()
+        self.settings_patcher = patch.dict('broker.driver_settings', {
+            'acct1': AccountProfile('acct1', {'driver': 'ibkr', 'port': '7496'}).connection,
+            'acct2': AccountProfile('acct2', {'driver': 'alpaca', 'key': 'old'}).connection,
+        }, clear=True)
+        self.settings_patcher.start()
+        self.profiles_patcher = patch('broker.profiles', ConfigProfiles('nonexistent.ini'))
+        self.profiles_patcher.start()
+        self.accounts_patcher = patch('broker.accounts', ['acct1', 'acct2'])
+        self.accounts_patcher.start()
+
+    def tearDown(self):
+        self.drivers_patcher.stop()
+        self.settings_patcher.stop()
+        self.profiles_patcher.stop()
+        self.accounts_patcher.stop()
+
+    def reload_with(self, ini):
+        new_config = configparser.ConfigParser()
+        new_config.read_string(ini)
+        broker.profiles.load(new_config)
+        self.new_driver = MagicMock()
+        with patch('broker.create_driver', return_value=self.new_driver) as mock_create:
+            broker.reload_config()
+        return mock_create
+
+    def test_reload_rebuilds_only_changed_accounts(self):
+        """Only accounts whose settings changed get a new driver"""
+        mock_create = self.reload_with(
+            "[bot-test]\naccounts = acct1,acct2\n"
+            "[acct1]\ndriver = ibkr\nport = 7496\n"
+            "[acct2]\ndriver = alpaca\nkey = new\n")
+        mock_create.assert_called_once_with('acct2')
+        self.assertIs(broker.drivers['acct1'], self.old_driver1)
+        self.assertIs(broker.drivers['acct2'], self.new_driver)
+
+    def test_sizing_changes_keep_the_drivers(self):
+        """Editing pct settings or DEFAULT keys like price-cache-stale doesn't rebuild any driver"""
+        mock_create = self.reload_with(
+            "[DEFAULT]\nprice-cache-stale = 30\n"
+            "[bot-test]\naccounts = acct1,acct2\n"
+            "[acct1]\ndriver = ibkr\nport = 7496\nsoxl-pct = 50\n"
+            "[acct2]\ndriver = alpaca\nkey = old\ndefault-pct = 20\n")
+        mock_create.assert_not_called()
+        self.assertIs(broker.drivers['acct1'], self.old_driver1)
+        self.assertIs(broker.drivers['acct2'], self.old_driver2)
+
+    def test_old_driver_trades_until_the_new_one_is_ready(self):
+        """A rebuilt driver replaces the old one only once it has connected"""
+        new_config = configparser.ConfigParser()
+        new_config.read_string(
+            "[bot-test]\naccounts = acct1,acct2\n"
+            "[acct1]\ndriver = ibkr\nport = 4002\n"
+            "[acct2]\ndriver = alpaca\nkey = old\n")
+        broker.profiles.load(new_config)
+        self.old_driver1.ready = True
+        connected = asyncio.Event()
+        new_driver = MagicMock(ready=False)
+        async def start_async():
+            await connected.wait()
+            new_driver.ready = True
+        new_driver.start_async = AsyncMock(side_effect=start_async)
+
+        async def run():
+            with patch('broker.create_driver', return_value=new_driver), patch.dict('broker.driver_starts', clear=True):
+                broker.reload_config()
+                await asyncio.sleep(0.01)
+                during = (broker.drivers['acct1'], broker.ready_accounts())
+                connected.set()
+                await broker.driver_starts['acct1']
+            return during
+        during = asyncio.run(run())
+        self.assertEqual(during, (self.old_driver1, ['acct1', 'acct2']))
+        self.assertIs(broker.drivers['acct1'], new_driver)
+        self.assertNotIn('acct1', broker.replacement_drivers)
+
+    def test_reload_adds_and_drops_accounts(self):
+        """Accounts added to or removed from the bot are picked up"""
+        mock_create = self.reload_with(
+            "[bot-test]\naccounts = acct1,acct3\n"
+            "[acct1]\ndriver = ibkr\nport = 7496\n"
+            "[acct3]\ndriver = alpaca\nkey = k\n")
+        mock_create.assert_called_once_with('acct3')
+        self.assertNotIn('acct2', broker.drivers)
+        self.assertEqual(broker.accounts, ['acct1', 'acct3'])
+
+class TestBrokerAccountPlanning(unittest.TestCase):
+    """Test planning several accounts concurrently"""
+
+    def setUp(self):
+        self.threaded_driver = MagicMock()
+        self.threaded_driver.planning_threads = 2
+        self.inline_driver = MagicMock()
+        self.inline_driver.planning_threads = 0
+        self.inline_driver.prepare_async = AsyncMock(side_effect=lambda symbols, prices: dict(prices or {}))
+        self.inline_driver.get_prices_async = AsyncMock(return_value={})
+        self.drivers_patcher = patch.dict('broker.drivers', {
+            'slow_account': self.threaded_driver,
+            'fast_account': self.inline_driver,
+        }, clear=True)
+        self.drivers_patcher.start()
+        self.accounts_patcher = patch('broker.accounts', ['slow_account', 'fast_account'])
+        self.accounts_patcher.start()
+
+    def tearDown(self):
+        self.drivers_patcher.stop()
+        self.accounts_patcher.stop()
+
+    def test_trades_merged_in_account_order(self):
+        """Trades come out in account order even when the first account finishes last"""
+        def fake_setup(account, symbol, pct, closing_trades, opening_trades, snapshot=None):
+            if account == 'slow_account':
+                time.sleep(0.05)
+            closing_trades.append((account, 'SOXS', 0))
+            opening_trades.append((account, symbol, pct))
+            return closing_trades, opening_trades
+
+        with patch('broker.setup_trades_for_account', side_effect=fake_setup):
+            closing_trades, opening_trades, snapshots = asyncio.run(broker.plan_trades('SOXL', 50))
+
+        self.assertEqual([t[0] for t in closing_trades], ['slow_account', 'fast_account'])
+        self.assertEqual([t[0] for t in opening_trades], ['slow_account', 'fast_account'])
+        self.assertEqual(set(snapshots), {self.threaded_driver, self.inline_driver})
+        self.assertIsNotNone(broker.core_metrics.get_stats('broker.plan_account', ['bot:test', 'account:slow_account']))
+
+    def test_planning_error_is_raised(self):
+        """An account that fails to plan fails the signal, as before"""
+        def fake_setup(account, symbol, pct, closing_trades, opening_trades, snapshot=None):
+            if account == 'fast_account':
+                raise Exception("no price")
+            return closing_trades, opening_trades
+
+        with patch('broker.setup_trades_for_account', side_effect=fake_setup):
+            with self.assertRaises(Exception):
+                asyncio.run(broker.plan_trades('SOXL', 50))
+
+class TestBrokerDriverStartup(unittest.TestCase):
+    """Test connecting accounts concurrently at startup"""
+
+    def driver(self, start):
+        driver = MagicMock(ready=False, planning_threads=0)
+        async def start_async():
+            await start()
+            driver.ready = True
+        driver.start_async = AsyncMock(side_effect=start_async)
+        driver.prepare_async = AsyncMock(side_effect=lambda symbols, prices: dict(prices or {}))
+        driver.get_prices_async = AsyncMock(return_value={})
+        return driver
+
+    def setUp(self):
+        attempts = []
+        async def quick():
+            pass
+        async def dead_gateway():
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                await asyncio.sleep(0.2)
+                raise Exception("connection refused")
+        self.attempts = attempts
+        self.healthy = self.driver(quick)
+        self.dead = self.driver(dead_gateway)
+        self.patchers = [
+            patch.dict('broker.drivers', {'healthy': self.healthy, 'dead': self.dead}, clear=True),
+            patch.dict('broker.driver_starts', clear=True),
+            patch('broker.accounts', ['dead', 'healthy']),
+            patch('broker.get_account_profile', return_value=MagicMock(get=lambda key, default=None: '0.1' if key == 'start-timeout' else default,
+                                                                        rules={}, inverse_etfs={})),
+            patch('broker.DRIVER_RETRY_DELAY', 0.01),
+            patch('broker.prefetch_prices', AsyncMock(return_value={})),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+
+    def test_dead_account_does_not_hold_up_the_others(self):
+        """Startup waits at most the deadline; the failed account keeps retrying and is traded once ready"""
+        def fake_setup(account, symbol, pct, closing_trades, opening_trades, snapshot=None):
+            opening_trades.append((account, symbol, pct))
+
+        async def run():
+            start = time.monotonic()
+            await broker.start_drivers()
+            startup = time.monotonic() - start
+            ready_at_startup = broker.ready_accounts()
+            with patch('broker.setup_trades_for_account', side_effect=fake_setup):
+                _, opening_while_down, _ = await broker.plan_trades('SOXL', 50)
+                await broker.driver_starts['dead']
+                _, opening_after, _ = await broker.plan_trades('SOXL', 50)
+            return startup, ready_at_startup, opening_while_down, opening_after
+
+        startup, ready_at_startup, opening_while_down, opening_after = asyncio.run(run())
+        self.assertLess(startup, 0.2)
+        self.assertEqual(ready_at_startup, ['healthy'])
+        self.assertEqual([t[0] for t in opening_while_down], ['healthy'])
+        self.assertEqual(len(self.attempts), 3)
+        self.assertEqual([t[0] for t in opening_after], ['dead', 'healthy'])
+        self.assertIsNotNone(broker.core_metrics.get_stats('broker.driver_ready', ['bot:test', 'account:dead']))
+
+    def test_health_check_skips_accounts_that_are_not_ready(self):
+        """Accounts still connecting, or whose driver never got built, are left out of the health check"""
+        for driver in [self.healthy, self.dead]:
+            driver.health_check_prices_async = AsyncMock()
+            driver.health_check_positions_async = AsyncMock()
+        self.healthy.ready = True
+        with patch('broker.accounts', ['broken', 'dead', 'healthy']), patch('broker.r') as mock_redis:
+            asyncio.run(broker.check_messages({'type': 'message', 'data': b'health check'}))
+        self.healthy.health_check_positions_async.assert_awaited_once()
+        self.dead.health_check_prices_async.assert_not_awaited()
+        self.dead.health_check_positions_async.assert_not_awaited()
+        mock_redis.publish.assert_called_once_with('health', 'ok')
+
+class TestAccountProfiles(unittest.TestCase):
+    """Test compiling config.ini into account profiles"""
+
+    ini = (
+        "[DEFAULT]\nmultiplier = 1.0\n"
+        "[bot-test]\naccounts = acct1,acct2\n"
+        "[cash]\nuse-inverse-etf = yes\nsoxl-pct = 50\n"
+        "[acct1]\ndriver = ibkr\nuse-futures = yes\nsoxl-pct = 70\nndx-pct = 1.5, NQ\ndefault-pct = 0\n"
+        "[acct2]\ndriver = alpaca\ngroup = cash\nmultiplier = 0.1\ntqqq-pct = lots\n"
+        "[inverse-etfs]\nSOXL = SOXS\nTQQQ = SQQQ\n"
+    )
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.ini')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.ini)
+        self.profiles = ConfigProfiles(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_rules_are_parsed(self):
+        """Per-symbol percentages and futures targets are pre-parsed"""
+        profile = self.profiles.get('acct1')
+        self.assertEqual(profile.get_rule('SOXL').pct, 70.0)
+        self.assertIsNone(profile.get_rule('SOXL').target_symbol)
+        self.assertEqual(profile.get_rule('NDX').pct, 1.5)
+        self.assertEqual(profile.get_rule('NDX').target_symbol, 'NQ')
+        self.assertIsNone(profile.get_rule('QQQ'))
+        self.assertEqual(profile.default_pct, 0.0)
+        self.assertTrue(profile.use_futures)
+        self.assertEqual(profile.multiplier, 1.0)
+
+    def test_group_settings_are_merged(self):
+        """Group settings apply, with the account's own settings taking precedence"""
+        profile = self.profiles.get('acct2')
+        self.assertTrue(profile.use_inverse_etf)
+        self.assertEqual(profile.get_rule('SOXL').pct, 50.0)
+        self.assertEqual(profile.multiplier, 0.1)
+        self.assertEqual(profile.inverse_etfs, {'soxl': 'SOXS', 'tqqq': 'SQQQ'})
+        self.assertEqual(self.profiles.get_accounts('test'), ['acct1', 'acct2'])
+
+    def test_bad_value_only_breaks_its_symbol(self):
+        """An unparseable setting fails signals for that symbol only"""
+        profile = self.profiles.get('acct2')
+        with self.assertRaises(Exception):
+            profile.get_rule('TQQQ')
+        self.assertIsNotNone(profile.get_rule('SOXL'))
+
+    def test_profiles_are_cached_until_mtime_changes(self):
+        """Profiles compile once and recompile only when the file changes"""
+        profile = self.profiles.get('acct1')
+        self.assertFalse(self.profiles.changed())
+        self.assertFalse(self.profiles.refresh())
+        self.assertIs(self.profiles.get('acct1'), profile)
+
+        with open(self.path, 'w') as f:
+            f.write(self.ini.replace('soxl-pct = 70', 'soxl-pct = 80'))
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertTrue(self.profiles.changed())
+        self.assertTrue(self.profiles.refresh())
+        self.assertEqual(self.profiles.get('acct1').get_rule('SOXL').pct, 80.0)
+
+class TestBrokerFillTracking(unittest.TestCase):
+    """Test waiting for fills pushed by the drivers' order streams"""
+
+    def setUp(self):
+        # a local stand-in for a broker's order-update stream
+        self.tracker = FillTracker(['filled', 'canceled'])
+        self.driver = MagicMock()
+        self.driver.account = 'acct1'
+        self.driver.get_trade_event.side_effect = self.tracker.watch
+        self.driver.is_trade_completed = AsyncMock(side_effect=lambda order_id: self.tracker.is_done(order_id))
+        self.driver.check_trade_completed = AsyncMock(side_effect=lambda order_id: self.tracker.is_done(order_id))
+        self.driver.forget_trade.side_effect = self.tracker.forget
+        self.update_signal_patcher = patch('broker.update_signal')
+        self.mock_update_signal = self.update_signal_patcher.start()
+
+    def tearDown(self):
+        self.update_signal_patcher.stop()
+
+    def test_wakes_as_soon_as_order_fills(self):
+        """Waiting ends when the fill arrives, with no polling"""
+        async def run():
+            asyncio.get_running_loop().call_later(0.01, self.tracker.update, 'order1', 'filled')
+            return await broker.wait_for_trades([(self.driver, 'order1')], 123, timeout=5)
+
+        start = time.perf_counter()
+        incomplete = asyncio.run(run())
+        self.assertEqual(incomplete, [])
+        self.assertLess(time.perf_counter() - start, 1)
+        self.driver.check_trade_completed.assert_not_called()
+        self.mock_update_signal.assert_called_once()
+
+    def test_fill_from_stream_thread(self):
+        """Updates delivered on the stream's own thread wake the waiter"""
+        async def run():
+            # the waiter registers with the tracker before the stream thread reports the fill
+            self.tracker.watch('order2')
+            threading.Timer(0.01, self.tracker.update_threadsafe, args=('order2', 'canceled')).start()
+            return await broker.wait_for_trades([(self.driver, 'order2')], None, timeout=5)
+
+        self.assertEqual(asyncio.run(run()), [])
+
+    def test_timeout_reports_open_orders(self):
+        """Orders that never finish are returned after the timeout"""
+        self.tracker.update('order3', 'new')
+        incomplete = asyncio.run(broker.wait_for_trades([(self.driver, 'order3')], 123, timeout=0.05))
+        self.assertEqual(incomplete, [(self.driver, 'order3')])
+        self.mock_update_signal.assert_not_called()
+
+    def test_finished_orders_are_forgotten(self):
+        """Once the wait is over the tracker no longer holds the order, filled or not"""
+        async def run():
+            asyncio.get_running_loop().call_later(0.01, self.tracker.update, 'order4', 'filled')
+            return await broker.wait_for_trades([(self.driver, 'order4'), (self.driver, 'order5')], 123, timeout=0.05)
+
+        self.assertEqual(asyncio.run(run()), [(self.driver, 'order5')])
+        self.assertEqual(self.tracker.states, {})
+        self.assertEqual(self.tracker.events, {})
+
+    def test_unwatched_states_are_pruned(self):
+        """States for orders nobody waits on are dropped after STATE_TTL; watched ones are kept"""
+        now = [1000.0]
+        with patch('broker_fills.time.monotonic', side_effect=lambda: now[0]):
+            async def watch():
+                self.tracker.watch('mine')
+            asyncio.run(watch())
+            self.tracker.update('mine', 'new')
+            self.tracker.update('other', 'filled')
+            now[0] += broker_fills.STATE_TTL + 1
+            self.tracker.update('latest', 'new')
+
+        self.assertEqual(set(self.tracker.states), {'mine', 'latest'})
+
+    def test_unplaced_orders_are_skipped(self):
+        """Trades that needed no order don't hold up the signal"""
+        self.assertEqual(asyncio.run(broker.wait_for_trades([(self.driver, None)], 123)), [])
+        self.driver.get_trade_event.assert_not_called()
+
+class TestSignalPipeline(unittest.TestCase):
+    """Test ordering and concurrency of signals per (account, symbol)"""
+
+    def run_jobs(self, jobs):
+        locks = KeyedLocks('test.signal')
+        events = []
+
+        async def job(name, keys, delay):
+            async with locks.acquire(keys):
+                events.append(('start', name))
+                await asyncio.sleep(delay)
+                events.append(('end', name))
+
+        async def run():
+            await asyncio.gather(*[job(*j) for j in jobs])
+            return locks
+
+        return asyncio.run(run()), events
+
+    def test_same_key_runs_in_order(self):
+        """A second signal for the same account+symbol waits for the first"""
+        locks, events = self.run_jobs([
+            ('first', [('acct1', 'SOXL')], 0.02),
+            ('second', [('acct1', 'SOXL')], 0),
+        ])
+        self.assertEqual(events, [('start', 'first'), ('end', 'first'), ('start', 'second'), ('end', 'second')])
+        self.assertEqual(locks.locks, {})
+        stats = core_metrics.get_stats('test.signal.key_wait', ['key:acct1:SOXL'])
+        self.assertGreaterEqual(stats['max'], 10)
+
+    def test_different_keys_run_concurrently(self):
+        """A slow signal doesn't hold up a signal for another symbol"""
+        locks, events = self.run_jobs([
+            ('slow', [('acct1', 'SOXL'), ('acct1', 'SOXS')], 0.05),
+            ('fast', [('acct1', 'TQQQ')], 0),
+        ])
+        self.assertLess(events.index(('end', 'fast')), events.index(('end', 'slow')))
+
+    def test_signal_keys_cover_targets_and_inverse_etfs(self):
+        """Keys include futures targets and inverse ETFs for accounts that trade them"""
+        profile = AccountProfile('acct1', {'driver': 'ibkr', 'ndx-pct': '1.5, NQ', 'use-futures': 'yes', 'use-inverse-etf': 'yes'},
+                                 {'ndx': 'SQQQ', 'nq': 'SQQQ'})
+        with patch('broker.accounts', ['acct1']), patch('broker.get_account_profile', return_value=profile):
+            keys = broker.signal_keys('NDX')
+        self.assertEqual(keys, {('acct1', 'NDX'), ('acct1', 'NQ'), ('acct1', 'SQQQ')})
+
+    def test_signal_keys_follow_the_account_settings(self):
+        """An account without futures or inverse ETFs doesn't lock or price them"""
+        profile = AccountProfile('acct1', {'driver': 'ibkr', 'ndx-pct': '1.5, NQ'}, {'ndx': 'SQQQ', 'nq': 'SQQQ'})
+        with patch('broker.accounts', ['acct1']), patch('broker.get_account_profile', return_value=profile):
+            keys = broker.signal_keys('NDX')
+        self.assertEqual(keys, {('acct1', 'NDX')})
+
+    def test_gate_waits_for_running_signals(self):
+        """A config reload waits for running signals and holds back new ones"""
+        gate = SignalGate()
+        events = []
+
+        async def signal(name, delay):
+            async with gate.signal():
+                events.append(name)
+                await asyncio.sleep(delay)
+
+        async def reload():
+            async with gate.exclusive():
+                events.append('reload')
+
+        async def run():
+            first = asyncio.create_task(signal('first', 0.02))
+            await asyncio.sleep(0)
+            reloading = asyncio.create_task(reload())
+            await asyncio.sleep(0)
+            second = asyncio.create_task(signal('second', 0))
+            await asyncio.gather(first, reloading, second)
+
+        asyncio.run(run())
+        self.assertEqual(events, ['first', 'reload', 'second'])
+
+class TestIbkrMarketData(unittest.TestCase):
+    """Test the IBKR driver's standing market data subscriptions"""
+
+    def setUp(self):
+        import broker_ibkr
+        self.module = broker_ibkr
+        self.market_data_patcher = patch.dict(broker_ibkr.market_data, clear=True)
+        self.market_data_patcher.start()
+        config = configparser.ConfigParser()
+        config.read_string(
+            "[acct1]\nsoxl-pct = 70\nndx-pct = 1.5, NQ\ndefault-pct = 0\nhost = 127.0.0.1\nport = 7496\n"
+            "[inverse-etfs]\nsoxl = SOXS\n")
+        # skip __init__, which connects to a gateway
+        self.driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        self.driver.config = config
+        self.driver.account = 'acct1'
+        self.driver.aconfig = config['acct1']
+        self.driver.conn = MagicMock()
+        self.driver.conn.isConnected.return_value = True
+        self.driver.session = MagicMock(generation=1)
+        self.driver.session.ensure_connected.return_value = self.driver.conn
+        self.driver.session.ensure_connected_async = AsyncMock(return_value=self.driver.conn)
+        self.driver.conn.qualifyContractsAsync = AsyncMock()
+        self.stock = MagicMock(symbol='SOXL')
+        self.driver.get_stock = MagicMock(return_value=self.stock)
+        import broker_prices
+        self.prices_patcher = patch.dict(broker_prices.caches, {'ibkr': broker_prices.PriceCache('ibkr', 15, 10, FakeRedis())})
+        self.prices_patcher.start()
+
+    def tearDown(self):
+        self.market_data_patcher.stop()
+        self.prices_patcher.stop()
+
+    def test_config_symbols(self):
+        """Every *-pct symbol, futures target and inverse ETF pair is subscribed"""
+        self.assertEqual(self.driver.config_symbols(), ['NDX', 'NQ', 'SOXL', 'SOXS'])
+
+    def test_subscribed_price_is_a_memory_read(self):
+        """A streaming ticker is read without any request to IB"""
+        self.driver.conn.reqMktData.return_value = MagicMock(last=25.5, close=25.0)
+        self.driver.subscribe_market_data(['SOXL'])
+        self.assertEqual(self.driver.get_price('SOXL'), 25.5)
+        self.driver.conn.reqTickersAsync.assert_not_called()
+
+    def test_unseen_symbol_falls_back_to_snapshot_then_streams(self):
+        """A symbol without a subscription is fetched once, then subscribed"""
+        self.driver.conn.reqTickersAsync = AsyncMock(return_value=[MagicMock(last=float('nan'), close=24.0)])
+        self.driver.conn.reqMktData.return_value = MagicMock(last=24.5, close=24.0)
+        with patch.dict(self.module.ticker_cache, clear=True):
+            self.assertEqual(self.driver.get_price('SOXL'), 24.0)
+        self.assertEqual(self.driver.get_price('SOXL'), 24.5)
+        self.driver.conn.reqTickersAsync.assert_awaited_once()
+        self.driver.conn.reqMktData.assert_called_once()
+
+    def test_prepare_prices_every_symbol_before_planning(self):
+        """prepare_async completes the prefetched prices, so planning on the loop never blocks"""
+        self.driver.conn.accountSummaryAsync = AsyncMock(return_value=[MagicMock(tag='NetLiquidation', value='1000')])
+        self.driver.get_prices_async = AsyncMock(return_value={'SOXS': 12.0})
+        with patch.dict(self.module.account_state, clear=True):
+            prices = asyncio.run(self.driver.prepare_async(['SOXL', 'SOXS'], {'SOXL': 25.0}))
+        self.assertEqual(prices, {'SOXL': 25.0, 'SOXS': 12.0})
+        self.driver.get_prices_async.assert_awaited_once_with(['SOXS'])
+
+    def test_prepare_leaves_unpriced_symbols_to_planning(self):
+        """A symbol that can't be priced is left out rather than retried and alerted on"""
+        self.driver.conn.accountSummaryAsync = AsyncMock(return_value=[MagicMock(tag='NetLiquidation', value='1000')])
+        self.driver.get_prices_async = AsyncMock(return_value={})
+        self.driver.get_price_async = AsyncMock(side_effect=Exception("no price"))
+        with patch.dict(self.module.account_state, clear=True):
+            prices = asyncio.run(self.driver.prepare_async(['SOXL', 'SOXS'], {'SOXL': 25.0}))
+        self.assertEqual(prices, {'SOXL': 25.0})
+        self.driver.get_price_async.assert_not_called()
+
+    def test_sync_reads_on_the_loop_fail_fast(self):
+        """On the event loop a sync price lookup raises instead of nesting the loop"""
+        async def plan():
+            self.driver.get_price('SOXL')
+        with self.assertRaises(RuntimeError):
+            asyncio.run(plan())
+        self.driver.conn.reqTickersAsync.assert_not_called()
+
+    def test_orders_for_accounts_overlap(self):
+        """Price lookups for one account's order don't hold up another account's"""
+        import broker_ibkr
+        events = []
+
+        async def slow_tickers(stock):
+            events.append('request')
+            await asyncio.sleep(0.01)
+            events.append('reply')
+            return [MagicMock(last=20.0, close=20.0)]
+        self.driver.conn.reqTickersAsync = AsyncMock(side_effect=slow_tickers)
+        self.driver.get_position_size = MagicMock(return_value=0)
+        self.stock.market_order = False
+        self.stock.round_precision = 100
+        self.driver.subscribe_market_data = MagicMock()
+
+        async def run():
+            await asyncio.gather(self.driver.set_position_size('SOXL', 10), self.driver.set_position_size('SOXL', 20))
+        with patch.dict(broker_ibkr.ticker_cache, clear=True):
+            asyncio.run(run())
+        self.assertEqual(events, ['request', 'request', 'reply', 'reply'])
+        self.assertEqual(self.driver.conn.placeOrder.call_count, 2)
+
+class TestIbkrAccountCache(unittest.TestCase):
+    """Test the IBKR driver's event-driven net liquidity and position cache"""
+
+    def setUp(self):
+        import broker_ibkr
+        from eventkit import Event
+        self.state_patcher = patch.dict(broker_ibkr.account_state, clear=True)
+        self.state_patcher.start()
+        self.driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        self.driver.account = 'acct1'
+        self.driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        self.driver.load_conn = MagicMock()
+        self.driver.session = None
+        self.driver.get_stock = MagicMock(side_effect=lambda symbol: MagicMock(symbol=symbol))
+        conn = self.driver.conn = MagicMock()
+        conn.accountValueEvent = Event('accountValueEvent')
+        conn.accountSummaryEvent = Event('accountSummaryEvent')
+        conn.positionEvent = Event('positionEvent')
+        conn.accountValues.return_value = [self.value('acct1', 'NetLiquidation', '1000.5')]
+        conn.positions.return_value = [self.position('acct1', 'SOXL', 10.0), self.position('acct2', 'SOXL', 99.0)]
+
+    def tearDown(self):
+        self.state_patcher.stop()
+
+    def value(self, account, tag, value):
+        return MagicMock(account=account, tag=tag, value=value)
+
+    def position(self, account, symbol, size):
+        return MagicMock(account=account, contract=MagicMock(symbol=symbol), position=size)
+
+    def test_reads_come_from_the_cache(self):
+        """Seeded values are read without asking the gateway again"""
+        self.assertEqual(self.driver.get_net_liquidity(), 1000.5)
+        self.assertEqual(self.driver.get_position_size('SOXL'), 10)
+        self.assertEqual(self.driver.get_positions(), {'SOXL': 10})
+        self.driver.conn.accountSummary.assert_not_called()
+        self.assertEqual(self.driver.conn.positions.call_count, 1)
+
+    def test_events_update_the_cache(self):
+        """Account value and position events keep the cache current"""
+        self.driver.get_net_liquidity()
+        self.driver.conn.accountSummaryEvent.emit(self.value('acct1', 'NetLiquidation', '2000'))
+        self.driver.conn.positionEvent.emit(self.position('acct1', 'SOXL', 0.0))
+        self.driver.conn.positionEvent.emit(self.position('acct1', 'SOXS', 5.0))
+        self.assertEqual(self.driver.get_net_liquidity(), 2000.0)
+        self.assertEqual(self.driver.get_positions(), {'SOXS': 5})
+
+class TestIbkrConnectionManager(unittest.TestCase):
+    """Test clientId leasing and the shared IB session per gateway"""
+
+    def setUp(self):
+        import broker_ibkr_conn
+        self.conn_module = broker_ibkr_conn
+        self.store = {}
+
+        def fake_set(key, value, nx=False, ex=None):
+            if nx and key in self.store:
+                return None
+            self.store[key] = value.encode()
+            return True
+        self.redis = MagicMock()
+        self.redis.set.side_effect = fake_set
+        self.redis.get.side_effect = lambda key: self.store.get(key)
+        self.redis.delete.side_effect = lambda key: self.store.pop(key, None)
+
+    def test_processes_get_distinct_client_ids(self):
+        """Two brokers on one gateway lease different clientIds, and release only their own"""
+        first = self.conn_module.ClientIdRegistry('live@host:1', self.redis)
+        second = self.conn_module.ClientIdRegistry('test@host:2', self.redis)
+        self.assertEqual(first.allocate('127.0.0.1:7496'), 1)
+        self.assertEqual(second.allocate('127.0.0.1:7496'), 2)
+        self.assertEqual(second.allocate('127.0.0.1:4002'), 1)
+        first.release_all()
+        self.assertNotIn('ibkr:clientid:127.0.0.1:7496:1', self.store)
+        self.assertIn('ibkr:clientid:127.0.0.1:7496:2', self.store)
+
+    def test_connect_moves_past_a_taken_client_id(self):
+        """A clientId rejected by the gateway is blocked and the next one is tried"""
+        registry = self.conn_module.ClientIdRegistry('live@host:1', self.redis)
+        with patch('broker_ibkr_conn.IB') as mock_ib_class:
+            ib = mock_ib_class.return_value
+            session = self.conn_module.IBSession('127.0.0.1', 7496, registry)
+            async def connect(*args, **kwargs):
+                if kwargs['clientId'] == 1:
+                    # what the gateway sends before dropping a client whose id is taken
+                    session.on_error(-1, self.conn_module.CLIENT_ID_IN_USE, "client id is already in use", None)
+                    raise ConnectionError("Peer closed connection")
+            ib.connectAsync = AsyncMock(side_effect=connect)
+            self.assertIs(session.connect(), ib)
+        self.assertEqual(session.client_id, 2)
+        self.assertEqual(session.generation, 1)
+        self.assertEqual(self.store['ibkr:clientid:127.0.0.1:7496:1'], b'in-use')
+        self.assertIsNotNone(core_metrics.get_stats('broker.ibkr.connect', ['gateway:127.0.0.1:7496']))
+
+    def test_gateway_down_keeps_the_client_id(self):
+        """Refused or timed out connects retry with the leased id instead of blocking it"""
+        registry = self.conn_module.ClientIdRegistry('live@host:1', self.redis)
+        with patch('broker_ibkr_conn.IB') as mock_ib_class, patch('broker_ibkr_conn.handle_ex'):
+            ib = mock_ib_class.return_value
+            ib.connectAsync = AsyncMock(side_effect=ConnectionRefusedError("Connect call failed"))
+            session = self.conn_module.IBSession('127.0.0.1', 7496, registry)
+            with self.assertRaises(ConnectionRefusedError):
+                session.connect()
+        self.assertEqual([c.kwargs['clientId'] for c in ib.connectAsync.call_args_list], [1, 1, 1])
+        self.assertEqual(session.client_id, 1)
+        self.assertEqual(list(self.store), ['ibkr:clientid:127.0.0.1:7496:1'])
+        self.assertEqual(self.store['ibkr:clientid:127.0.0.1:7496:1'], b'live@host:1')
+
+    def test_lease_is_renewed_while_connected(self):
+        """The session renews its lease on a timer, with no requests going through it"""
+        registry = self.conn_module.ClientIdRegistry('live@host:1', self.redis)
+        with patch('broker_ibkr_conn.IB') as mock_ib_class, patch.object(self.conn_module, 'LEASE_RENEW', 0.01):
+            ib = mock_ib_class.return_value
+            ib.connectAsync = AsyncMock()
+            session = self.conn_module.IBSession('127.0.0.1', 7496, registry)
+            async def connect_and_idle():
+                await session.connect_async()
+                self.redis.set.reset_mock()
+                await asyncio.sleep(0.05)
+                session.close()
+            asyncio.run(connect_and_idle())
+        renewals = [c for c in self.redis.set.call_args_list if c.args == ('ibkr:clientid:127.0.0.1:7496:1', 'live@host:1')]
+        self.assertGreaterEqual(len(renewals), 2)
+        self.assertTrue(all(c.kwargs['ex'] == self.conn_module.LEASE_TTL for c in renewals))
+
+    def test_accounts_share_one_session_per_gateway(self):
+        """Every account on the same gateway gets the same session"""
+        with patch.dict(self.conn_module.sessions, clear=True), \
+             patch.object(self.conn_module, 'registry', self.conn_module.ClientIdRegistry('live@host:1', self.redis)), \
+             patch('broker_ibkr_conn.IB'):
+            first = self.conn_module.get_session('127.0.0.1', '7496')
+            self.assertIs(self.conn_module.get_session('127.0.0.1', 7496), first)
+            self.assertIsNot(self.conn_module.get_session('127.0.0.1', 4002), first)
+
+    def test_accounts_starting_together_share_one_connect(self):
+        """Concurrent connects to one gateway (accounts starting up in parallel) make one connection"""
+        registry = self.conn_module.ClientIdRegistry('live@host:1', self.redis)
+        with patch('broker_ibkr_conn.IB') as mock_ib_class:
+            ib = mock_ib_class.return_value
+            ib.isConnected.return_value = False
+            async def connect(*args, **kwargs):
+                await asyncio.sleep(0.01)
+            ib.connectAsync = AsyncMock(side_effect=connect)
+            session = self.conn_module.IBSession('127.0.0.1', 7496, registry)
+            async def start_two():
+                return await asyncio.gather(session.ensure_connected_async(), session.ensure_connected_async())
+            self.assertEqual(asyncio.run(start_two()), [ib, ib])
+        self.assertEqual(ib.connectAsync.await_count, 1)
+
+class TestIbkrContractCache(unittest.TestCase):
+    """Test the on-disk contract details cache and futures roll"""
+
+    def setUp(self):
+        import broker_contracts
+        import broker_instruments
+        self.contracts = broker_contracts
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'contract-details.json')
+        self.cache = broker_contracts.ContractCache(self.path)
+        self.mnq = broker_instruments.get_instrument('MNQ')
+        self.months = [self.month(expiry, 100 + n) for n, expiry in enumerate(['20260320', '20260619', '20260918', '20261218'])]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def month(self, expiry, con_id):
+        return {'conId': con_id, 'symbol': 'MNQ', 'secType': 'FUT', 'lastTradeDateOrContractMonth': expiry, 'exchange': 'CME',
+                'currency': 'USD', 'multiplier': '2', 'localSymbol': f'MNQ{expiry}', 'tradingClass': 'MNQ'}
+
+    def test_front_month_rolls_before_expiry(self):
+        """The next month takes over roll_days before the front month expires"""
+        self.cache.put(self.mnq, list(reversed(self.months)))
+        contract, rolls = self.cache.front_month(self.mnq, datetime.date(2026, 6, 1))
+        self.assertEqual((contract['conId'], rolls), (101, datetime.date(2026, 6, 14)))
+        contract, rolls = self.cache.front_month(self.mnq, datetime.date(2026, 6, 14))
+        self.assertEqual((contract['conId'], rolls), (102, datetime.date(2026, 9, 13)))
+        # the last known month is still traded, but is a reason to fetch again
+        contract, rolls = self.cache.front_month(self.mnq, datetime.date(2026, 12, 1))
+        self.assertEqual((contract['conId'], rolls), (103, None))
+        self.assertFalse(self.cache.is_fresh(self.mnq, datetime.date(2026, 12, 1)))
+        self.assertTrue(self.cache.is_fresh(self.mnq, datetime.date(2026, 6, 1)))
+        # an expired contract is never handed out
+        self.assertEqual(self.cache.front_month(self.mnq, datetime.date(2027, 1, 5)), (None, None))
+
+    def test_survives_restart(self):
+        """Saved details are read back by a new cache"""
+        self.cache.put(self.mnq, self.months)
+        self.cache.save()
+        reloaded = self.contracts.ContractCache(self.path)
+        self.assertEqual(reloaded.get(self.mnq)['contracts'], self.months)
+        self.assertIsNone(self.contracts.ContractCache(os.path.join(self.tmp.name, 'missing.json')).get(self.mnq))
+
+    def test_driver_trades_the_cached_front_month(self):
+        """Startup fetches details in one batch; contracts then come from the cache with their conId"""
+        import broker_ibkr
+        from ib_insync import Contract, Stock
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.account = 'acct1'
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        driver.conn = MagicMock()
+        driver.check_connection = MagicMock(return_value=True)
+        driver.load_conn = MagicMock()
+        details = [MagicMock(contract=Contract(**month)) for month in self.months + [self.month('20270319', 104)]]
+        driver.conn.reqContractDetailsAsync = AsyncMock(side_effect=[details, [MagicMock(contract=Stock(conId=7, symbol='SOXL'))]])
+        with patch.object(broker_ibkr, 'contract_cache', self.cache), patch.dict(broker_ibkr.stock_cache, clear=True):
+            asyncio.run(driver.qualify_contracts_async(['MNQ1!', 'SOXL', 'MNQ']))
+            self.assertEqual(driver.conn.reqContractDetailsAsync.await_count, 2)
+            self.assertTrue(os.path.exists(self.path))
+            stock = driver.get_stock('MNQ1!')
+            self.assertEqual(stock.secType, 'FUT')
+            self.assertGreaterEqual(stock.lastTradeDateOrContractMonth, datetime.date.today().strftime('%Y%m%d'))
+            self.assertTrue(stock.conId)
+            self.assertEqual(stock.price_scale, 0.1)
+            self.assertEqual(driver.get_stock('SOXL').conId, 7)
+            # nothing left to fetch
+            asyncio.run(driver.qualify_contracts_async(['MNQ', 'SOXL']))
+            self.assertEqual(driver.conn.reqContractDetailsAsync.await_count, 2)
+
+    def test_driver_falls_back_without_details(self):
+        """Without cached details the registry expiry is used, and the contract is rebuilt once details arrive"""
+        import broker_ibkr
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.account = 'acct1'
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        driver.check_connection = MagicMock(return_value=True)
+        driver.load_conn = MagicMock()
+        with patch.object(broker_ibkr, 'contract_cache', self.cache), patch.dict(broker_ibkr.stock_cache, clear=True):
+            stock = driver.get_stock('MNQ')
+            self.assertEqual((stock.lastTradeDateOrContractMonth, stock.conId), (self.mnq.expiry, 0))
+            self.assertIs(driver.get_stock('MNQ'), stock)
+            self.cache.put(self.mnq, self.months + [self.month('20270319', 104), self.month('20270618', 105)])
+            self.assertTrue(driver.get_stock('MNQ').conId)
+
+    def test_position_in_the_old_month_is_closed_after_the_roll(self):
+        """A position still in the month we rolled out of is its own position, and a flat signal closes it"""
+        import broker_ibkr
+        from ib_insync import Future
+        from eventkit import Event
+        today = datetime.date.today()
+        old, new = [(today + datetime.timedelta(days=days)).strftime('%Y%m%d') for days in (3, 90)]
+        self.cache.put(self.mnq, [self.month(old, 101), self.month(new, 102)])
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.account = 'acct1'
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        driver.session = None
+        driver.check_connection = MagicMock(return_value=True)
+        driver.load_conn = MagicMock()
+        conn = driver.conn = MagicMock()
+        conn.accountValueEvent = Event('accountValueEvent')
+        conn.accountSummaryEvent = Event('accountSummaryEvent')
+        conn.positionEvent = Event('positionEvent')
+        conn.accountValues.return_value = [MagicMock(account='acct1', tag='NetLiquidation', value='100000')]
+        # positions come back without an exchange
+        held = Future('MNQ', old, '', currency='USD', multiplier='2', conId=101)
+        conn.positions.return_value = [MagicMock(account='acct1', contract=held, position=3.0)]
+        profile = AccountProfile('acct1', {'driver': 'ibkr', 'default-pct': '100', 'use-futures': 'yes'})
+        with patch.object(broker_ibkr, 'contract_cache', self.cache), patch.dict(broker_ibkr.stock_cache, clear=True), \
+             patch.dict(broker_ibkr.account_state, clear=True), patch.dict('broker.drivers', {'acct1': driver}), \
+             patch('broker.get_account_profile', return_value=profile):
+            self.assertEqual(driver.get_stock('MNQ').conId, 102)
+            snapshot = broker.AccountSnapshot(driver, {'MNQ': 20000.0})
+            self.assertEqual(snapshot.get_position_size('MNQ'), 0)
+            closing, opening = broker.setup_trades_for_account('acct1', 'MNQ', 0, [], [], snapshot)
+            rolled = f"MNQ {old[:6]}"
+            self.assertEqual(closing, [(driver, rolled, 0)])
+            self.assertEqual(opening, [])
+            # the closing order goes to the old month, routed to the instrument's exchange
+            self.assertEqual(snapshot.get_position_size(rolled), 3)
+            contract = driver.get_stock(rolled)
+            self.assertEqual((contract.conId, contract.exchange, contract.is_futures), (101, 'CME', 1))
+
+    def test_held_vx_month_is_closed_as_a_future(self):
+        """A VX position comes back as VIX, which must resolve to the VX future and not the VIX index"""
+        import broker_ibkr
+        import broker_instruments
+        from ib_insync import Future
+        from eventkit import Event
+        today = datetime.date.today()
+        old, new = [(today + datetime.timedelta(days=days)).strftime('%Y%m%d') for days in (3, 35)]
+        vx = broker_instruments.get_instrument('VX')
+        self.cache.put(vx, [dict(self.month(expiry, con_id), symbol='VIX', exchange='CFE', multiplier='1000', tradingClass='VX')
+                            for expiry, con_id in ((old, 201), (new, 202))])
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.account = 'acct1'
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        driver.session = None
+        driver.check_connection = MagicMock(return_value=True)
+        driver.load_conn = MagicMock()
+        conn = driver.conn = MagicMock()
+        conn.accountValueEvent = Event('accountValueEvent')
+        conn.accountSummaryEvent = Event('accountSummaryEvent')
+        conn.positionEvent = Event('positionEvent')
+        conn.accountValues.return_value = []
+        held = Future('VIX', old, '', currency='USD', multiplier='1000', conId=201)
+        conn.positions.return_value = [MagicMock(account='acct1', contract=held, position=-2.0)]
+        with patch.object(broker_ibkr, 'contract_cache', self.cache), patch.dict(broker_ibkr.stock_cache, clear=True), \
+             patch.dict(broker_ibkr.account_state, clear=True):
+            rolled = f"VIX {old[:6]}"
+            self.assertEqual(driver.rolled_positions('VX', driver.get_positions()), {rolled: -2})
+            contract = driver.get_stock(rolled)
+            self.assertEqual((contract.secType, contract.conId, contract.exchange, contract.is_futures), ('FUT', 201, 'CFE', 1))
+            self.assertEqual(contract.round_precision, vx.round_precision)
+
+class TestAlpacaRequests(unittest.TestCase):
+    """Test that the Alpaca driver keeps its clients and stays off the event loop"""
+
+    def setUp(self):
+        import broker_alpaca
+        self.module = broker_alpaca
+        self.driver = broker_alpaca.broker_alpaca.__new__(broker_alpaca.broker_alpaca)
+        self.driver.account = 'acct2'
+        self.driver.conn = MagicMock()
+        self.driver.dataconn = MagicMock()
+        self.driver.positions = {'positions': {}, 'time': 0}
+        import broker_prices
+        self.prices_patcher = patch.dict(broker_prices.caches, {'alpaca': broker_prices.PriceCache('alpaca', 5, 10, FakeRedis())})
+        self.prices_patcher.start()
+
+    def tearDown(self):
+        self.prices_patcher.stop()
+
+    def test_clients_are_kept_per_key(self):
+        """Drivers sharing an API key share one long-lived client pair"""
+        with patch.dict(self.module.alpaca_clients, clear=True), \
+             patch('broker_alpaca.TradingClient') as mock_trading, \
+             patch('broker_alpaca.StockHistoricalDataClient'):
+            first = self.module.get_clients('key1', 'secret', True)
+            self.assertEqual(self.module.get_clients('key1', 'secret', True), first)
+            self.module.get_clients('key2', 'secret', True)
+        self.assertEqual(mock_trading.call_count, 2)
+
+    def test_order_is_placed_off_the_event_loop(self):
+        """Blocking API calls run on the alpaca executor and record per-endpoint latency"""
+        threads = []
+
+        def submit_order(order_data):
+            threads.append(threading.current_thread().name)
+            return MagicMock(id='order1')
+        self.driver.conn.submit_order.side_effect = submit_order
+        self.driver.conn.get_all_positions.return_value = []
+        quote = MagicMock(ask_price=10.0)
+        self.driver.dataconn.get_stock_latest_quote.return_value = {'SOXL': quote}
+
+        with patch.dict(self.module.ticker_cache, clear=True):
+            order_id = asyncio.run(self.driver.set_position_size('SOXL', 10))
+        self.assertEqual(order_id, 'order1')
+        self.assertTrue(threads[0].startswith('alpaca'))
+        self.assertIsNotNone(core_metrics.get_stats('broker.alpaca.request', ['endpoint:submit_order']))
+        self.assertIsNotNone(core_metrics.get_stats('broker.alpaca.request', ['endpoint:latest_quote']))
+
+    def test_health_check_runs_off_the_event_loop(self):
+        """The health check's quote, account and positions requests run on the alpaca executor"""
+        threads = []
+
+        def record(result):
+            def call(*args, **kwargs):
+                threads.append(threading.current_thread().name)
+                return result
+            return call
+        self.driver.dataconn.get_stock_latest_quote.side_effect = record({'SOXL': MagicMock(ask_price=10.0)})
+        self.driver.conn.get_account.side_effect = record(MagicMock(last_equity='1000'))
+        self.driver.conn.get_all_positions.side_effect = record([])
+
+        async def check():
+            await self.driver.health_check_prices_async()
+            await self.driver.health_check_positions_async()
+        with patch.dict(self.module.ticker_cache, clear=True):
+            asyncio.run(check())
+        self.assertEqual(len(threads), 3)
+        self.assertTrue(all(name.startswith('alpaca') for name in threads))
+
+    def test_positions_are_fetched_once_and_indexed(self):
+        """Lookups read the indexed cache; the portfolio is refetched only after the TTL"""
+        self.driver.conn.get_all_positions.return_value = [MagicMock(symbol='SOXL', qty='10'), MagicMock(symbol='SOXS', qty='-5')]
+        self.assertEqual(self.driver.get_position_size('SOXL'), 10)
+        self.assertEqual(self.driver.get_position_size('TQQQ'), 0)
+        self.assertEqual(self.driver.get_positions(), {'SOXL': 10, 'SOXS': -5})
+        self.assertEqual(self.driver.conn.get_all_positions.call_count, 1)
+        self.assertEqual(self.driver.portfolio_fetches, 1)
+
+        self.driver.positions['time'] -= self.module.POSITION_TTL + 1
+        self.driver.get_position_size('SOXL')
+        self.assertEqual(self.driver.conn.get_all_positions.call_count, 2)
+
+    def test_fills_update_cached_positions(self):
+        """A fill's resulting position is written into the cache"""
+        with patch.dict(self.module.position_caches, clear=True):
+            cache = self.module.get_position_cache('key1')
+            self.module.update_cached_position('key1', 'SOXL', '10')
+            self.assertEqual(cache['positions'], {})  # never fetched, nothing to keep current
+            cache['time'] = time.time()
+            self.module.update_cached_position('key1', 'SOXL', '10')
+            self.module.update_cached_position('key1', 'SOXS', '0')
+            self.assertEqual(cache['positions'], {'SOXL': 10})
+
+class TestAlpacaTradeUpdates(unittest.TestCase):
+    """Test the Alpaca trade-updates stream against a local fake server"""
+
+    def setUp(self):
+        import broker_alpaca
+        self.module = broker_alpaca
+        self.fill_trackers_patcher = patch.dict(broker_alpaca.fill_trackers, clear=True)
+        self.fill_trackers_patcher.start()
+
+    def tearDown(self):
+        for entry in self.module.fill_trackers.values():
+            try:
+                entry['stream'].stop()
+            except Exception:
+                pass
+        self.fill_trackers_patcher.stop()
+
+    def start_fake_server(self, updates):
+        """A websocket server that speaks just enough of Alpaca's trading stream protocol"""
+        from websockets.asyncio.server import serve
+        ready = threading.Event()
+        address = {}
+
+        async def handler(ws):
+            auth = json.loads(await ws.recv())
+            self.assertEqual(auth['action'], 'authenticate')
+            await ws.send(json.dumps({'stream': 'authorization', 'data': {'status': 'authorized', 'action': 'authenticate'}}))
+            listen = json.loads(await ws.recv())
+            self.assertEqual(listen['data']['streams'], ['trade_updates'])
+            await ws.send(json.dumps({'stream': 'listening', 'data': {'streams': ['trade_updates']}}))
+            for order_id, status in updates:
+                await ws.send(json.dumps({'stream': 'trade_updates', 'data': {'event': status, 'order': {'id': order_id, 'status': status}}}))
+            await asyncio.sleep(5)
+
+        async def run():
+            async with serve(handler, '127.0.0.1', 0) as server:
+                address['url'] = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+                ready.set()
+                await asyncio.sleep(5)
+
+        threading.Thread(target=lambda: asyncio.run(run()), daemon=True).start()
+        ready.wait(5)
+        return address['url']
+
+    def test_stream_updates_order_states(self):
+        """Fills pushed by the server wake waiters and answer is_trade_completed without REST"""
+        url = self.start_fake_server([('order1', 'new'), ('order1', 'filled')])
+        driver = self.module.broker_alpaca.__new__(self.module.broker_alpaca)
+        driver.account = 'acct2'
+        driver.conn = MagicMock()
+        driver.fills = self.module.get_fill_tracker('key', 'secret', True, url)
+
+        async def run():
+            await asyncio.wait_for(driver.fills.watch('order1').wait(), 5)
+            return await driver.is_trade_completed('order1')
+
+        self.assertTrue(asyncio.run(run()))
+        driver.conn.get_order_by_id.assert_not_called()
+
+    def test_unknown_order_falls_back_to_rest_once(self):
+        """An order the stream hasn't reported is looked up once and remembered"""
+        driver = self.module.broker_alpaca.__new__(self.module.broker_alpaca)
+        driver.account = 'acct2'
+        driver.conn = MagicMock()
+        driver.conn.get_order_by_id.return_value = MagicMock(status='filled')
+        driver.fills = FillTracker(['filled', 'canceled', 'expired'])
+        self.assertTrue(asyncio.run(driver.is_trade_completed('order2')))
+        self.assertTrue(asyncio.run(driver.is_trade_completed('order2')))
+        driver.conn.get_order_by_id.assert_called_once_with('order2')
+
+    def test_final_check_asks_alpaca_when_the_stream_stopped_short(self):
+        """An order the stream last saw partially filled is looked up directly"""
+        driver = self.module.broker_alpaca.__new__(self.module.broker_alpaca)
+        driver.account = 'acct2'
+        driver.conn = MagicMock()
+        driver.conn.get_order_by_id.return_value = MagicMock(status='filled')
+        driver.fills = FillTracker(['filled', 'canceled', 'expired'])
+        driver.fills.update('order3', 'partially_filled')
+        self.assertFalse(asyncio.run(driver.is_trade_completed('order3')))
+        self.assertTrue(asyncio.run(driver.check_trade_completed('order3')))
+        driver.conn.get_order_by_id.assert_called_once_with('order3')
+
+class TestBarStore(unittest.TestCase):
+    """Test the shared historical bar store"""
+
+    def setUp(self):
+        import broker_bars
+        self.bars = broker_bars
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = broker_bars.BarStore(self.tmp.name)
+        self.store_patcher = patch.object(broker_bars, 'bar_store', self.store)
+        self.store_patcher.start()
+
+    def tearDown(self):
+        self.store_patcher.stop()
+        self.tmp.cleanup()
+
+    def frame(self, days, close=1.0):
+        import pandas as pd
+        index = pd.DatetimeIndex(days, name='Date')
+        return pd.DataFrame({'Open': close, 'High': close, 'Low': close, 'Close': close, 'Volume': 100.0}, index=index)
+
+    def test_windows_and_merge(self):
+        """Windows are slices of the mapped file; new bars replace stored ones from their first timestamp"""
+        import numpy as np
+        import pandas as pd
+        days = pd.date_range('2026-01-01', periods=10)
+        self.store.write('ibkr', 'SOXL', '1 day', self.frame(days))
+        window = self.store.read('ibkr', 'SOXL', '1 day', '2026-01-03', '2026-01-05')
+        self.assertEqual(list(window.index.day), [3, 4, 5])
+        self.assertTrue(np.shares_memory(window['Close'].to_numpy(), self.store.array('ibkr', 'SOXL', '1 day')))
+        # the last stored bar comes again (it may have been partial), plus two new ones
+        self.store.write('ibkr', 'SOXL', '1 day', self.frame(pd.date_range('2026-01-10', periods=3), close=2.0))
+        df = self.store.read('ibkr', 'SOXL', '1 day')
+        self.assertEqual(len(df), 12)
+        self.assertEqual(list(df['Close'][-4:]), [1.0, 2.0, 2.0, 2.0])
+        self.assertEqual(self.store.last_time('ibkr', 'SOXL', '1 day'), pd.Timestamp('2026-01-12'))
+        self.assertTrue(self.store.covers('ibkr', 'SOXL', '1 day', '2026-01-01', '2026-01-12'))
+        self.assertFalse(self.store.covers('ibkr', 'SOXL', '1 day', '2025-12-01'))
+
+    def test_downloads_are_copies_unless_asked_not_to_be(self):
+        """The store's frames are read-only; download_data hands out ones callers can change"""
+        import pandas as pd
+        import broker_ibkr
+        import broker_alpaca
+        today = pd.Timestamp.now().normalize()
+        self.store.write('ibkr', 'SOXL', '1 day', self.frame(pd.date_range(end=today, periods=10)),
+                         covered_from=today - pd.Timedelta(days=30), replace=True)
+        with self.assertRaises(ValueError):
+            stored = self.store.read('ibkr', 'SOXL', '1 day')
+            stored.iloc[0, 0] = 9.0
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        df = driver.download_data('SOXL', '', '5 D', '1 day', cachedata=True)
+        df.iloc[0, 0] = 9.0
+        self.assertEqual(self.store.read('ibkr', 'SOXL', '1 day')['Open'].iloc[-5], 1.0)
+        df = driver.download_data('SOXL', '', '5 D', '1 day', cachedata=True, copy=False)
+        with self.assertRaises(ValueError):
+            df.iloc[0, 0] = 9.0
+
+        driver = broker_alpaca.broker_alpaca.__new__(broker_alpaca.broker_alpaca)
+        utc_today = pd.Timestamp.now(tz='UTC').normalize()
+        self.store.write('alpaca', 'SOXL', '1 day', self.frame(pd.date_range(end=utc_today, periods=10)),
+                         covered_from=utc_today - pd.Timedelta(days=400), replace=True)
+        df = driver.download_data('SOXL', '', '1 Y', '1 day', cachedata=True)
+        df.iloc[0, 0] = 9.0
+        self.assertEqual(self.store.read('alpaca', 'SOXL', '1 day')['Open'].iloc[0], 1.0)
+
+    def test_ibkr_fetches_only_new_bars(self):
+        """After the first download, only the bars since the last stored one are requested"""
+        import pandas as pd
+        import broker_ibkr
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        today = pd.Timestamp.now().normalize()
+        history = self.frame(pd.date_range(end=today - pd.Timedelta(days=1), periods=300))
+        driver.fetch_bars_async = AsyncMock(side_effect=[history, self.frame([today - pd.Timedelta(days=1), today], close=2.0)])
+        self.assertEqual(len(driver.download_data('SOXL', '', '1 Y', '1 day')), 300)
+        driver.fetch_bars_async.assert_awaited_once_with('SOXL', '', '1 Y', '1 day')
+        df = driver.download_data('SOXL', '', '1 Y', '1 day')
+        self.assertEqual(driver.fetch_bars_async.call_args, call('SOXL', '', '3 D', '1 day'))
+        self.assertEqual((len(df), df['Close'].iloc[-1]), (301, 2.0))
+        # shorter windows are slices of what's stored
+        self.assertEqual(len(driver.download_data('SOXL', '', '30 D', '1 day', cachedata=True)), 30)
+        self.assertEqual(driver.fetch_bars_async.await_count, 2)
+
+    def test_alpaca_fetches_only_new_bars(self):
+        """The Alpaca driver shares the store and keeps the SDK's (symbol, timestamp) index"""
+        import pandas as pd
+        import broker_alpaca
+        driver = broker_alpaca.broker_alpaca.__new__(broker_alpaca.broker_alpaca)
+        today = pd.Timestamp.now(tz='UTC').normalize()
+        def bars(days, close):
+            df = pd.DataFrame({'open': close, 'close': close, 'volume': 10.0, 'vwap': close},
+                              index=pd.DatetimeIndex(days, name='timestamp'))
+            return MagicMock(df=pd.concat({'SOXL': df}, names=['symbol', 'timestamp']))
+        driver.request = MagicMock(side_effect=[bars(pd.date_range(end=today, periods=200), 1.0), bars([today], 2.0)])
+        driver.dataconn = MagicMock()
+        df = driver.download_data('SOXL', '', '1 Y', '1 day')
+        self.assertEqual((df.index.names, len(df)), (['symbol', 'timestamp'], 200))
+        df = driver.download_data('SOXL', '', '1 Y', '1 day')
+        self.assertEqual(driver.request.call_args[0][2].start.date(), today.date())
+        self.assertEqual((len(df), df['close'].iloc[-1]), (200, 2.0))
+
+class TestBulkDownloads(unittest.TestCase):
+    """Test historical data pacing and the bulk downloader"""
+
+    def setUp(self):
+        import broker_downloads
+        self.downloads = broker_downloads
+        self.tmp = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.tmp.name, 'bulk.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pacing(self):
+        """Requests for one contract beyond its limit wait their turn; other contracts don't"""
+        async def run():
+            pacing = self.downloads.HistoryPacing(per_contract=2, contract_window=0.1)
+            start = time.monotonic()
+            for _ in range(3):
+                async with pacing.slot('SOXL'):
+                    pass
+            async with pacing.slot('SOXS'):
+                pass
+            return time.monotonic() - start
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_no_window_goes_over_the_request_limit(self):
+        """However requests are timed, no 600s window ever sees more than 60 of them"""
+        now = [0.0]
+        async def fake_sleep(seconds):
+            now[0] += seconds
+        async def run():
+            pacing = self.downloads.HistoryPacing()
+            times = []
+            for n in range(200):
+                # bursts, with the odd pause in between
+                if n % 45 == 0:
+                    now[0] += 250
+                async with pacing.slot(f"SYM{n % 20}"):
+                    times.append(now[0])
+            return times
+        with patch('broker_downloads.time.monotonic', side_effect=lambda: now[0]), \
+             patch('broker_downloads.asyncio.sleep', fake_sleep):
+            times = asyncio.run(run())
+        busiest = max(sum(1 for t in times if start <= t < start + 600) for start in times)
+        self.assertEqual(busiest, 60)
+
+    def test_concurrent_dedupe_and_resume(self):
+        """Symbols download concurrently, each once, and an interrupted run resumes"""
+        import broker_ibkr
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        running, calls = [0, 0], []
+        async def load_bars(symbol, end, duration, barlength, cachedata):
+            calls.append(symbol)
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            if symbol == 'BAD':
+                raise Exception('no data')
+            if symbol == 'NDX':
+                # NDX's volume comes from QQQ, which is being downloaded at the same time
+                await driver.download_data_async('QQQ', end, duration, barlength)
+            return [1, 2, 3]
+        driver.load_bars = load_bars
+        downloader = self.downloads.BulkDownloader(driver, self.checkpoint)
+        results, failed = downloader.download(['QQQ', 'NDX', 'SOXL', 'BAD', 'SOXL'], '', '1 Y', '1 day')
+        self.assertEqual(sorted(calls), ['BAD', 'NDX', 'QQQ', 'SOXL'])
+        self.assertGreater(running[1], 1)
+        self.assertEqual((sorted(results), failed), (['NDX', 'QQQ', 'SOXL'], ['BAD']))
+        # the next run only does what's left, then clears the checkpoint
+        calls.clear()
+        driver.load_bars = AsyncMock(return_value=[1])
+        results, failed = downloader.download(['QQQ', 'NDX', 'SOXL', 'BAD'], '', '1 Y', '1 day')
+        self.assertEqual((list(results), failed), (['BAD'], []))
+        self.assertFalse(os.path.exists(self.checkpoint))
+        # a different request doesn't use another's checkpoint
+        downloader.save_checkpoint(['', '5 Y', '1 day'], {'QQQ'})
+        results, failed = downloader.download(['QQQ'], '', '1 Y', '1 day')
+        self.assertEqual(list(results), ['QQQ'])
+
+class TestDriverRegistry(unittest.TestCase):
+    """Test loading drivers by name, on demand"""
+
+    def test_driver_module_loads_when_first_used(self):
+        """A driver's module is imported (and timed) only when an account uses it"""
+        import broker_drivers
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(broker_drivers.drivers), \
+                patch.dict(broker_drivers.import_times, clear=True), patch.object(sys, 'path', [tmp] + sys.path):
+            with open(os.path.join(tmp, 'broker_fake.py'), 'w') as f:
+                f.write("class broker_fake:\n    def __init__(self, bot, account):\n        self.account = account\n")
+            broker_drivers.register('fake', 'broker_fake')
+            self.assertNotIn('broker_fake', sys.modules)
+            try:
+                driver = broker_drivers.create('fake', 'live', 'acct1')
+                self.assertEqual(driver.account, 'acct1')
+                self.assertIn('broker_fake', broker_drivers.import_times)
+                report = broker_drivers.startup_report(1200, {'broker.py imports': 300})
+                self.assertIn('broker.py imports: 300ms', report)
+                self.assertIn('import broker_fake:', report)
+            finally:
+                sys.modules.pop('broker_fake', None)
+            with self.assertRaises(Exception):
+                broker_drivers.create('nosuchdriver', 'live', 'acct1')
+
+    def test_broker_creates_drivers_through_the_registry(self):
+        """broker.py doesn't import driver modules itself"""
+        profile = MagicMock(driver='alpaca')
+        with patch('broker.get_account_profile', return_value=profile), \
+                patch('broker_drivers.create', return_value='driver') as create:
+            self.assertEqual(broker.create_driver('acct1'), 'driver')
+        create.assert_called_once_with('alpaca', broker.bot, 'acct1')
+        self.assertFalse(hasattr(broker, 'broker_alpaca'))
+
+class TestSharedPriceCache(unittest.TestCase):
+    """Test the price cache shared between broker processes"""
+
+    def setUp(self):
+        import broker_prices
+        self.prices = broker_prices
+        self.redis = FakeRedis()
+        self.stats_patcher = patch.dict(core_metrics.stats, clear=True)
+        self.stats_patcher.start()
+
+    def tearDown(self):
+        self.stats_patcher.stop()
+
+    def age(self, cache, symbol, seconds):
+        key = cache.key(symbol)
+        quote = json.loads(self.redis.store[key])
+        quote['time'] -= seconds
+        self.redis.store[key] = json.dumps(quote).encode()
+
+    def test_fresh_stale_and_missing(self):
+        """Prices put by one process are read by another; stale ones are refreshed by one process only"""
+        live = self.prices.PriceCache('ibkr', 15, 10, self.redis)
+        test = self.prices.PriceCache('ibkr', 15, 10, self.redis)
+        live.put({'SOXL': 25.5, 'NQ1!': 18000.0})
+        self.assertEqual(test.lookup(['SOXL', 'NQ', 'TQQQ']), ({'SOXL': 25.5, 'NQ': 18000.0}, [], ['TQQQ']))
+        self.age(live, 'SOXL', 20)
+        self.assertEqual(test.lookup(['SOXL']), ({'SOXL': 25.5}, ['SOXL'], []))
+        # the other process serves it too, but leaves the refresh to the first
+        self.assertEqual(live.lookup(['SOXL']), ({'SOXL': 25.5}, [], []))
+        self.age(live, 'SOXL', 10)
+        self.assertEqual(live.lookup(['SOXL']), ({}, [], ['SOXL']))
+        # sources don't mix
+        self.assertEqual(self.prices.PriceCache('alpaca', 5, 10, self.redis).lookup(['NQ'])[0], {})
+        with patch.dict(self.prices.caches, {'ibkr': live}):
+            self.assertEqual(self.prices.summary(), ['price cache ibkr: 2 fresh, 2 stale, 2 misses (4 broker calls saved, 67%)'])
+
+    def test_redis_down_means_fetching_directly(self):
+        """Without redis every symbol is a miss, and redis isn't tried again for a while"""
+        import redis
+        r = MagicMock()
+        r.mget.side_effect = redis.exceptions.ConnectionError("refused")
+        cache = self.prices.PriceCache('alpaca', 5, 10, r)
+        self.assertEqual(cache.lookup(['SOXL']), ({}, [], ['SOXL']))
+        self.assertEqual(cache.lookup(['SOXL']), ({}, [], ['SOXL']))
+        self.assertEqual(r.mget.call_count, 1)
+
+    def test_alpaca_serves_shared_prices(self):
+        """A fresh shared price needs no quote request; a stale one is refreshed in the background"""
+        import broker_alpaca
+        cache = self.prices.PriceCache('alpaca', 5, 10, self.redis)
+        driver = broker_alpaca.broker_alpaca.__new__(broker_alpaca.broker_alpaca)
+        driver.dataconn = MagicMock()
+        driver.dataconn.get_stock_latest_quote.return_value = {'SOXL': MagicMock(ask_price=26.0)}
+        with patch.dict(self.prices.caches, {'alpaca': cache}), patch.dict(broker_alpaca.ticker_cache, clear=True):
+            cache.put({'SOXL': 25.5})
+            self.assertEqual(driver.get_price('SOXL'), 25.5)
+            driver.dataconn.get_stock_latest_quote.assert_not_called()
+            self.age(cache, 'SOXL', 8)
+            self.assertEqual(driver.get_prices(['SOXL']), {'SOXL': 25.5})
+            broker_alpaca.alpaca_executor.submit(lambda: None).result()
+            driver.dataconn.get_stock_latest_quote.assert_called_once()
+            self.assertEqual(cache.lookup(['SOXL'])[0], {'SOXL': 26.0})
+
+    def test_ibkr_serves_shared_prices(self):
+        """An IBKR price another process fetched is used without a snapshot request"""
+        import broker_ibkr
+        cache = self.prices.PriceCache('ibkr', 15, 10, self.redis)
+        driver = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        driver.load_conn_async = AsyncMock()
+        driver.get_stock_async = AsyncMock(return_value=MagicMock(symbol='SOXL'))
+        driver.get_streaming_price = MagicMock(return_value=None)
+        driver.subscribe_market_data = MagicMock()
+        driver.conn = MagicMock()
+        driver.conn.reqTickersAsync = AsyncMock()
+        with patch.dict(self.prices.caches, {'ibkr': cache}), patch.dict(broker_ibkr.ticker_cache, clear=True):
+            cache.put({'SOXL': 25.5})
+            self.assertEqual(asyncio.run(driver.get_price_async('SOXL')), 25.5)
+        driver.conn.reqTickersAsync.assert_not_called()
+        driver.subscribe_market_data.assert_called_once_with(['SOXL'])
+
+class TestInstrumentRegistry(unittest.TestCase):
+    """Test resolving symbols through instruments.json"""
+
+    def test_lookups(self):
+        """TV symbols, aliases and unlisted symbols all resolve"""
+        import broker_instruments
+        nq = broker_instruments.get_instrument('NQ1!')
+        self.assertTrue(nq.is_futures)
+        self.assertEqual((nq.exchange, nq.round_precision, nq.price_scale), ('CME', 4, 1.0))
+        self.assertEqual(broker_instruments.get_instrument('MNQ1!').price_scale, 0.1)
+        self.assertEqual(broker_instruments.get_instrument('BRK.B').contract_symbol, 'BRK B')
+        other = broker_instruments.get_instrument('AAPL')
+        self.assertEqual((other.sec_type, other.exchange, other.currency), ('STK', 'SMART', 'USD'))
+        self.assertFalse(other.is_futures)
+
+    def test_new_instrument_needs_no_code(self):
+        """An instrument added to the data file is picked up as is"""
+        import broker_instruments
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'default': {'sec_type': 'STK'}, 'instruments': [
+                {'symbols': ['ZB'], 'sec_type': 'FUT', 'exchange': 'CBOT', 'expiry': '20991215', 'round_precision': 32, 'market_order': True}]}, f)
+        try:
+            zb = broker_instruments.InstrumentRegistry(path).get('ZB1!')
+        finally:
+            os.remove(path)
+        self.assertTrue(zb.is_futures)
+        self.assertEqual((zb.expiry, zb.tick_size, zb.market_order), ('20991215', 1 / 32, True))
+
+    def test_drivers_build_contracts_from_the_registry(self):
+        """IBKR contracts and Alpaca stubs carry the registry's settings"""
+        import broker_ibkr
+        import broker_alpaca
+        import broker_contracts
+        ibkr = broker_ibkr.broker_ibkr.__new__(broker_ibkr.broker_ibkr)
+        ibkr.account = 'acct1'
+        ibkr.aconfig = {'host': '127.0.0.1', 'port': '7496'}
+        ibkr.check_connection = MagicMock(return_value=True)
+        ibkr.load_conn = MagicMock()
+        empty_cache = broker_contracts.ContractCache(os.path.join(tempfile.gettempdir(), 'no-such-dir', 'contracts.json'))
+        with patch.dict(broker_ibkr.stock_cache, clear=True), patch.object(broker_ibkr, 'contract_cache', empty_cache):
+            mym = ibkr.get_stock('MYM1!')
+            vx_history = ibkr.get_stock('VX', forhistory=True)
+            self.assertIs(ibkr.get_stock('MYM1!'), mym)
+        self.assertEqual((mym.secType, mym.symbol, mym.exchange, mym.lastTradeDateOrContractMonth), ('FUT', 'MYM', 'CBOT', '20250919'))
+        self.assertEqual((mym.is_futures, mym.round_precision, mym.market_order, mym.price_scale), (1, 100, True, 0.1))
+        self.assertEqual((vx_history.secType, vx_history.symbol), ('CONTFUT', 'VX'))
+
+        alpaca = broker_alpaca.broker_alpaca.__new__(broker_alpaca.broker_alpaca)
+        self.assertEqual(alpaca.get_stock('MYM').is_futures, 1)
+        self.assertEqual(alpaca.get_stock('SOXL').is_futures, 0)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
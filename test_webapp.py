@@ -209,7 +209,7 @@ class TestWebappSignalProcessing(unittest.TestCase):
         expected_signal = flat_signal.copy()
         expected_signal['is_retry'] = True
         self.mock_redis.publish.assert_called_once_with(
-            'tradingview', 
+            'tradingview:test_bot', 
             json.dumps(expected_signal)
         )
     
@@ -2,13 +2,14 @@ import hashlib
 import logging
 from logging.handlers import RotatingFileHandler
 from flask import redirect, render_template, request, session, url_for
-from webapp_core import app, get_db, is_logged_in, USER_CREDENTIALS, save_signal, r, p, process_signal_retries
+from webapp_core import app, get_db, is_logged_in, USER_CREDENTIALS, save_signal, r, p, process_signal_retries, SIGNAL_TRANSPORT
 from flask_apscheduler import APScheduler
 import webapp_reports
 import webapp_dashboard
 import webapp_stocks
 from datadog import statsd
 from core_error import handle_ex
+import core_transport
 import os
 
 # Set up logging
@@ -99,8 +100,8 @@ def webhook():
 @app.get("/health")
 def health():
     try:
-        # send a message to the redis channel to test connectivity
-        r.publish('tradingview', 'health check')
+        # send a health check to the broker(s) to test connectivity
+        core_transport.publish_signal(r, 'health check', SIGNAL_TRANSPORT)
         
         # wait for response
         for i in range(10):
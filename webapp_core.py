@@ -9,6 +9,7 @@ from datetime import timedelta
 import asyncio
 import pytz
 from core_error import handle_ex
+import core_transport
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///trade.db'
@@ -21,6 +22,7 @@ config.read('config.ini')
 USER_CREDENTIALS = config['users']
 
 r = redis.Redis(host='localhost', port=6379, db=0)
+SIGNAL_TRANSPORT = core_transport.get_transport(config)
 p = r.pubsub()
 p.subscribe('health')
 p.get_message(timeout=3)
@@ -316,7 +318,7 @@ def process_signal_retries():
                 # Publish the signal
                 signal_dict['is_retry'] = True
                 app.logger.info(f"Publishing signal: {json.dumps(signal_dict, default=str)}")
-                r.publish('tradingview', json.dumps(signal_dict))
+                core_transport.publish_signal(r, json.dumps(signal_dict), SIGNAL_TRANSPORT, signal_dict['strategy'].get('bot'))
                 
                 # Update retry count for this signal
                 cursor.execute("""
@@ -493,7 +495,7 @@ def save_signal(data_dict):
                 'is_retry': False
             }
             app.logger.info(f"Publishing directional signal immediately: {json.dumps(signal_data, default=str)}")
-            r.publish('tradingview', json.dumps(signal_data, default=str))
+            core_transport.publish_signal(r, json.dumps(signal_data, default=str), SIGNAL_TRANSPORT, data_dict['strategy'].get('bot'))
 
     except Exception as e:
         handle_ex(e, context="save_signal", service="webapp", extra_tags=['component:core'])